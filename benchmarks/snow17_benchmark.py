@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Snow-17 performance benchmarks.
+
+Runs the Snow-17 engines on fixed synthetic forcings (daily and 6-hourly,
+a single point and many cells) and records the throughput (cell timesteps
+per second) and the peak memory allocated by numpy/python of each case
+(Python 3 only, tracemalloc).
+
+Usage: python benchmarks/snow17_benchmark.py [--ncells 10000] [--out FILE]
+"""
+from __future__ import print_function
+import argparse
+import json
+import time as tm
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+from tonic.testing import snow17_forcings
+from tonic.models.snow17.snow17 import snow17, snow17_multi, njit
+
+# (name, timestep (hours), number of timesteps)
+FORCINGS = [('daily', 24, 3650), ('6-hourly', 6, 7300)]
+
+
+def engines(ncells):
+    """Benchmark cases: (name, function(time, prec, tair, dt), ncells)"""
+    cases = [('snow17 python', _point('python'), 1)]
+    if njit is not None:
+        cases.append(('snow17 numba', _point('numba'), 1))
+    cases.append(('snow17_multi', _multi, 1))
+    cases.append(('snow17_multi', _multi, ncells))
+    return cases
+
+
+def _point(backend):
+    def run(time, prec, tair, dt):
+        return snow17(time, prec[:, 0], tair[:, 0], dt=dt, backend=backend)
+    return run
+
+
+def _multi(time, prec, tair, dt):
+    return snow17_multi(time, prec, tair, dt=dt)
+
+
+def benchmark(func, time, prec, tair, dt, repeat=3):
+    """Best wall time (s) and peak traced memory (MB, None if unavailable)
+    of func"""
+    # compile / warm up
+    func(time[:10], prec[:10], tair[:10], dt)
+    best = None
+    for i in range(repeat):
+        t0 = tm.time()
+        func(time, prec, tair, dt)
+        elapsed = tm.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    if tracemalloc is None:
+        return best, None
+    tracemalloc.start()
+    func(time, prec, tair, dt)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snow-17 benchmarks')
+    parser.add_argument('--ncells', type=int, default=10000,
+                        help='number of cells of the multi cell cases')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each case')
+    parser.add_argument('--out', type=str, default=None,
+                        help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    print('{0:10s} {1:15s} {2:>7s} {3:>7s} {4:>9s} {5:>14s} {6:>9s}'.format(
+        'forcing', 'engine', 'ncells', 'nsteps', 'time (s)', 'steps/s',
+        'peak (MB)'))
+    for forcing, dt, nsteps in FORCINGS:
+        for name, func, ncells in engines(args.ncells):
+            time, prec, tair = snow17_forcings(nsteps, ncells=ncells, dt=dt)
+            elapsed, peak = benchmark(func, time, prec, tair, dt,
+                                      repeat=args.repeat)
+            rate = nsteps * ncells / elapsed
+            print('{0:10s} {1:15s} {2:7d} {3:7d} {4:9.3f} {5:14.0f} '
+                  '{6:>9s}'.format(forcing, name, ncells, nsteps, elapsed,
+                                   rate, 'n/a' if peak is None else
+                                   '{0:.1f}'.format(peak)))
+            results.append({'forcing': forcing, 'engine': name,
+                            'ncells': ncells, 'nsteps': nsteps,
+                            'seconds': elapsed, 'steps_per_second': rate,
+                            'peak_mb': peak})
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return
+
+
+if __name__ == '__main__':
+    main()
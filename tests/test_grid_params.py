@@ -0,0 +1,119 @@
+"""Set to run with pytest
+
+Usage: py.test
+"""
+import pytest
+
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+from tonic.models.vic import grid_params as gp
+from tonic.models.vic.grid_params import grid_params, GatheredDict, Cols
+
+
+@pytest.fixture(scope="function")
+def target_grid():
+    lons = np.arange(-120, -115, 0.5)
+    lats = np.arange(40, 43, 0.5)
+    mask = np.zeros((len(lats), len(lons)), dtype=int)
+    mask[1:4, 2:8] = 1
+    return {'xc': lons, 'yc': lats, 'mask': mask}
+
+
+@pytest.fixture(scope="function")
+def soil_dict(target_grid):
+    ys, xs = np.nonzero(target_grid['mask'])
+    ncells = len(ys)
+    soil = OrderedDict()
+    soil['gridcell'] = np.arange(1, ncells + 1)
+    soil['lats'] = target_grid['yc'][ys]
+    soil['lons'] = target_grid['xc'][xs]
+    soil['infilt'] = np.linspace(0.1, 0.3, ncells)
+    soil['depth'] = np.tile([0.1, 0.5, 1.0], (ncells, 1))
+    return soil
+
+
+def test_grid_params_compress(soil_dict, target_grid):
+    dense = grid_params(soil_dict, target_grid, False, False, False)
+    gathered = grid_params(soil_dict, target_grid, False, False, False,
+                           compress=True)
+    soil = gathered['soil_dict']
+    assert isinstance(soil, GatheredDict)
+    assert soil['infilt'].shape == (target_grid['mask'].sum(), )
+    assert soil['depth'].shape == (3, target_grid['mask'].sum())
+    for var in soil_dict:
+        expanded = soil.dense(var)
+        assert expanded.shape == dense['soil_dict'][var].shape
+        assert np.ma.allequal(expanded, dense['soil_dict'][var])
+
+
+@pytest.fixture(scope="function")
+def param_files(tmpdir, soil_dict):
+    ncells = len(soil_dict['gridcell'])
+    ncols = max(c.max() for c in Cols(nlayers=3).soil_param.values()) + 1
+    data = np.ones((ncells, ncols))
+    data[:, 1] = soil_dict['gridcell']
+    data[:, 2] = soil_dict['lats']
+    data[:, 3] = soil_dict['lons']
+    soil_file = str(tmpdir.join('soil.txt'))
+    np.savetxt(soil_file, data)
+
+    snow = np.ones((ncells, 1 + 3 * 5))
+    snow[:, 0] = soil_dict['gridcell']
+    snow_file = str(tmpdir.join('snow.txt'))
+    np.savetxt(snow_file, snow)
+    return soil_file, snow_file
+
+
+def test_make_grid_cache(tmpdir, param_files, monkeypatch):
+    soil_file, snow_file = param_files
+    nc_file = str(tmpdir.join('params.nc'))
+    cache_dir = str(tmpdir.join('cache'))
+    kwargs = dict(nc_file=nc_file, cache_dir=cache_dir, compress=True)
+    gp.make_grid(None, soil_file, snow_file, None, None, None, **kwargs)
+
+    # change the snow file, the soil file must not be parsed or gridded
+    snow = np.loadtxt(snow_file)
+    snow[:, 11:] = 2.
+    np.savetxt(snow_file, snow)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('soil was parsed again')
+    monkeypatch.setattr(gp, 'soil', fail)
+    gp.make_grid(None, soil_file, snow_file, None, None, None, **kwargs)
+
+    with Dataset(nc_file) as f:
+        assert 'Updated' in f.history
+        assert np.all(f.variables['Pfactor'][:] == 2.)
+        assert np.all(f.variables['AreaFract'][:] == 1.)
+
+    # no changes
+    grid_dict = gp.make_grid(None, soil_file, snow_file, None, None, None,
+                             nc_file=False, cache_dir=cache_dir,
+                             compress=True)
+    assert np.all(grid_dict['snow_dict']['Pfactor'] == 2.)
+
+
+def test_write_netcdf_encoding(tmpdir, param_files):
+    soil_file, snow_file = param_files
+    plain_file = str(tmpdir.join('plain.nc'))
+    gp.make_grid(None, soil_file, snow_file, None, None, None,
+                 nc_file=plain_file, num_workers=1)
+    nc_file = str(tmpdir.join('params.nc'))
+    gp.make_grid(None, soil_file, snow_file, None, None, None,
+                 nc_file=nc_file, zlib=True, complevel=2,
+                 chunks={'lat': 2, 'lon': 3, 'nlayer': 1}, num_workers=2)
+
+    with Dataset(plain_file) as plain, Dataset(nc_file) as f:
+        var = f.variables['depth']
+        assert var.dimensions == ('nlayer', 'lat', 'lon')
+        assert var.filters()['zlib']
+        assert var.filters()['complevel'] == 2
+        assert var.chunking() == [1, 2, 3]
+        assert f.variables['infilt'].chunking() == [2, 3]
+        assert not plain.variables['depth'].filters()['zlib']
+        assert plain.variables['depth'].chunking() == 'contiguous'
+        assert set(f.variables) == set(plain.variables)
+        for name in plain.variables:
+            np.testing.assert_array_equal(f.variables[name][:],
+                                          plain.variables[name][:])
@@ -38,3 +38,31 @@ def test_isscalar():
     assert not isscalar(('a', 'b'))
     assert isscalar(1)
     assert not isscalar('str')
+
+
+def test_paramset(tmpdir):
+    import numpy as np
+    from netCDF4 import Dataset
+    from tonic.io import ParamSet
+
+    nc_file = str(tmpdir.join('params.nc'))
+    mask = np.zeros((4, 5), dtype=int)
+    mask[1:3, 1:4] = 1
+    depth = np.arange(3 * 4 * 5, dtype=float).reshape(3, 4, 5)
+    with Dataset(nc_file, 'w') as f:
+        f.createDimension('nlayer', 3)
+        f.createDimension('lat', 4)
+        f.createDimension('lon', 5)
+        f.createVariable('mask', 'i4', ('lat', 'lon'))[:] = mask
+        f.createVariable('depth', 'f8', ('nlayer', 'lat', 'lon'))[:] = depth
+
+    with ParamSet(nc_file, verbose=False) as params:
+        yinds, xinds = np.nonzero(mask)
+        assert params.ncells == mask.sum()
+        assert np.array_equal(params['depth'], depth[:, yinds, xinds])
+
+        params.select(bbox=(1, 1, 2, 3))
+        assert params.ncells == 2
+        data, attrs = params.read(['depth'])
+        assert data['depth'].shape == (3, 1, 2)
+        assert np.array_equal(data['depth'], depth[:, 1:2, 2:4])
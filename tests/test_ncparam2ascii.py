@@ -0,0 +1,162 @@
+"""Set to run with pytest
+
+Usage: py.test
+"""
+import pytest
+
+import numpy as np
+from netCDF4 import Dataset
+from tonic.models.vic.ncparam2ascii import (subset, veg, lake, rasm_soil,
+                                            CellTable, FILL_VALUE)
+from tonic.models.vic.grid_params import Cols
+
+
+@pytest.fixture(scope="function")
+def veg_data():
+    ny, nx, nclasses = 2, 3, 4
+    cv = np.zeros((nclasses, ny, nx))
+    cv[0, 0, 0] = 0.25
+    cv[2, 0, 0] = 0.75
+    cv[1, 1, 2] = 1.
+    data = {'gridcell': np.arange(1, ny * nx + 1).reshape(ny, nx),
+            'Nveg': (cv > 0).sum(axis=0),
+            'Cv': cv,
+            'root_depth': np.full((nclasses, 3, ny, nx), 0.5),
+            'root_fract': np.full((nclasses, 3, ny, nx), 0.25),
+            'LAI': np.tile(np.arange(12.)[None, :, None, None],
+                           (nclasses, 1, ny, nx))}
+    return data
+
+
+def test_veg(tmpdir, veg_data):
+    veg_file = str(tmpdir.join('veg.txt'))
+    yinds, xinds = np.array([0, 0, 1]), np.array([0, 1, 2])
+    veg(veg_data, xinds, yinds, veg_file, chunk_cells=2)
+    lines = open(veg_file).read().splitlines()
+    lai = ' '.join(str(m) for m in range(12))
+    assert lines == ['1 2',
+                     '1 0.25 0.5 0.25 0.5 0.25 0.5 0.25', lai,
+                     '3 0.75 0.5 0.25 0.5 0.25 0.5 0.25', lai,
+                     '2 0',
+                     '6 1',
+                     '2 1 0.5 0.25 0.5 0.25 0.5 0.25', lai]
+
+
+def test_cell_table(veg_data):
+    yinds, xinds = np.array([0, 1]), np.array([0, 2])
+    table = CellTable.from_grids(veg_data, yinds, xinds, ['Nveg', 'Cv',
+                                                          'root_depth'])
+    assert table.table.shape == (2, 1 + 4 + 4 * 3)
+    assert table['Cv'].shape == (2, 4)
+    assert table['root_depth'].shape == (2, 4, 3)
+    np.testing.assert_array_equal(table['Nveg'], [2, 1])
+    np.testing.assert_array_equal(table['Cv'][1], [0, 1, 0, 0])
+
+
+def test_lake(tmpdir):
+    shape = (1, 3)
+    data = {'gridcell': np.array([[1, 2, 3]]),
+            'lake_idx': np.array([[0, -1, 2]]),
+            'numnod': np.array([[2, 1, 1]]),
+            'mindepth': np.full(shape, 0.5),
+            'wfrac': np.full(shape, 0.25),
+            'depth_in': np.full(shape, 1.),
+            'rpercent': np.full(shape, 0.),
+            'basin_depth': np.array([[[3, 0, 4]], [[2, 0, 0]]]),
+            'basin_area': np.array([[[0.5, 0, 0.25]], [[0.1, 0, 0]]])}
+    lake_file = str(tmpdir.join('lake.txt'))
+    lake(data, np.arange(3), np.zeros(3, dtype=int), lake_file)
+    lines = open(lake_file).read().splitlines()
+    assert lines == ['1 0 2 0.5 0.25 1 0',
+                     '3 0.5 2 0.1',
+                     '2 -1 1 0.5 0.25 1 0',
+                     '3 2 1 0.5 0.25 1 0',
+                     '4 0.25']
+
+
+def test_rasm_soil(tmpdir):
+    ny, nx = 2, 3
+    yc, xc = np.meshgrid([0., 5.], [0., 2., 3.], indexing='ij')
+    cells = np.arange(ny * nx, dtype=np.float64).reshape(ny, nx)
+    data = {'mask': np.ones((ny, nx), dtype=int),
+            'yc': yc, 'xc': xc, 'lats': yc, 'lons': xc,
+            'Nveg': np.array([[1, 2, 3], [4, 5, 6]]),
+            'avg_T': cells + 0.5,
+            'fs_active': np.array([[1, 1, 1], [1, 0, 1]])}
+    for i, (var, cols) in enumerate(Cols(nlayers=3).soil_param.items()):
+        if var not in data:
+            values = cells + 10 * i + 0.5
+            if len(cols) > 1:
+                values = np.array([values + 0.25 * j for j in range(3)])
+            data[var] = values
+    infilt = data['infilt'].copy()
+    # leading nan row, fill-value row and a nan row after it
+    data['infilt'][0, 0] = np.nan
+    data['Ds'][0, 2] = FILL_VALUE
+    data['infilt'][1, 0] = np.nan
+
+    soil_file = str(tmpdir.join('soil.txt'))
+    rasm_soil(data, soil_file)
+    soil = np.loadtxt(soil_file)
+
+    assert soil.shape == (ny * nx, 54)
+    np.testing.assert_array_equal(soil[:, 0], data['Nveg'].ravel())
+    np.testing.assert_array_equal(soil[:, 3], yc.ravel())
+    # inactive cell (1, 1) is filled from its nearest neighbor (1, 2)
+    expected = infilt.ravel()[[1, 1, 2, 1, 5, 5]]
+    np.testing.assert_allclose(soil[:, 5], expected)
+    # nan row is filled from the previous row without nans or fill values
+    np.testing.assert_array_equal(soil[3, 5:], soil[1, 5:])
+    # leading nan row is filled from its nearest valid row
+    np.testing.assert_array_equal(soil[0, 5:], soil[1, 5:])
+    assert not np.isnan(soil).any()
+
+
+@pytest.fixture(scope="function")
+def param_file(tmpdir):
+    ny, nx = 4, 5
+    rng = np.random.RandomState(2)
+    param_file = str(tmpdir.join('params.nc'))
+    with Dataset(param_file, 'w') as f:
+        f.createDimension('nlayer', 3)
+        # not named snow_band
+        f.createDimension('band', 3)
+        f.createDimension('lat', ny)
+        f.createDimension('lon', nx)
+        mask = np.ones((ny, nx), dtype=int)
+        mask[0, :2] = 0
+        f.createVariable('mask', 'i4', ('lat', 'lon'))[:] = mask
+        for var, cols in Cols(nlayers=3).soil_param.items():
+            dims = ('lat', 'lon') if len(cols) == 1 else ('nlayer', 'lat',
+                                                          'lon')
+            shape = tuple(len(f.dimensions[d]) for d in dims)
+            f.createVariable(var, 'f8', dims)[:] = rng.rand(*shape)
+        f.createVariable('cellnum', 'i4', ('lat', 'lon'))[:] = \
+            np.arange(1, ny * nx + 1).reshape(ny, nx)
+        for var in ['AreaFract', 'elevation', 'Pfactor']:
+            f.createVariable(var, 'f8', ('band', 'lat', 'lon'))[:] = \
+                rng.rand(3, ny, nx)
+    return param_file, mask
+
+
+def test_subset_soil_split(tmpdir, param_file):
+    param_file, mask = param_file
+    subset(param_file, soil_file=str(tmpdir.join('soil')))
+    subset(param_file, outfiles=3, num_workers=2,
+           soil_file=str(tmpdir.join('split')))
+
+    expected = tmpdir.join('soil.txt').read()
+    split = ''.join(tmpdir.join('split_{0}.txt'.format(i)).read()
+                    for i in range(3))
+    assert len(expected.splitlines()) == mask.sum()
+    assert split == expected
+
+
+def test_subset_snow(tmpdir, param_file):
+    param_file, mask = param_file
+    snow_file = str(tmpdir.join('snow.txt'))
+    subset(param_file, snow_file=snow_file)
+    snow = np.loadtxt(snow_file)
+    assert snow.shape == (mask.sum(), 1 + 3 * 3)
+    np.testing.assert_array_equal(snow[:, 0],
+                                  np.flatnonzero(mask.ravel()) + 1)
@@ -0,0 +1,261 @@
+"""Set to run with pytest
+
+Usage: py.test
+"""
+import os
+import struct
+import pytest
+
+import numpy as np
+from collections import OrderedDict
+from netCDF4 import Dataset
+from tonic.models.vic.netcdf2vic import (convert, convert_image,
+                                         find_active_cells, pack_binary,
+                                         unit_conversion)
+
+VAR_KEYS = ['prcp', 'tmax', 'tmin']
+
+
+@pytest.fixture(scope="function")
+def forcings(tmpdir):
+    ny, nx, ntime = 4, 5, 30
+    rng = np.random.RandomState(0)
+    lons, lats = np.meshgrid(np.arange(nx) * 0.5 + 240.25,
+                             np.arange(ny) * 0.5 + 40.25)
+    mask = np.ones((ny, nx), dtype=int)
+    mask[0, 0] = 0
+
+    mask_file = str(tmpdir.join('domain.nc'))
+    with Dataset(mask_file, 'w') as f:
+        f.createDimension('y', ny)
+        f.createDimension('x', nx)
+        f.createVariable('mask', 'i4', ('y', 'x'))[:] = mask
+
+    files = []
+    for i in range(2):
+        fname = 'forcing_{0}.nc'.format(i)
+        with Dataset(str(tmpdir.join(fname)), 'w') as f:
+            f.createDimension('time', ntime)
+            f.createDimension('y', ny)
+            f.createDimension('x', nx)
+            f.createVariable('xc', 'f8', ('y', 'x'))[:] = lons
+            f.createVariable('yc', 'f8', ('y', 'x'))[:] = lats
+            for key in VAR_KEYS:
+                v = f.createVariable(key, 'f4', ('time', 'y', 'x'),
+                                     fill_value=1e20)
+                data = np.ma.masked_array(rng.rand(ntime, ny, nx) * 10)
+                # a cell without data
+                data[:, 3, 4] = np.ma.masked
+                v[:] = data
+        files.append(fname)
+    return str(tmpdir), files, mask_file
+
+
+def _read_dir(path):
+    out = {}
+    for fname in os.listdir(path):
+        if fname.startswith('.'):
+            continue
+        with open(os.path.join(path, fname), 'rb') as f:
+            out[fname] = f.read()
+    return out
+
+
+def test_find_active_cells(tmpdir, forcings, capsys):
+    in_path, files, mask_file = forcings
+    nc_file = os.path.join(in_path, files[0])
+    cache_file = str(tmpdir.join('cells.npz'))
+    with Dataset(mask_file) as f:
+        mask = f.variables['mask'][:]
+
+    ylist, xlist, points = find_active_cells(nc_file, mask, VAR_KEYS,
+                                             cache_file=cache_file,
+                                             time_chunk=7)
+    assert len(ylist) == 18
+    assert (0, 0) not in list(zip(ylist, xlist))
+    assert (3, 4) not in list(zip(ylist, xlist))
+    assert points[0] == (40.25, -119.25)
+    assert os.path.isfile(cache_file)
+    capsys.readouterr()
+
+    # the cached cells are reused, unless the mask changes
+    cached = find_active_cells(nc_file, mask, VAR_KEYS, cache_file=cache_file,
+                               verbose=True)
+    assert capsys.readouterr().out.startswith('read active cells')
+    assert np.array_equal(cached[0], ylist)
+    assert cached[2] == points
+    mask[1, 1] = 0
+    ylist, xlist, points = find_active_cells(nc_file, mask, VAR_KEYS,
+                                             cache_file=cache_file)
+    assert len(ylist) == 17
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_convert_stream(tmpdir, forcings, binary):
+    in_path, files, mask_file = forcings
+    outputs = []
+    for stream, num_workers in [(False, 1), (True, 1), (True, 2)]:
+        out_path = str(tmpdir.mkdir('out_{0}_{1}'.format(stream,
+                                                          num_workers)))
+        kwargs = dict(in_path=in_path, stream=stream, time_chunk=7,
+                      tile_size=2, max_open_files=3, num_workers=num_workers)
+        if binary:
+            kwargs.update(binary_path=out_path, binary_type='<Hhh',
+                          binary_mult=[40, 100, 100])
+        else:
+            kwargs.update(ascii_path=out_path)
+        convert(files, VAR_KEYS, mask_file, **kwargs)
+        outputs.append(_read_dir(out_path))
+
+    assert len(outputs[1]) == 18
+    assert 'data_41.750_-117.750' not in outputs[1]
+    assert outputs[0] == outputs[1]
+    assert outputs[0] == outputs[2]
+    if binary:
+        assert len(outputs[1]['data_40.250_-119.250']) == 60 * 3 * 2
+    else:
+        data = np.loadtxt(os.path.join(str(tmpdir), 'out_True_1',
+                                       'data_40.250_-119.250'))
+        assert data.shape == (60, 3)
+
+
+@pytest.mark.parametrize('binary_type,codes', [('<Hhh', 'Hhh'),
+                                               ('>3h', 'hhh'),
+                                               ('Hhi', 'Hhi'),
+                                               ('=fhB', 'fhB'),
+                                               ('@ih', 'ih'),
+                                               ('hbi', 'hbi')])
+def test_pack_binary(binary_type, codes):
+    array = np.random.RandomState(1).rand(10, len(codes)) * 100
+    expected = b''.join(
+        struct.pack(binary_type, *[v if c == 'f' else int(v)
+                                   for c, v in zip(codes, row)])
+        for row in array)
+    assert pack_binary(array, binary_type) == expected
+
+
+def test_pack_binary_not_finite():
+    array = np.ones((4, 2))
+    array[2, 1] = np.nan
+    with pytest.raises(ValueError):
+        pack_binary(array, '<Hh')
+    with pytest.raises(ValueError):
+        pack_binary(array * np.inf, '<Hh')
+    assert len(pack_binary(array, '<ff')) == 4 * 2 * 4
+    assert pack_binary(np.empty((0, 2)), '<Hh') == b''
+
+
+@pytest.fixture(scope="function")
+def image_forcings(tmpdir):
+    lats = np.arange(30, 35, 0.5) + 0.25
+    lons = np.arange(240, 246, 0.5) + 0.25
+    ntime = 8
+    rng = np.random.RandomState(1)
+    files = []
+    for i in range(2):
+        fname = 'forcing_{0}.nc'.format(i)
+        with Dataset(str(tmpdir.join(fname)), 'w') as f:
+            f.createDimension('time', ntime)
+            f.createDimension('lat', len(lats))
+            f.createDimension('lon', len(lons))
+            f.createVariable('lat', 'f8', ('lat', ))[:] = lats
+            f.createVariable('lon', 'f8', ('lon', ))[:] = lons
+            time = f.createVariable('time', 'f8', ('time', ))
+            time.units = 'hours since 1999-12-31 00:00:00'
+            time[:] = (np.arange(ntime) + i * ntime) * 3
+            tas = f.createVariable('tas', 'f4', ('time', 'lat', 'lon'))
+            tas.units = 'K'
+            tas[:] = 270 + rng.rand(ntime, len(lats), len(lons)) * 10
+            pr = f.createVariable('pr', 'f4', ('time', 'lat', 'lon'))
+            pr.units = 'kg m-2 s-1'
+            pr[:] = rng.rand(ntime, len(lats), len(lons)) * 1e-4
+        files.append(fname)
+
+    # the domain is a subset of the forcing grid
+    domain_file = str(tmpdir.join('domain.nc'))
+    with Dataset(domain_file, 'w') as f:
+        f.createDimension('lat', 4)
+        f.createDimension('lon', 3)
+        f.createVariable('lat', 'f8', ('lat', ))[:] = lats[2:6]
+        f.createVariable('lon', 'f8', ('lon', ))[:] = lons[5:8] - 360
+        mask = np.ones((4, 3), dtype=int)
+        mask[0, 0] = 0
+        f.createVariable('mask', 'i4', ('lat', 'lon'))[:] = mask
+    return str(tmpdir), files, domain_file
+
+
+def test_convert_image(tmpdir, image_forcings):
+    in_path, files, domain_file = image_forcings
+    out_path = str(tmpdir.mkdir('image'))
+    variables = OrderedDict([('air_temp', 'tas'), ('prec', 'pr')])
+    convert_image(files, variables, domain_file, out_path, in_path=in_path,
+                  time_chunk=3)
+
+    assert sorted(os.listdir(out_path)) == ['forcings_1999.nc',
+                                            'forcings_2000.nc']
+    air_temp, prec = [], []
+    for year in [1999, 2000]:
+        fname = os.path.join(out_path, 'forcings_{0}.nc'.format(year))
+        with Dataset(fname) as f:
+            assert f.variables['air_temp'].units == 'C'
+            assert f.variables['air_temp'].chunking() == [1, 4, 3]
+            assert np.all(f.variables['lon'][:] < 0)
+            air_temp.append(f.variables['air_temp'][:])
+            prec.append(f.variables['prec'][:])
+    # 1999-12-31 has 8 3-hourly steps
+    assert air_temp[0].shape == (8, 4, 3)
+    assert air_temp[1].shape == (8, 4, 3)
+    air_temp = np.ma.concatenate(air_temp)
+    prec = np.ma.concatenate(prec)
+
+    tas, pr = [], []
+    for fname in files:
+        with Dataset(os.path.join(in_path, fname)) as f:
+            tas.append(f.variables['tas'][:, 2:6, 5:8])
+            pr.append(f.variables['pr'][:, 2:6, 5:8])
+    tas = np.concatenate(tas)
+    pr = np.concatenate(pr)
+    assert np.all(air_temp.mask[:, 0, 0])
+    assert air_temp.mask.sum() == 16
+    np.testing.assert_allclose(air_temp[:, 1:], tas[:, 1:] - 273.15,
+                               rtol=1e-5)
+    np.testing.assert_allclose(prec[:, 1:], pr[:, 1:] * 3 * 3600, rtol=1e-5)
+
+
+def test_convert_image_single_step(tmpdir, image_forcings):
+    # the first file has a single timestep
+    in_path, files, domain_file = image_forcings
+    for fname, steps in [('first.nc', slice(0, 1)),
+                         ('rest.nc', slice(1, None))]:
+        with Dataset(os.path.join(in_path, files[0])) as src:
+            with Dataset(os.path.join(in_path, fname), 'w') as f:
+                for name, dim in src.dimensions.items():
+                    f.createDimension(name, None if name == 'time'
+                                      else len(dim))
+                for name, var in src.variables.items():
+                    new = f.createVariable(name, var.dtype, var.dimensions)
+                    new.setncatts(var.__dict__)
+                    if 'time' in var.dimensions:
+                        new[:] = var[steps]
+                    else:
+                        new[:] = var[:]
+    out_path = str(tmpdir.mkdir('image'))
+    variables = OrderedDict([('air_temp', 'tas'), ('prec', 'pr')])
+    convert_image(['first.nc', 'rest.nc', files[1]], variables, domain_file,
+                  out_path, in_path=in_path)
+
+    with Dataset(os.path.join(out_path, 'forcings_1999.nc')) as f:
+        prec = f.variables['prec'][:]
+    with Dataset(os.path.join(in_path, files[0])) as f:
+        pr = f.variables['pr'][:, 2:6, 5:8]
+    np.testing.assert_allclose(prec[:, 1:], pr[:, 1:] * 3 * 3600, rtol=1e-5)
+
+
+def test_unit_conversion():
+    assert unit_conversion('degC', 'C') == (1., 0.)
+    assert unit_conversion('Pa', 'kPa') == (1e-3, 0.)
+    assert unit_conversion('kg m-2 s-1', 'mm', timestep=3600.) == (3600., 0.)
+    with pytest.raises(ValueError):
+        unit_conversion('kg m-2 s-1', 'mm')
+    with pytest.raises(ValueError):
+        unit_conversion('m', 'kPa')
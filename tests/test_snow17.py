@@ -0,0 +1,242 @@
+"""Set to run with pytest
+
+Usage: py.test
+"""
+import pytest
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+from tonic.testing import snow17_forcings
+from tonic.models.snow17.gridded import snow17_gridded
+from tonic.models.snow17.snow17 import (snow17, snow17_multi,
+                                        snow17_ensemble, melt_factors,
+                                        melt_function)
+
+# reference results on snow17_forcings: (dt, nsteps, rvs, lat), and the sum
+# and max of swe, sum of outflow and swe at nsteps // 4
+GOLDEN = [((24, 730, 0, 45), (166194.95105164376, 710.5390083717818,
+                              2873.243563256134, 610.1380516250355)),
+          ((24, 730, 1, 45), (168257.23659114394, 700.5063410712692,
+                              2895.832407088963, 622.2598772751634)),
+          ((24, 730, 2, 45), (188886.90102596814, 737.160101142305,
+                              2818.0805331399015, 652.9845792616552)),
+          ((6, 2920, 1, 60), (563580.3356295587, 602.4583476653235,
+                              2794.2291772763, 593.9140378675002))]
+
+
+@pytest.fixture(scope="module")
+def forcings():
+    # two winters of synthetic daily forcings at 4 cells
+    time = pd.date_range('2000-10-01', periods=600, freq='D').to_pydatetime()
+    rng = np.random.RandomState(17)
+    doy = np.array([t.timetuple().tm_yday for t in time])
+    seasonal = -10 * np.cos(2 * np.pi * (doy - 15) / 365.)
+    tair = (seasonal[:, np.newaxis] + 3 * rng.randn(len(time), 4) +
+            np.array([-4, -2, 0, 2]))
+    prec = rng.gamma(0.5, 8, (len(time), 4)) * (rng.rand(len(time), 4) < 0.4)
+    return time, prec, tair
+
+
+def test_snow17_multi(forcings):
+    time, prec, tair = forcings
+    params = dict(lat=np.array([40, 50, 60, 65]),
+                  elevation=np.array([0, 1000, 2000, 3000]),
+                  mfmax=np.array([1.05, 1.2, 0.9, 1.5]),
+                  tipm=np.array([0.1, 0.2, 0.1, 0.3]),
+                  plwhc=np.array([0.04, 0.08, 0.02, 0.04]))
+    for rvs in [0, 1, 2]:
+        swe, outflow = snow17_multi(time, prec, tair, rvs=rvs, **params)
+        assert swe.shape == outflow.shape == prec.shape
+        for j in range(prec.shape[1]):
+            point = dict((k, v[j]) for k, v in params.items())
+            p_swe, p_outflow = snow17(time, prec[:, j], tair[:, j], rvs=rvs,
+                                      **point)
+            np.testing.assert_allclose(swe[:, j], p_swe, rtol=1e-10,
+                                       atol=1e-10)
+            np.testing.assert_allclose(outflow[:, j], p_outflow, rtol=1e-10,
+                                       atol=1e-10)
+        assert swe.max() > 0
+
+
+def test_snow17_multi_point(forcings):
+    time, prec, tair = forcings
+    swe, outflow = snow17_multi(time, prec[:, 0], tair[:, 0])
+    assert swe.shape == (len(time), 1)
+    with pytest.raises(ValueError):
+        snow17_multi(time, prec, tair, rvs=3)
+
+
+@pytest.mark.parametrize('lat', [40., 60.])
+def test_melt_factors(lat):
+    time = pd.date_range('2000-01-01', periods=366 * 4, freq='6H')
+    time = time.to_pydatetime()
+    mfs = melt_factors(time, 6, lat, 1.05, 0.6)
+    expected = [melt_function(t, 6, lat, 1.05, 0.6) for t in time]
+    np.testing.assert_allclose(mfs, expected, rtol=1e-12)
+
+    # by day of year, for several cells
+    table = melt_factors(np.arange(1, 367), 6, np.array([lat, 70.]),
+                         np.array([1.05, 1.5]), 0.6)
+    assert table.shape == (366, 2)
+    np.testing.assert_allclose(table[::4, 0], mfs[::16], rtol=1e-12)
+
+
+def test_snow17_backend(forcings):
+    time, prec, tair = forcings
+    with pytest.raises(ValueError):
+        snow17(time, prec[:, 0], tair[:, 0], backend='fortran')
+
+
+@pytest.mark.parametrize('rvs', [0, 1, 2])
+def test_snow17_numba(forcings, rvs):
+    pytest.importorskip('numba')
+    time, prec, tair = forcings
+    for j in range(prec.shape[1]):
+        swe, outflow = snow17(time, prec[:, j], tair[:, j], rvs=rvs,
+                              backend='python')
+        nb_swe, nb_outflow = snow17(time, prec[:, j], tair[:, j], rvs=rvs,
+                                    backend='numba')
+        np.testing.assert_allclose(nb_swe, swe, rtol=1e-14, atol=1e-12)
+        np.testing.assert_allclose(nb_outflow, outflow, rtol=1e-14,
+                                   atol=1e-12)
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_snow17_ensemble(forcings, num_workers):
+    time, prec, tair = forcings
+    prec, tair = prec[:, 0], tair[:, 0]
+    params = pd.DataFrame({'scf': [0.9, 1.0, 1.1, 1.2, 1.0],
+                           'mfmax': [1.05, 1.2, 0.9, 1.5, 1.05],
+                           'pxtemp2': [3.0, 2.0, 4.0, 3.0, 1.0]})
+    obs = snow17(time, prec, tair, lat=45, **params.iloc[1])[0]
+    obs[::7] = np.nan
+
+    swe, outflow, scores = snow17_ensemble(time, prec, tair, params,
+                                           obs_swe=obs, lat=45,
+                                           num_workers=num_workers)
+    assert swe.shape == outflow.shape == (len(time), len(params))
+    for j, member in params.iterrows():
+        expected = snow17(time, prec, tair, lat=45, **member)
+        np.testing.assert_allclose(swe[:, j], expected[0], atol=1e-10)
+        np.testing.assert_allclose(outflow[:, j], expected[1], atol=1e-10)
+    assert np.argmax(scores['nse']) == 1
+    assert scores['rmse'][1] < 1e-10
+    assert abs(scores['nse'][1] - 1.) < 1e-10
+
+
+def test_snow17_state(tmpdir, forcings):
+    time, prec, tair = forcings
+    swe, outflow = snow17(time, prec[:, 0], tair[:, 0])
+
+    # warm start from the state of the first run, saved to disk
+    first = snow17(time[:250], prec[:250, 0], tair[:250, 0],
+                   return_state=True)
+    state_file = str(tmpdir.join('state.npy'))
+    np.save(state_file, first[2])
+    assert first[2]['w_i'] > 0
+    second = snow17(time[250:], prec[250:, 0], tair[250:, 0],
+                    state=np.load(state_file))
+    np.testing.assert_allclose(np.concatenate((first[0], second[0])), swe)
+    np.testing.assert_allclose(np.concatenate((first[1], second[1])),
+                               outflow)
+
+    # many cells
+    swe, outflow = snow17_multi(time, prec, tair)
+    first = snow17_multi(time[:250], prec[:250], tair[:250],
+                         return_state=True)
+    assert first[2].shape == (prec.shape[1], )
+    second = snow17_multi(time[250:], prec[250:], tair[250:],
+                          state=first[2], return_state=True)
+    np.testing.assert_allclose(np.concatenate((first[0], second[0])), swe)
+    np.testing.assert_allclose(np.concatenate((first[1], second[1])),
+                               outflow)
+    point = snow17(time, prec[:, 2], tair[:, 2], return_state=True)[2]
+    for name in point.dtype.names:
+        np.testing.assert_allclose(second[2][name][2], point[name])
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_snow17_gridded(tmpdir, forcings, num_workers):
+    time, prec, tair = forcings
+    ny, nx = 5, 7
+    rng = np.random.RandomState(3)
+    cells = rng.randint(0, prec.shape[1], (ny, nx))
+    mask = np.ones((ny, nx), dtype=int)
+    mask[0, :3] = 0
+    elev = rng.rand(ny, nx) * 2000
+    scf = 1 + rng.rand(ny, nx) * 0.2
+
+    domain_file = str(tmpdir.join('domain.nc'))
+    with Dataset(domain_file, 'w') as f:
+        f.createDimension('lat', ny)
+        f.createDimension('lon', nx)
+        f.createVariable('lat', 'f8', ('lat', ))[:] = np.linspace(45, 57, ny)
+        f.createVariable('lon', 'f8', ('lon', ))[:] = np.arange(nx)
+        f.createVariable('mask', 'i4', ('lat', 'lon'))[:] = mask
+        f.createVariable('elev', 'f8', ('lat', 'lon'))[:] = elev
+        f.createVariable('scf', 'f8', ('lat', 'lon'))[:] = scf
+
+    files = []
+    for i, steps in enumerate([slice(0, 365), slice(365, None)]):
+        fname = str(tmpdir.join('forcing_{0}.nc'.format(i)))
+        with Dataset(fname, 'w') as f:
+            f.createDimension('time', None)
+            f.createDimension('lat', ny)
+            f.createDimension('lon', nx)
+            t = f.createVariable('time', 'f8', ('time', ))
+            t.units = 'days since 2000-10-01'
+            t[:] = np.arange(len(time))[steps]
+            f.createVariable('prec', 'f8', ('time', 'lat', 'lon'))[:] = \
+                prec[steps][:, cells]
+            f.createVariable('tair', 'f8', ('time', 'lat', 'lon'))[:] = \
+                tair[steps][:, cells]
+        files.append(fname)
+
+    out_file = str(tmpdir.join('snow17.nc'))
+    snow17_gridded(files, domain_file, out_file, param_vars={'scf': 'scf'},
+                   tile_size=3, num_workers=num_workers, mfmax=1.2)
+
+    with Dataset(out_file) as f:
+        swe = f.variables['swe'][:]
+        outflow = f.variables['outflow'][:]
+        assert f.variables['swe'].chunking() == [len(time), 3, 3]
+        assert len(f.variables['lat']) == ny
+    assert swe.shape == (len(time), ny, nx)
+    assert np.all(swe.mask[:, 0, :3])
+    lats = np.linspace(45, 57, ny)
+    for y, x in [(0, 3), (2, 2), (4, 6)]:
+        expected = snow17(time, prec[:, cells[y, x]], tair[:, cells[y, x]],
+                          lat=lats[y], elevation=elev[y, x], scf=scf[y, x],
+                          mfmax=1.2)
+        np.testing.assert_allclose(swe[:, y, x], expected[0], rtol=1e-5,
+                                   atol=1e-3)
+        np.testing.assert_allclose(outflow[:, y, x], expected[1],
+                                   rtol=1e-5, atol=1e-3)
+
+
+def _check_golden(swe, outflow, expected):
+    nsteps = len(swe)
+    np.testing.assert_allclose([swe.sum(), swe.max(), outflow.sum(),
+                                swe[nsteps // 4]], expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize('case, expected', GOLDEN)
+@pytest.mark.parametrize('backend', ['python', 'numba'])
+def test_snow17_golden(case, expected, backend):
+    if backend == 'numba':
+        pytest.importorskip('numba')
+    dt, nsteps, rvs, lat = case
+    time, prec, tair = snow17_forcings(nsteps, dt=dt)
+    swe, outflow = snow17(time, prec[:, 0], tair[:, 0], dt=dt, rvs=rvs,
+                          lat=lat, backend=backend)
+    _check_golden(swe, outflow, expected)
+
+
+@pytest.mark.parametrize('case, expected', GOLDEN)
+def test_snow17_multi_golden(case, expected):
+    dt, nsteps, rvs, lat = case
+    # the middle of 3 cells has the forcings of a single point
+    time, prec, tair = snow17_forcings(nsteps, ncells=3, dt=dt)
+    swe, outflow = snow17_multi(time, prec, tair, dt=dt, rvs=rvs, lat=lat)
+    _check_golden(swe[:, 1], outflow[:, 1], expected)
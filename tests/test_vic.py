@@ -0,0 +1,275 @@
+"""Set to run with pytest
+
+Usage: py.test
+"""
+import os
+import stat
+import time
+import tempfile
+import threading
+import pytest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from tonic.models.vic import vic as vic_module
+from tonic.models.vic.vic import (VIC, VICProgress, VICRunManager,
+                                  read_vic_ascii)
+
+# a stand in for the VIC executable: prints the global parameter file,
+# hangs if it contains STALL and fails if it contains FAIL
+FAKE_VIC = """#!/bin/sh
+case "$1" in
+    -v) echo "VIC Version : 5.0.0"; echo v >> "$0.probes";;
+    -o) echo "VIC_DRIVER classic"; echo o >> "$0.probes";;
+    -g) cat "$2"; echo "done" >&2
+        if grep -q STALL "$2"; then sleep 30; fi
+        exit `grep -c FAIL "$2"`;;
+esac
+"""
+
+
+@pytest.fixture(scope="function")
+def vic_exe(tmpdir):
+    exe = str(tmpdir.join('vic.exe'))
+    with open(exe, 'w') as f:
+        f.write(FAKE_VIC)
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IEXEC)
+    return exe
+
+
+def test_vic(tmpdir, vic_exe):
+    vic = VIC(vic_exe)
+    assert b'5.0.0' in vic.version
+    assert vic.run('STARTYEAR 1949\n') == 0
+    assert vic.stdout.strip() == b'STARTYEAR 1949'
+    assert vic.run('FAIL\n') == 1
+    assert vic.args[-2] == '-g'
+
+
+def test_vic_run_manager(tmpdir, vic_exe, monkeypatch):
+    vic = VIC(vic_exe)
+    logdir = str(tmpdir.mkdir('logs'))
+    tmp = tmpdir.mkdir('tmp')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp))
+    params = ['RUN {0}\n'.format(i) for i in range(6)] + ['FAIL\n']
+    with VICRunManager(vic, max_workers=3, logdir=logdir) as runs:
+        futures = runs.map(params)
+        runs.submit('RUN named\n', name='named')
+        with pytest.raises(ValueError):
+            runs.submit('RUN named\n', name='named')
+    assert [f.result() for f in futures] == [0] * 6 + [1]
+    assert list(runs.wait().values()) == [0] * 6 + [1, 0]
+
+    stdout, stderr = runs.log_files('run_0003')
+    with open(stdout) as f:
+        assert f.read() == 'RUN 3\n'
+    with open(stderr) as f:
+        assert f.read() == 'done\n'
+    assert os.path.isfile(os.path.join(logdir, 'stdout_named.txt'))
+    # the temporary global parameter files are removed
+    assert tmp.listdir() == []
+
+
+def test_vic_run_manager_interrupt(tmpdir, vic_exe):
+    vic = VIC(vic_exe)
+    logdir = str(tmpdir.mkdir('logs'))
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        with VICRunManager(vic, max_workers=2, logdir=logdir) as runs:
+            futures = runs.map(['STALL {0}\n'.format(i) for i in range(4)])
+            while len(runs._procs) < 2 and time.time() - start < 10:
+                time.sleep(0.05)
+            raise KeyboardInterrupt
+    assert time.time() - start < 10
+    assert [f.result() != 0 for f in futures[:2]] == [True, True]
+    assert all(f.cancelled() for f in futures[2:])
+
+
+def test_vic_run_manager_stall(tmpdir, vic_exe, monkeypatch):
+    monkeypatch.setattr(vic_module, 'POLL_INTERVAL', 0.1)
+    vic = VIC(vic_exe)
+    logdir = str(tmpdir.mkdir('logs'))
+    progress = VICProgress(stall_timeout=0.5)
+    start = time.time()
+    with VICRunManager(vic, max_workers=2, logdir=logdir) as runs:
+        stalled = runs.submit('1949-01-01\nSTALL\n', progress=progress)
+        done = runs.submit('RUN\n')
+    assert time.time() - start < 10
+    assert progress.stalled
+    assert stalled.result() != 0
+    assert done.result() == 0
+    with open(runs.log_files('run_0000')[0]) as f:
+        assert f.read() == '1949-01-01\nSTALL\n'
+
+
+def test_vic_run_streaming(tmpdir, vic_exe, monkeypatch):
+    vic = VIC(vic_exe)
+    logdir = str(tmpdir.mkdir('logs'))
+    lines = ['date {0}\n'.format(d) for d in
+             ('1949-01-01', '1949-01-02', '1949-01-31')]
+    progress = VICProgress()
+    tmp = tmpdir.mkdir('tmp')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp))
+    assert vic.run(''.join(lines), logdir=logdir, progress=progress,
+                   tail_lines=2) == 0
+    assert tmp.listdir() == []
+    assert vic.stdout == ''.join(lines[1:]).encode()
+    assert progress.first_date == datetime(1949, 1, 1)
+    assert progress.date == datetime(1949, 1, 31)
+
+    stdout = [f for f in os.listdir(logdir) if f.startswith('stdout')]
+    with open(os.path.join(logdir, stdout[0])) as f:
+        assert f.read() == ''.join(lines)
+
+
+def test_vic_progress_reuse(vic_exe):
+    vic = VIC(vic_exe)
+    progress = VICProgress(stall_timeout=60)
+    assert vic.run('1949-01-01\n1949-01-31\n', progress=progress) == 0
+    # a stale clock and stall of the previous run
+    progress.last_update -= 3600
+    progress.stalled = True
+    assert vic.run('1950-01-01\n1950-01-02\n', progress=progress) == 0
+    assert not progress.stalled
+    assert progress.first_date == datetime(1950, 1, 1)
+    assert progress.date == datetime(1950, 1, 2)
+    assert time.time() - progress.last_update < 60
+
+
+def test_vic_progress_startup():
+    progress = VICProgress(stall_timeout=1, startup_timeout=60)
+    # startup without dates is only limited by startup_timeout
+    progress.last_update -= 10
+    assert not progress.poll()
+    progress(b'1949-01-01')
+    progress.last_update -= 10
+    assert progress.poll()
+
+    progress = VICProgress(stall_timeout=1, startup_timeout=5)
+    progress.last_update -= 10
+    assert progress.poll()
+    # no limit on the startup by default
+    progress = VICProgress(stall_timeout=1)
+    progress.last_update -= 10
+    assert not progress.poll()
+
+
+def test_vic_run_stall(vic_exe, monkeypatch):
+    monkeypatch.setattr(vic_module, 'POLL_INTERVAL', 0.1)
+    vic = VIC(vic_exe)
+    progress = VICProgress(stall_timeout=0.5)
+    start = time.time()
+    returncode = vic.run('1949-01-01\nSTALL\n', progress=progress)
+    assert time.time() - start < 10
+    assert progress.stalled
+    assert returncode != 0
+
+
+def _probes(exe):
+    with open(exe + '.probes') as f:
+        return len(f.readlines())
+
+
+def test_vic_probe_cache(tmpdir, vic_exe):
+    cache_file = str(tmpdir.join('probes.json'))
+    vic = VIC(vic_exe, cache_file=cache_file)
+    assert _probes(vic_exe) == 2
+    for i in range(5):
+        assert VIC(vic_exe).options == vic.options
+    assert _probes(vic_exe) == 2
+
+    # from the disk cache
+    vic_module._probe_cache.clear()
+    assert VIC(vic_exe, cache_file=cache_file).version == vic.version
+    assert _probes(vic_exe) == 2
+
+    # probed again when the executable changes
+    st = os.stat(vic_exe)
+    os.utime(vic_exe, (st.st_atime, st.st_mtime + 10))
+    VIC(vic_exe, cache_file=cache_file)
+    assert _probes(vic_exe) == 4
+    vic_module._probe_cache.clear()
+    VIC(vic_exe, cache_file=cache_file)
+    assert _probes(vic_exe) == 4
+
+
+def test_write_probe_cache_threads(tmpdir):
+    cache_file = str(tmpdir.join('probes.json'))
+    entries = [{'vic{0}'.format(i): {'key': [i]}} for i in range(8)]
+    threads = [threading.Thread(target=vic_module._write_probe_cache,
+                                args=(cache_file, e)) for e in entries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert vic_module._read_probe_cache(cache_file) in entries
+    assert tmpdir.listdir() == [tmpdir.join('probes.json')]
+
+
+@pytest.fixture(scope="function", params=[24, 1])
+def vic_ascii(request, tmpdir):
+    dt = request.param
+    times = pd.date_range('1949-01-01', periods=50, freq='{0}H'.format(dt))
+    data = np.random.RandomState(0).rand(len(times), 3).round(4)
+    time_cols = ['YEAR', 'MONTH', 'DAY'] + (['HOUR'] if dt < 24 else [])
+    fname = str(tmpdir.join('fluxes_48.1875_-120.6875'))
+    with open(fname, 'w') as f:
+        f.write('# NRECS: {0}\n# DT: {1}\n'.format(len(times), dt))
+        f.write('# STARTDATE: 1949-01-01 00:00:00\n# ALMA_OUTPUT: 0\n')
+        f.write('# NVARS: 3\n')
+        f.write('# ' + '\t'.join(time_cols + ['OUT_PREC', 'OUT_EVAP',
+                                              'OUT_RUNOFF']) + '\n')
+        for t, row in zip(times, data):
+            fields = ['%04i' % t.year, '%02i' % t.month, '%02i' % t.day]
+            if dt < 24:
+                fields.append('%02i' % t.hour)
+            f.write('\t'.join(fields + ['%.4f' % v for v in row]) + '\n')
+    expected = pd.DataFrame(data, columns=['PREC', 'EVAP', 'RUNOFF'],
+                            index=pd.DatetimeIndex(times, name='datetime'))
+    return fname, expected
+
+
+def test_read_vic_ascii(vic_ascii):
+    fname, expected = vic_ascii
+    df = read_vic_ascii(fname)
+    assert df.index.equals(expected.index)
+    assert df.index.name == 'datetime'
+    assert df.columns.tolist() == expected.columns.tolist()
+    np.testing.assert_array_equal(df.values, expected.values)
+
+    df = read_vic_ascii(fname, usecols=['RUNOFF', 'PREC'])
+    assert df.index.equals(expected.index)
+    assert df.columns.tolist() == ['PREC', 'RUNOFF']
+    np.testing.assert_array_equal(df.values,
+                                  expected[['PREC', 'RUNOFF']].values)
+
+    index = pd.date_range('2000-01-01', periods=len(expected))
+    df = read_vic_ascii(fname, datetime_index=index, usecols=['EVAP'])
+    assert df.columns.tolist() == ['EVAP']
+    assert df.index.equals(index)
+
+    df = read_vic_ascii(fname, parse_dates=False)
+    assert df['YEAR'].dtype == np.int64
+    assert df.columns.tolist()[-3:] == ['PREC', 'EVAP', 'RUNOFF']
+
+
+def test_read_vic_ascii_no_header(vic_ascii, tmpdir):
+    fname, expected = vic_ascii
+    lines = open(fname).read().splitlines(True)
+    no_header = str(tmpdir.join('no_header'))
+    with open(no_header, 'w') as f:
+        f.writelines(lines[6:])
+    ncols = len(lines[5].split()) - 1
+
+    df = read_vic_ascii(no_header, header=False, parse_dates=False)
+    assert df.shape == (len(expected), ncols)
+    np.testing.assert_array_equal(df.values[:, -3:], expected.values)
+
+    names = lines[5].strip('#').replace('OUT_', '').split()
+    df = read_vic_ascii(no_header, header=False, names=names)
+    assert df.index.equals(expected.index)
+    np.testing.assert_array_equal(df.values, expected.values)
+
+    with pytest.raises(ValueError):
+        read_vic_ascii(no_header, header=False)
@@ -5,7 +5,8 @@ Usage: py.test
 import pytest
 
 import numpy as np
-from tonic.tonic import calc_grid
+from scipy.spatial import cKDTree
+from tonic.tonic import calc_grid, GridIndex
 
 
 @pytest.fixture(scope="function")
@@ -23,3 +24,63 @@ def test_calc_grid_standard(lons, lats):
     target_grid = calc_grid(lons, lats, decimals=4)
     assert type(target_grid) == dict
     assert target_grid['mask'].shape == shape
+
+
+def _tree_inds(plats, plons, glats, glons):
+    if glats.ndim == 1:
+        glats, glons = np.meshgrid(glats, glons, indexing='ij')
+    tree = cKDTree(np.column_stack((glats.ravel(), glons.ravel())))
+    dist, inds = tree.query(np.column_stack((plats, plons)))
+    return np.unravel_index(inds, glats.shape)
+
+
+@pytest.fixture(scope="function")
+def points():
+    rng = np.random.RandomState(42)
+    return rng.uniform(-1, 11, 500), rng.uniform(-1, 6, 500)
+
+
+def test_grid_index_regular(lons, lats, points):
+    index = GridIndex(lats, lons)
+    assert index.regular
+    assert index.tree is None
+    y, x = index.query(*points)
+    ty, tx = _tree_inds(points[0], points[1], lats, lons)
+    np.testing.assert_array_equal(y, ty)
+    np.testing.assert_array_equal(x, tx)
+
+
+def test_grid_index_irregular_axis(lons, points):
+    lats = np.sort(np.random.RandomState(0).uniform(0, 10, 20))[::-1]
+    index = GridIndex(lats, lons)
+    assert not index.regular
+    assert index.tree is None
+    y, x = index.query(*points)
+    ty, tx = _tree_inds(points[0], points[1], lats, lons)
+    np.testing.assert_array_equal(y, ty)
+    np.testing.assert_array_equal(x, tx)
+
+
+def test_grid_index_drifting_axis(lons):
+    # every step is within 0.1% of the mean step, but they add up
+    steps = np.full(400, 0.025)
+    steps[:200] *= 1.0009
+    steps[200:] *= 0.9991
+    lats = np.concatenate([[0], np.cumsum(steps)])
+    index = GridIndex(lats, lons)
+    assert not index.regular
+    points = np.linspace(0, 10, 1001), np.full(1001, 2.)
+    y, x = index.query(*points)
+    ty, tx = _tree_inds(points[0], points[1], lats, lons)
+    np.testing.assert_array_equal(y, ty)
+
+
+def test_grid_index_curvilinear(lons, lats, points):
+    glons, glats = np.meshgrid(lons, lats)
+    glons = glons + 0.1 * glats
+    index = GridIndex(glats, glons)
+    assert index.tree is not None
+    y, x = index.query(*points)
+    ty, tx = _tree_inds(points[0], points[1], glats, glons)
+    np.testing.assert_array_equal(y, ty)
+    np.testing.assert_array_equal(x, tx)
@@ -2,6 +2,7 @@
 """Input/Output functions"""
 import os
 from collections import Sequence
+import numpy as np
 from netCDF4 import Dataset
 import configobj
 from .pycompat import OrderedDict, SafeConfigParser, basestring, unicode_type
@@ -137,6 +138,184 @@ def read_netcdf(nc_file, variables=[], coords=False, verbose=True):
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+class ParamSet(object):
+    """
+    Lazy access to the variables of a gridded netCDF (parameter) file.
+
+    The file is opened once and variables are only read when requested.
+    Reads are restricted to the selected grid cells (see `select`), so only
+    the window of the grid spanning those cells is read from disk.  Gridded
+    variables must have the (y, x) dimensions of the mask variable last, or
+    a land dimension that uses CF compression by gathering.
+    """
+    def __init__(self, nc_file, mask=None, bbox=None, mask_var='mask',
+                 verbose=True):
+        self.filename = nc_file
+        self.verbose = verbose
+        self.f = Dataset(nc_file, 'r')
+
+        self.mask_var = mask_var
+        self.grid_dims = self.f.variables[mask_var].dimensions
+        self.shape = self.f.variables[mask_var].shape
+
+        # land dimension (compression by gathering)
+        self.land_var = None
+        self.land_dim = None
+        self.land = None
+        for name, var in self.f.variables.items():
+            if var.ndim == 1 and 'compress' in var.ncattrs():
+                self.land_var = name
+                self.land_dim = var.dimensions[0]
+                self.land = var[:]
+                break
+
+        self.select(mask=mask, bbox=bbox)
+
+    def select(self, mask=None, bbox=None):
+        """
+        Select the grid cells to read.  Cells are selected where mask is
+        true (default is the mask variable in the file) and, if bbox is
+        given, inside bbox=(ymin, ymax, xmin, xmax) (inclusive grid indices).
+        """
+        if mask is None:
+            mask = self.f.variables[self.mask_var][:] > 0
+        mask = np.ma.filled(mask, False).astype(bool)
+
+        if bbox is not None:
+            ymin, ymax, xmin, xmax = bbox
+            inbox = np.zeros(mask.shape, dtype=bool)
+            inbox[ymin:ymax + 1, xmin:xmax + 1] = True
+            mask &= inbox
+
+        self.yinds, self.xinds = np.nonzero(mask)
+        self.ncells = len(self.yinds)
+
+        if self.ncells:
+            self.window = (slice(self.yinds.min(), self.yinds.max() + 1),
+                           slice(self.xinds.min(), self.xinds.max() + 1))
+        else:
+            self.window = (slice(0, 0), slice(0, 0))
+
+        if self.land is not None:
+            cells = np.ravel_multi_index((self.yinds, self.xinds), self.shape)
+            pos = np.searchsorted(self.land, cells)
+            self._land_pos = np.minimum(pos, len(self.land) - 1)
+            self._on_land = self.land[self._land_pos] == cells
+
+        if self.verbose:
+            print('Selected {0} grid cells from file: {1}'.format(
+                self.ncells, self.filename))
+        return
+
+    @property
+    def window_inds(self):
+        """y and x indices of the selected cells relative to the window"""
+        return (self.yinds - self.window[0].start,
+                self.xinds - self.window[1].start)
+
+    def keys(self):
+        return self.f.variables.keys()
+
+    def __contains__(self, var):
+        return var in self.f.variables
+
+    def attrs(self, var):
+        """Return the attributes of var"""
+        return self.f.variables[var].__dict__
+
+    def _is_gathered(self, v):
+        return (self.land_dim is not None and
+                v.dimensions[-1:] == (self.land_dim, ) and
+                v.name != self.land_var)
+
+    def _is_gridded(self, v):
+        return v.dimensions[-2:] == self.grid_dims
+
+    def cell_shape(self, var):
+        """Shape of var without its grid cell dimension(s)"""
+        v = self.f.variables[var]
+        if self._is_gathered(v):
+            return v.shape[:-1]
+        elif self._is_gridded(v):
+            return v.shape[:-2]
+        raise ValueError('{0} is not a grid cell variable'.format(var))
+
+    def __getitem__(self, var):
+        """Read var at the selected cells, returns a (..., ncells) array"""
+        v = self.f.variables[var]
+
+        if self._is_gathered(v):
+            pos = self._land_pos
+            if not self.ncells:
+                return np.ma.zeros(v.shape[:-1] + (0, ), dtype=v.dtype)
+            start = pos.min()
+            data = v[..., start:pos.max() + 1]
+            data = np.ma.array(data[..., pos - start])
+            data[..., ~self._on_land] = np.ma.masked
+            return data
+        elif self._is_gridded(v):
+            if not self.ncells:
+                return np.ma.zeros(v.shape[:-2] + (0, ), dtype=v.dtype)
+            yinds, xinds = self.window_inds
+            return v[(Ellipsis, ) + self.window][..., yinds, xinds]
+        else:
+            return v[:]
+
+    def grid(self, var, window=True):
+        """
+        Read var as a dense (..., y, x) array.  Only the window spanning the
+        selected cells is read, unless window is False.
+        """
+        v = self.f.variables[var]
+
+        if self._is_gathered(v):
+            data = v[:]
+            out = np.ma.masked_all(data.shape[:-1] +
+                                   (self.shape[0] * self.shape[1], ),
+                                   dtype=data.dtype)
+            out[..., self.land] = data
+            out = out.reshape(data.shape[:-1] + tuple(self.shape))
+            if window:
+                out = out[(Ellipsis, ) + self.window]
+            return out
+        elif self._is_gridded(v) and window:
+            return v[(Ellipsis, ) + self.window]
+        else:
+            return v[:]
+
+    def read(self, variables=None, window=True):
+        """
+        Read a list of variables (default is all variables) with `grid`.
+        Returns dictionaries of data and attributes, like `read_netcdf`.
+        """
+        if variables is None:
+            variables = list(self.f.variables.keys())
+        elif isinstance(variables, basestring):
+            variables = [variables]
+
+        if self.verbose:
+            print('Reading input data variables: '
+                  ' {0} from file: {1}'.format(variables, self.filename))
+
+        d = OrderedDict()
+        a = OrderedDict()
+        for var in variables:
+            d[var] = self.grid(var, window=window)
+            a[var] = self.attrs(var)
+        return d, a
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def isfloat(x):
     '''Test if value is a float'''
@@ -0,0 +1,207 @@
+"""
+Gridded Snow-17 driver.
+
+Runs `snow17_multi` over the active cells of a domain, reading the netCDF
+forcings one spatial tile at a time and writing SWE and outflow to a
+chunked netCDF file.  Tiles can be run by a pool of processes, the full
+grid is never held in memory.
+"""
+from __future__ import print_function, division
+import time as tm
+from itertools import islice
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from netCDF4 import Dataset, date2num, num2date, default_fillvals
+from tonic.io import read_netcdf
+from tonic.pycompat import basestring
+from .snow17 import snow17_multi
+
+FILL_VALUE = default_fillvals['f4']
+COORD_VARS = ('lat', 'lon', 'yc', 'xc')
+OUT_VARS = {'swe': ('snow water equivalent', 'mm'),
+            'outflow': ('snowpack outflow', 'mm')}
+
+
+def snow17_gridded(forcing_files, domain_file, out_file, prec_var='prec',
+                   tair_var='tair', lat_var='lat', elev_var='elev',
+                   param_vars=None, dt=24, tile_size=32, num_workers=1,
+                   verbose=False, **kwargs):
+    """
+    Run Snow-17 over the active cells of a domain.
+
+    Parameters
+    ----------
+    forcing_files : str or list of str
+        netCDF forcing files (a continuous timeseries) with time and
+        (time, y, x) precipitation (mm per timestep) and air temperature
+        (deg C) variables on the domain grid.
+    domain_file : str
+        netCDF domain (or parameter) file with the mask, latitude and,
+        optionally, elevation (m) of the grid cells.
+    out_file : str
+        Output netCDF file of the simulated SWE and outflow.
+    prec_var, tair_var : str, optional
+        Names of the precipitation and air temperature variables in
+        forcing_files.  Defaults are 'prec' and 'tair'.
+    lat_var, elev_var : str, optional
+        Names of the latitude (1d or 2d) and elevation variables in
+        domain_file.  Defaults are 'lat' and 'elev'; if elev_var is None, the
+        elevation is 0.
+    param_vars : dict, optional
+        Gridded Snow-17 parameters, maps `snow17_multi` parameter names to
+        variables in domain_file.
+    dt : float, optional
+        Timestep in hours, default is 24 hours.
+    tile_size : int, optional
+        Tiles of tile_size x tile_size cells are read and run at once.
+        Default is 32.
+    num_workers : int, optional
+        Number of processes running tiles, default is 1.
+    verbose : bool, optional
+        Print progress, default is False.
+    kwargs :
+        Scalar parameters for all cells, passed on to `snow17_multi`.
+    """
+    if isinstance(forcing_files, basestring):
+        forcing_files = [forcing_files]
+    param_vars = param_vars or {}
+
+    # domain
+    names = ['mask', lat_var] + list(param_vars.values())
+    if elev_var:
+        names.append(elev_var)
+    domain, attrs = read_netcdf(domain_file, variables=names,
+                                verbose=verbose)
+    mask = np.ma.filled(domain['mask'], 0) != 0
+    lats = np.asarray(domain[lat_var], dtype=np.float64)
+    if lats.ndim == 1:
+        lats = np.broadcast_to(lats[:, np.newaxis], mask.shape)
+
+    # time
+    times = []
+    for fname in forcing_files:
+        with Dataset(fname, 'r') as f:
+            time = f.variables['time']
+            if not times:
+                time_units = time.units
+                calendar = getattr(time, 'calendar', 'standard')
+            times.append(num2date(time[:], time.units, calendar=calendar))
+    times = np.concatenate(times)
+    jdays = np.array([t.timetuple().tm_yday for t in times])
+
+    tiles = []
+    for y0 in range(0, mask.shape[0], tile_size):
+        for x0 in range(0, mask.shape[1], tile_size):
+            window = (slice(y0, y0 + tile_size), slice(x0, x0 + tile_size))
+            cells = np.nonzero(mask[window])
+            if len(cells[0]) == 0:
+                continue
+            params = dict(kwargs)
+            params['lat'] = lats[window][cells]
+            if elev_var:
+                params['elevation'] = np.ma.filled(
+                    domain[elev_var][window], 0)[cells]
+            for name, var in param_vars.items():
+                params[name] = np.asarray(domain[var][window])[cells]
+            tiles.append((window, cells, params))
+    print('running Snow-17 for {0} cells in {1} tiles'.format(mask.sum(),
+                                                              len(tiles)))
+
+    out = _create_output(out_file, domain_file, times, time_units, calendar,
+                         mask.shape, tile_size)
+    args = (forcing_files, prec_var, tair_var, jdays, dt)
+    try:
+        if num_workers > 1:
+            # at most 2 x num_workers tiles are in flight, each tile is
+            # written as it completes and the next one submitted
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                pending = iter(tiles)
+                futures = {}
+                for window, cells, params in islice(pending,
+                                                    2 * num_workers):
+                    futures[pool.submit(_run_tile, window, cells, params,
+                                        *args)] = (window, cells)
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        window, cells = futures.pop(future)
+                        _write_tile(out, window, cells, future.result())
+                        if verbose:
+                            print('finished tile {0}'.format(window))
+                    for window, cells, params in islice(pending, len(done)):
+                        futures[pool.submit(_run_tile, window, cells, params,
+                                            *args)] = (window, cells)
+        else:
+            for window, cells, params in tiles:
+                _write_tile(out, window, cells,
+                            _run_tile(window, cells, params, *args))
+                if verbose:
+                    print('finished tile {0}'.format(window))
+    finally:
+        out.close()
+    return
+
+
+def _run_tile(window, cells, params, forcing_files, prec_var, tair_var,
+              jdays, dt):
+    """Read the forcings of one tile and run its cells"""
+    prec = []
+    tair = []
+    coords = (slice(None), ) + window
+    for fname in forcing_files:
+        d, a = read_netcdf(fname, variables=[prec_var, tair_var],
+                           coords=coords, verbose=False)
+        prec.append(np.ma.filled(d[prec_var], np.nan)[(slice(None), ) +
+                                                      cells])
+        tair.append(np.ma.filled(d[tair_var], np.nan)[(slice(None), ) +
+                                                      cells])
+    return snow17_multi(jdays, np.concatenate(prec), np.concatenate(tair),
+                        dt=dt, **params)
+
+
+def _write_tile(out, window, cells, results):
+    """Write the results of one tile to the open output file"""
+    for name, data in zip(('swe', 'outflow'), results):
+        var = out.variables[name]
+        ny = len(range(*window[0].indices(var.shape[1])))
+        nx = len(range(*window[1].indices(var.shape[2])))
+        block = np.full((len(data), ny, nx), FILL_VALUE, dtype=np.float32)
+        block[(slice(None), ) + cells] = data
+        var[(slice(None), ) + window] = block
+
+
+def _create_output(out_file, domain_file, times, time_units, calendar,
+                   shape, tile_size):
+    """Create the output file, chunked by (time, tile)"""
+    out = Dataset(out_file, 'w', format='NETCDF4')
+    out.history = 'Created: {0} by snow17_gridded'.format(
+        tm.ctime(tm.time()))
+
+    with Dataset(domain_file, 'r') as f:
+        dims = f.variables['mask'].dimensions
+        out.createDimension('time', len(times))
+        for dim, size in zip(dims, shape):
+            out.createDimension(dim, size)
+        # copy the coordinates of the domain
+        for name in COORD_VARS:
+            if name in f.variables:
+                var = f.variables[name]
+                new = out.createVariable(name, var.dtype, var.dimensions)
+                new.setncatts(dict((k, v) for k, v in var.__dict__.items()
+                                   if k != '_FillValue'))
+                new[:] = var[:]
+
+    time = out.createVariable('time', 'f8', ('time', ))
+    time.units = time_units
+    time.calendar = calendar
+    time[:] = date2num(list(times), time_units, calendar=calendar)
+
+    chunks = (min(len(times), 1000), min(tile_size, shape[0]),
+              min(tile_size, shape[1]))
+    for name, (long_name, units) in OUT_VARS.items():
+        var = out.createVariable(name, 'f4', ('time', ) + dims,
+                                 fill_value=FILL_VALUE, zlib=True,
+                                 chunksizes=chunks)
+        var.long_name = long_name
+        var.units = units
+    return out
@@ -17,12 +17,28 @@ Primary Citations:
 Written by Joe Hamman April, 2013
 """
 from __future__ import print_function, division
+import math
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
+
+BACKENDS = ('auto', 'python', 'numba')
+# model state: antecedent temperature index (deg C), liquid water capacity
+# (mm), liquid water held by the snow (mm), water equivalent of the ice
+# portion of the snow cover (mm) and heat deficit (mm)
+STATE_VARS = ('ait', 'w_qx', 'w_q', 'w_i', 'deficit')
+STATE_DTYPE = np.dtype([(name, np.float64) for name in STATE_VARS])
+# the numba compiled time loop, compiled on first use
+_numba_loop = None
 
 
 def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
            uadj=0.04, mbase=1.0, mfmax=1.05, mfmin=0.6, tipm=0.1, nmf=0.15,
-           plwhc=0.04, pxtemp=1.0, pxtemp1=-1.0, pxtemp2=3.0):
+           plwhc=0.04, pxtemp=1.0, pxtemp1=-1.0, pxtemp2=3.0,
+           backend='auto', state=None, return_state=False):
     """
     Snow-17 accumulation and ablation model. This version of Snow-17 is
     intended for use at a point location.
@@ -88,6 +104,15 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
         Upper Limit Temperature dividing rain from transition, deg C - if temp
         is greater than or equal to pxtemp2, all precip is rain.  Otherwise it
         is mixed linearly. Default is 3.0.
+    backend : {'auto', 'python', 'numba'}, optional
+        Backend of the time loop.  'numba' compiles it with numba, 'python'
+        runs it in the interpreter.  Default of 'auto' uses numba if it is
+        installed.
+    state : numpy record or dict, optional
+        Initial model state (see `STATE_DTYPE`), e.g. the final state of a
+        previous run over the preceding timesteps.  Default is no snow.
+    return_state : bool, optional
+        Also return the final model state, default is False.
 
     Returns
     ----------
@@ -95,6 +120,8 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
         Simulated snow water equivalent.
     outflow : numpy.ndarray
         Simulated runoff outflow.
+    state : numpy record
+        Final model state (STATE_DTYPE), only if `return_state`.
     """
 
     # Convert to numpy array if scalars
@@ -103,38 +130,71 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
     tair = np.asarray(tair)
     assert time.shape == prec.shape == tair.shape
 
+    if rvs not in (0, 1, 2):
+        raise ValueError('Invalid rain vs snow option')
+    kernel = _kernel(backend)
+
     # Initialization
-    # Antecedent Temperature Index, deg C
-    ait = 0.0
-    # Liquid water capacity
-    w_qx = 0.0
-    # Liquid water held by the snow (mm)
-    w_q = 0.0
-    # accumulated water equivalent of the iceportion of the snow cover (mm)
-    w_i = 0.0
-    # Heat deficit, also known as NEGHS, Negative Heat Storage
-    deficit = 0.0
+    # ait : Antecedent Temperature Index, deg C
+    # w_qx : Liquid water capacity
+    # w_q : Liquid water held by the snow (mm)
+    # w_i : accumulated water equivalent of the iceportion of the snow cover
+    #     (mm)
+    # deficit : Heat deficit, also known as NEGHS, Negative Heat Storage
+    if state is None:
+        state = np.zeros(len(STATE_VARS))
+    else:
+        state = np.array([state[name] for name in STATE_VARS],
+                         dtype=np.float64)
 
     # number of time steps
     nsteps = len(time)
     model_swe = np.zeros(nsteps)
     outflow = np.zeros(nsteps)
 
-    # Stefan-Boltzman constant (mm/K/hr)
-    stefan = 6.12 * (10 ** (-10))
     # atmospheric pressure (mb) where elevation is in HUNDREDS of meters
     # (this is incorrectly stated in the manual)
     p_atm = 33.86 * (29.9 - (0.335 * elevation / 100) +
                      (0.00022 * ((elevation / 100) ** 2.4)))
 
-    transitionx = [pxtemp1, pxtemp2]
-    transitiony = [1.0, 0.0]
+    # seasonal melt factors for all timesteps
+    mfs = melt_factors(time, dt, lat, mfmax, mfmin)
+
+    # Model Execution
+    kernel(mfs.astype(np.float64), prec.astype(np.float64),
+           tair.astype(np.float64), state, model_swe, outflow, float(dt),
+           float(scf), int(rvs), float(uadj), float(mbase), float(mfmax),
+           float(tipm), float(nmf), float(plwhc), float(pxtemp),
+           float(pxtemp1), float(pxtemp2), float(p_atm))
+
+    if return_state:
+        return model_swe, outflow, np.array(tuple(state), dtype=STATE_DTYPE)
+    return model_swe, outflow
+
 
+def _snow17_loop(mfs, prec, tair, state, model_swe, outflow, dt, scf, rvs,
+                 uadj, mbase, mfmax, tipm, nmf, plwhc, pxtemp, pxtemp1,
+                 pxtemp2, p_atm):
+    """
+    Snow-17 time loop for a point, on plain float arrays (mfs are the melt
+    factors of each timestep) so that it can be compiled by numba.  The
+    state array (ait, w_qx, w_q, w_i, deficit) is updated in place and the
+    results are written to model_swe and outflow.
+    """
+    ait = state[0]
+    w_qx = state[1]
+    w_q = state[2]
+    w_i = state[3]
+    deficit = state[4]
+
+    # Stefan-Boltzman constant (mm/K/hr)
+    stefan = 6.12 * (10.0 ** (-10))
+    # slope of the linear rain/snow transition (rvs=1)
+    transition = (0.0 - 1.0) / (pxtemp2 - pxtemp1)
     tipm_dt = 1.0 - ((1.0 - tipm) ** (dt / 6))
 
-    # Model Execution
-    for i, t in enumerate(time):
-        mf = melt_function(t, dt, lat, mfmax, mfmin)
+    for i in range(len(prec)):
+        mf = mfs[i]
 
         # air temperature at this time step (deg C)
         t_air_mean = tair[i]
@@ -155,11 +215,9 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
             elif t_air_mean >= pxtemp2:
                 fracsnow = 0.0
             else:
-                fracsnow = np.interp(t_air_mean, transitionx, transitiony)
-        elif rvs == 2:
-            fracsnow = 1.0
+                fracsnow = transition * (t_air_mean - pxtemp1) + 1.0
         else:
-            raise ValueError('Invalid rain vs snow option')
+            fracsnow = 1.0
 
         fracrain = 1.0 - fracsnow
 
@@ -191,7 +249,7 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
             # Antecedent temperature index
             ait = ait + tipm_dt * (t_air_mean - ait)
         if ait > 0:
-            ait = 0
+            ait = 0.0
 
         # Heat Exchange when no Surface melt
         # delta_hd_t = change in heat deficit due to a temperature gradient(mm)
@@ -199,19 +257,19 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
 
         # Rain-on-snow melt
         # saturated vapor pressure at t_air_mean (mb)
-        e_sat = 2.7489 * (10 ** 8) * np.exp(
+        e_sat = 2.7489 * (10 ** 8) * math.exp(
             (-4278.63 / (t_air_mean + 242.792)))
         # 1.5 mm/ 6 hrs
         if rain > (0.25 * dt):
             # melt (mm) during rain-on-snow periods is:
-            m_ros1 = np.maximum(
+            m_ros1 = max(
                 stefan * dt * (((t_air_mean + 273) ** 4) - (273 ** 4)), 0.0)
-            m_ros2 = np.maximum((0.0125 * rain * t_rain), 0.0)
-            m_ros3 = np.maximum((8.5 * uadj *
-                                (dt / 6.0) *
-                                (((0.9 * e_sat) - 6.11) +
-                                 (0.00057 * p_atm * t_air_mean))),
-                                0.0)
+            m_ros2 = max((0.0125 * rain * t_rain), 0.0)
+            m_ros3 = max((8.5 * uadj *
+                          (dt / 6.0) *
+                          (((0.9 * e_sat) - 6.11) +
+                           (0.00057 * p_atm * t_air_mean))),
+                         0.0)
             m_ros = m_ros1 + m_ros2 + m_ros3
         else:
             m_ros = 0.0
@@ -260,7 +318,7 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
                 w_i = w_i + deficit
                 deficit = 0.0
             elif ((qw >= deficit) and
-                  ait((qw + w_q) <= ((deficit * (1 + plwhc)) + w_qx))):
+                  ((qw + w_q) <= ((deficit * (1 + plwhc)) + w_qx))):
                 # THEN the snow is NOT yet ripe, but ice is being melted
                 e = 0.0
                 w_q = w_q + qw - deficit
@@ -279,18 +337,364 @@ def snow17(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0, rvs=1,
             swe = w_i + w_q
         else:
             e = qw
-            swe = 0
+            swe = 0.0
 
         if deficit == 0:
-            ait = 0
+            ait = 0.0
 
         # End of model execution
         model_swe[i] = swe  # total swe (mm) at this time step
         outflow[i] = e
 
+    state[0] = ait
+    state[1] = w_qx
+    state[2] = w_q
+    state[3] = w_i
+    state[4] = deficit
+
+
+def _kernel(backend):
+    """Return the Snow-17 time loop of a backend"""
+    global _numba_loop
+    if backend not in BACKENDS:
+        raise ValueError('Invalid backend: {0}, must be one of '
+                         '{1}'.format(backend, BACKENDS))
+    if backend == 'python' or (backend == 'auto' and njit is None):
+        return _snow17_loop
+    if njit is None:
+        raise ValueError('the numba backend requires numba')
+    if _numba_loop is None:
+        _numba_loop = njit(nogil=True)(_snow17_loop)
+    return _numba_loop
+
+
+def snow17_multi(time, prec, tair, lat=50, elevation=0, dt=24, scf=1.0,
+                 rvs=1, uadj=0.04, mbase=1.0, mfmax=1.05, mfmin=0.6, tipm=0.1,
+                 nmf=0.15, plwhc=0.04, pxtemp=1.0, pxtemp1=-1.0,
+                 pxtemp2=3.0, state=None, return_state=False):
+    """
+    Snow-17 accumulation and ablation model for many grid cells (or
+    parameter sets) at once.  All cells are advanced together at each
+    timestep.
+
+    Parameters
+    ----------
+    time : 1d numpy.ndarray
+        Array of datetime objects (or of integer days of year).
+    prec : 2d numpy.ndarray
+        Array of precipitation forcings, shape (time, ncells).
+    tair : 2d numpy.ndarray
+        Array of air temperature forcings, shape (time, ncells).
+    lat, elevation, scf, uadj, mbase, mfmax, mfmin, tipm, nmf, plwhc, pxtemp,
+    pxtemp1, pxtemp2 : float or 1d numpy.ndarray, optional
+        Per cell parameters (size ncells) or a scalar for all cells, see
+        `snow17`.
+    dt : float, optional
+        Timestep in hours, default is 24 hours.
+    rvs : {0, 1, 2}, optional
+        Rain vs. Snow option, for all cells, see `snow17`.
+    state : numpy record array, optional
+        Initial model state of each cell (see `STATE_DTYPE`), size ncells.
+        Default is no snow.
+    return_state : bool, optional
+        Also return the final model state, default is False.
+
+    Returns
+    ----------
+    model_swe : numpy.ndarray
+        Simulated snow water equivalent, shape (time, ncells).
+    outflow : numpy.ndarray
+        Simulated runoff outflow, shape (time, ncells).
+    state : numpy record array
+        Final model state of each cell (STATE_DTYPE), only if
+        `return_state`.
+    """
+    time = np.asarray(time)
+    prec = np.asarray(prec, dtype=np.float64)
+    tair = np.asarray(tair, dtype=np.float64)
+    if prec.ndim == 1:
+        prec = prec[:, np.newaxis]
+        tair = tair[:, np.newaxis]
+    assert prec.shape == tair.shape
+    assert time.shape == prec.shape[:1]
+    if rvs not in (0, 1, 2):
+        raise ValueError('Invalid rain vs snow option')
+
+    nsteps, ncells = prec.shape
+    (lat, elevation, scf, uadj, mbase, mfmax, mfmin, tipm, nmf, plwhc, pxtemp,
+     pxtemp1, pxtemp2) = [np.broadcast_to(np.asarray(p, dtype=np.float64),
+                                          (ncells, ))
+                          for p in (lat, elevation, scf, uadj, mbase, mfmax,
+                                    mfmin, tipm, nmf, plwhc, pxtemp, pxtemp1,
+                                    pxtemp2)]
+
+    # Initialization, see snow17
+    if state is None:
+        state = np.zeros(ncells, dtype=STATE_DTYPE)
+    ait, w_qx, w_q, w_i, deficit = [
+        np.broadcast_to(np.asarray(state[name], dtype=np.float64),
+                        (ncells, )).copy() for name in STATE_VARS]
+
+    model_swe = np.zeros((nsteps, ncells))
+    outflow = np.zeros((nsteps, ncells))
+
+    stefan = 6.12 * (10 ** (-10))
+    p_atm = 33.86 * (29.9 - (0.335 * elevation / 100) +
+                     (0.00022 * ((elevation / 100) ** 2.4)))
+    tipm_dt = 1.0 - ((1.0 - tipm) ** (dt / 6))
+    # slope of the linear rain/snow transition (rvs=1)
+    transition = -1.0 / (pxtemp2 - pxtemp1)
+
+    # lookup table of the seasonal melt factors by day of year
+    mf_table = melt_factors(np.arange(1, 367), dt, lat, mfmax, mfmin)
+    jdays = day_of_year(time)
+
+    for i in range(nsteps):
+        mf = mf_table[jdays[i] - 1]
+        t_air_mean = tair[i]
+        precip = prec[i]
+
+        # Divide rain and snow
+        if rvs == 0:
+            fracsnow = np.where(t_air_mean <= pxtemp, 1.0, 0.0)
+        elif rvs == 1:
+            fracsnow = np.where(
+                t_air_mean <= pxtemp1, 1.0,
+                np.where(t_air_mean >= pxtemp2, 0.0,
+                         transition * (t_air_mean - pxtemp1) + 1.0))
+        else:
+            fracsnow = np.ones(ncells)
+        fracrain = 1.0 - fracsnow
+
+        # Snow Accumulation
+        pn = precip * fracsnow * scf
+        w_i = w_i + pn
+        rain = fracrain * precip
+
+        # Temperature and Heat deficit from new Snow
+        cold = t_air_mean < 0.0
+        t_snow_new = np.where(cold, t_air_mean, 0.0)
+        delta_hd_snow = np.where(cold, - (t_snow_new * pn) / (80 / 0.5), 0.0)
+        t_rain = np.where(cold, pxtemp, t_air_mean)
+
+        # Antecedent temperature Index
+        ait = np.where(pn > (1.5 * dt), t_snow_new,
+                       ait + tipm_dt * (t_air_mean - ait))
+        ait = np.minimum(ait, 0.0)
+
+        # Heat Exchange when no Surface melt
+        delta_hd_t = nmf * (dt / 6.0) * ((mf) / mfmax) * (ait - t_snow_new)
+
+        # Rain-on-snow melt
+        e_sat = 2.7489 * (10 ** 8) * np.exp(
+            (-4278.63 / (t_air_mean + 242.792)))
+        ros = rain > (0.25 * dt)
+        m_ros1 = np.maximum(
+            stefan * dt * (((t_air_mean + 273) ** 4) - (273 ** 4)), 0.0)
+        m_ros2 = np.maximum((0.0125 * rain * t_rain), 0.0)
+        m_ros3 = np.maximum((8.5 * uadj *
+                            (dt / 6.0) *
+                            (((0.9 * e_sat) - 6.11) +
+                             (0.00057 * p_atm * t_air_mean))),
+                            0.0)
+        m_ros = np.where(ros, m_ros1 + m_ros2 + m_ros3, 0.0)
+
+        # Non-Rain melt
+        m_nr = np.where(~ros & (t_air_mean > mbase),
+                        (mf * (t_air_mean - mbase)) + (0.0125 * rain * t_rain),
+                        0.0)
+
+        # Ripeness of the snow cover
+        melt = np.maximum(m_ros + m_nr, 0.0)
+        partial = melt < w_i
+        melt = np.where(partial, melt, w_i + w_q)
+        w_i = np.where(partial, w_i - melt, 0.0)
+
+        qw = melt + rain
+        w_qx = plwhc * w_i
+        deficit = np.minimum(np.maximum(deficit + delta_hd_snow + delta_hd_t,
+                                        0.0), 0.33 * w_i)
+
+        # Snow cover is ripe when both (deficit=0) & (w_q = w_qx)
+        snow = w_i > 0.0
+        capacity = (deficit * (1 + plwhc)) + w_qx
+        ripe = snow & ((qw + w_q) > capacity)
+        melting = snow & ~ripe & (qw >= deficit)
+        frozen = snow & ~ripe & ~melting
+
+        e = np.where(snow, np.where(ripe, qw + w_q - w_qx -
+                                    (deficit * (1 + plwhc)), 0.0), qw)
+        w_q = np.where(ripe, w_qx, np.where(melting, w_q + qw - deficit, w_q))
+        w_i = np.where(ripe | melting, w_i + deficit,
+                       np.where(frozen, w_i + qw, w_i))
+        deficit = np.where(ripe | melting, 0.0,
+                           np.where(frozen, deficit - qw, deficit))
+
+        ait = np.where(deficit == 0, 0.0, ait)
+
+        model_swe[i] = np.where(snow, w_i + w_q, 0.0)
+        outflow[i] = e
+
+    if return_state:
+        state = np.zeros(ncells, dtype=STATE_DTYPE)
+        for name, value in zip(STATE_VARS, (ait, w_qx, w_q, w_i, deficit)):
+            state[name] = value
+        return model_swe, outflow, state
     return model_swe, outflow
 
 
+def snow17_ensemble(time, prec, tair, params, obs_swe=None, num_workers=1,
+                    **kwargs):
+    """
+    Run an ensemble of Snow-17 parameter sets on one forcing series, e.g.
+    for calibration.  The members are run together with `snow17_multi`,
+    split across a pool of num_workers processes if num_workers > 1.
+
+    Parameters
+    ----------
+    time : 1d numpy.ndarray
+        Array of datetime objects.
+    prec : 1d numpy.ndarray
+        Array of precipitation forcings, size of `time`.
+    tair : 1d numpy.ndarray
+        Array of air temperature forcings, size of `time`.
+    params : pandas.DataFrame or dict
+        Table of parameter sets, one column (or key) per `snow17_multi`
+        parameter (e.g. scf, mfmax, mfmin, uadj, tipm, nmf, plwhc, pxtemp1,
+        pxtemp2) and one row (or value) per member.
+    obs_swe : 1d numpy.ndarray, optional
+        Observed snow water equivalent, size of `time`.  NaNs are ignored.
+    num_workers : int, optional
+        Number of processes, default is 1.
+    kwargs :
+        Parameters shared by all members, passed on to `snow17_multi`.
+
+    Returns
+    ----------
+    model_swe : numpy.ndarray
+        Simulated snow water equivalent, shape (time, nmembers).
+    outflow : numpy.ndarray
+        Simulated runoff outflow, shape (time, nmembers).
+    scores : dict or None
+        Objective scores of each member against obs_swe (see `swe_scores`),
+        None if obs_swe is not given.
+    """
+    time = np.asarray(time)
+    prec = np.asarray(prec, dtype=np.float64)
+    tair = np.asarray(tair, dtype=np.float64)
+    assert time.shape == prec.shape == tair.shape
+
+    params = dict((k, np.asarray(v, dtype=np.float64))
+                  for k, v in params.items())
+    nmembers = len(next(iter(params.values())))
+    shape = (len(time), nmembers)
+
+    if num_workers > 1 and nmembers > 1:
+        parts = np.array_split(np.arange(nmembers),
+                               min(num_workers, nmembers))
+        model_swe = np.zeros(shape)
+        outflow = np.zeros(shape)
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(snow17_multi, time,
+                                   _members(prec, len(part)),
+                                   _members(tair, len(part)),
+                                   **_subset(params, part, kwargs))
+                       for part in parts]
+            for part, future in zip(parts, futures):
+                model_swe[:, part], outflow[:, part] = future.result()
+    else:
+        model_swe, outflow = snow17_multi(time, _members(prec, nmembers),
+                                          _members(tair, nmembers),
+                                          **_subset(params, slice(None),
+                                                    kwargs))
+
+    if obs_swe is None:
+        scores = None
+    else:
+        scores = swe_scores(model_swe, obs_swe)
+    return model_swe, outflow, scores
+
+
+def _members(forcing, nmembers):
+    """View of a forcing series repeated for nmembers"""
+    return np.broadcast_to(forcing[:, np.newaxis], (len(forcing), nmembers))
+
+
+def _subset(params, members, kwargs):
+    """Keyword arguments of snow17_multi for a subset of members"""
+    subset = dict(kwargs)
+    for k, v in params.items():
+        subset[k] = v[members]
+    return subset
+
+
+def swe_scores(model_swe, obs_swe):
+    """
+    Objective scores of simulated (time, nmembers) against observed (time)
+    snow water equivalent, ignoring missing (NaN) observations.
+
+    Returns
+    ----------
+    scores : dict
+        Arrays (size nmembers) of the root mean square error (rmse), mean
+        bias (bias) and Nash-Sutcliffe efficiency (nse).
+    """
+    obs_swe = np.asarray(obs_swe, dtype=np.float64)
+    valid = np.isfinite(obs_swe)
+    obs = obs_swe[valid]
+    error = model_swe[valid] - obs[:, np.newaxis]
+    sse = (error ** 2).sum(axis=0)
+    return {'rmse': np.sqrt(sse / len(obs)),
+            'bias': error.mean(axis=0),
+            'nse': 1.0 - sse / ((obs - obs.mean()) ** 2).sum()}
+
+
+def day_of_year(time):
+    """
+    Day of year (1-366) of an array of datetime objects (integer arrays are
+    taken to be days of year already)
+    """
+    time = np.asarray(time)
+    if np.issubdtype(time.dtype, np.integer):
+        return time
+    days = time.astype('datetime64[D]')
+    return (days - days.astype('datetime64[Y]')).astype(int) + 1
+
+
+def melt_factors(time, dt, lat, mfmax, mfmin):
+    """
+    Seasonal melt factors (see `melt_function`) for all timesteps at once.
+
+    Parameters
+    ----------
+    time : 1d numpy.ndarray
+        Array of datetime objects or of integer days of year.
+    dt : float
+        Timestep in hours.
+    lat, mfmax, mfmin : float or numpy.ndarray
+        Latitude and melt factor parameters, see `melt_function`.
+
+    Returns
+    ----------
+    meltf : numpy.ndarray
+        Melt function, shape (time, ) + the broadcast shape of lat, mfmax
+        and mfmin.
+    """
+    jday = day_of_year(time)
+    shape = np.broadcast(lat, mfmax, mfmin).shape
+    jday = jday.reshape(jday.shape + (1, ) * len(shape))
+    n_mar21 = jday - 80
+    days = 365
+
+    # seasonal variation
+    sv = (0.5 * np.sin((n_mar21 * 2 * np.pi) / days)) + 0.5
+    # av = 0.0 from September 24 to March 18, 1.0 from April 27 to August
+    # 15 and linear in between, av=1.0 when lat < 54 deg N
+    av = np.interp(jday, [78, 116, 228, 266], [0, 1, 1, 0])
+    av = np.where(np.asarray(lat) < 54, 1.0, av)
+    return (dt / 6) * ((sv * av * (mfmax - mfmin)) + mfmin)
+
+
 def melt_function(t, dt, lat, mfmax, mfmin):
     """
     Seasonal variation calcs - indexed for Non-Rain melt
@@ -1 +1,2 @@
-from .vic import VIC, VICRuntimeError, read_vic_ascii
+from .vic import (VIC, VICProgress, VICRunManager, VICRuntimeError,
+                  read_vic_ascii)
@@ -12,7 +12,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
-from tonic.io import read_netcdf
+from tonic.io import ParamSet
 from tonic.plot_utils import sub_plot_pcolor, cmap_discretize
 from tonic.pycompat import pyrange
 
@@ -39,9 +39,11 @@ def _run(args, ):
     plot_atts_3 = None
     plot_atts_9 = None
 
-    dom, dom_atts = read_netcdf(args.domain_file)
-    d1, d1a = read_netcdf(args.soil_file1)
-    d2, d2a = read_netcdf(args.soil_file2)
+    dom, dom_atts = ParamSet(args.domain_file).read(['xc', 'yc', 'mask'],
+                                                    window=False)
+    # soil parameters are read one variable at a time
+    d1 = ParamSet(args.soil_file1)
+    d2 = ParamSet(args.soil_file2)
     out_path = args.out_path
     title1 = args.title1
     title2 = args.title2
@@ -149,14 +151,14 @@ def _run(args, ):
     for var in plot_atts_3.keys():
         print('making plot3 for {}'.format(var))
         try:
-            units = d1a[var]['units']
+            units = d1.attrs(var)['units']
         except:
             units = ''
         try:
             f = my_plot3(dom['xc'],
                          dom['yc'],
-                         d1[var],
-                         d2[var],
+                         d1.grid(var, window=False),
+                         d2.grid(var, window=False),
                          units=units,
                          mask=(dom['mask'] == 0),
                          t1=title1,
@@ -165,7 +167,7 @@ def _run(args, ):
 
             plt.figtext(.5, 0.94, var, fontsize=18, ha='center')
 
-            plt.figtext(.5, 0.90, d1a[var]['description'], fontsize=12,
+            plt.figtext(.5, 0.90, d1.attrs(var)['description'], fontsize=12,
                         ha='center')
 
             fname = os.path.join(out_path,
@@ -180,13 +182,13 @@ def _run(args, ):
     for var in plot_atts_9.keys():
         print('making plot9 for {}'.format(var))
         try:
-            units = d1a[var]['units']
+            units = d1.attrs(var)['units']
         except:
             units = ''
         f = my_plot9(dom['xc'],
                      dom['yc'],
-                     d1[var],
-                     d2[var],
+                     d1.grid(var, window=False),
+                     d2.grid(var, window=False),
                      units=units,
                      mask=(dom['mask'] == 0),
                      t1=title1,
@@ -194,7 +196,7 @@ def _run(args, ):
                      **plot_atts_9[var])
 
         plt.figtext(.5, 1.06, var, fontsize=18, ha='center')
-        plt.figtext(.5, 1.02, d1a[var]['description'], fontsize=12,
+        plt.figtext(.5, 1.02, d1.attrs(var)['description'], fontsize=12,
                     ha='center')
 
         fname = os.path.join(out_path,
@@ -203,6 +205,9 @@ def _run(args, ):
                   pad_inches=0)
         print('finished {}'.format(fname))
 
+    d1.close()
+    d2.close()
+
     return
 
 
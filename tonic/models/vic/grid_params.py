@@ -6,18 +6,23 @@ A toolkit for converting classic vic parameters to netcdf format
 """
 
 from __future__ import print_function
+import os
 import sys
+import json
+import pickle
+import hashlib
 import numpy as np
 from netCDF4 import Dataset, default_fillvals
-from scipy.spatial import cKDTree
 from scipy import stats
 import time as tm
 import socket
 from getpass import getuser
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from warnings import warn
 from tonic.io import read_netcdf
-from tonic.pycompat import pyrange, pyzip
+from tonic.tonic import GridIndex
+from tonic.pycompat import pyrange
 import re
 
 
@@ -635,7 +640,10 @@ def _run(args):
                         lai_src=args.lai_src,
                         fcan_src=args.fcan_src,
                         alb_src=args.alb_src,
-                        lake_profile=args.lake_profile)
+                        lake_profile=args.lake_profile,
+                        compress=args.compress,
+                        cache_dir=args.cache_dir,
+                        num_workers=args.num_workers)
 
     print('completed grid_params.main(), output file was: {0}'.format(nc_file))
 # -------------------------------------------------------------------- #
@@ -652,7 +660,9 @@ def make_grid(grid_file, soil_file, snow_file, vegl_file, veg_file,
               blowing_snow=False, vegparam_lai=False,
               vegparam_fcan=False, vegparam_albedo=False,
               lai_src='FROM_VEGLIB', fcan_src='FROM_DEFAULT',
-              alb_src='FROM_VEGLIB', lake_profile=False):
+              alb_src='FROM_VEGLIB', lake_profile=False, compress=False,
+              zlib=False, complevel=4, chunks=None, num_workers=1,
+              cache_dir=None):
     """
     Make grid uses routines from params.py to read standard vic format
     parameter files.  After the parameter files are read, the files are placed
@@ -660,79 +670,261 @@ def make_grid(grid_file, soil_file, snow_file, vegl_file, veg_file,
     present in the target grid it will be used to exclude areas in the ocean.
     Finally, if the nc_file = 'any_string.nc', a netcdf file be written with
     the parameter data, if nc_file = False, the dictionary of grids is
-    returned.
+    returned.  If compress is True, only the land cells of the mask are
+    stored, both in the dictionary of grids and in the netcdf file.
+    zlib, complevel, chunks and num_workers are passed to write_netcdf.
+    If cache_dir is given, the parsed input dictionaries and the gridded
+    sub-dictionaries are cached there by the content hash of their input
+    files and options.  On a rerun, only the inputs that changed are parsed
+    and gridded again and the variables of an existing nc_file are updated
+    in place.
     """
     print('making gridded parameters now...')
 
-    soil_dict = soil(soil_file, c=Cols(nlayers=nlayers,
-                     organic_fract=organic_fract,
-                     spatial_frost=spatial_frost,
-                     spatial_snow=spatial_snow,
-                     july_tavg_supplied=july_tavg_supplied))
+    names = ('soil_dict', 'snow_dict', 'veg_dict', 'lake_dict')
+
+    # content hash keys of the inputs, each key also covers the inputs its
+    # dictionary depends on
+    if cache_dir:
+        cache = GridCache(cache_dir)
+        keys = {}
+        keys['soil'] = cache.key([soil_file], nlayers, organic_fract,
+                                 spatial_frost, spatial_snow,
+                                 july_tavg_supplied)
+        keys['snow'] = cache.key([snow_file], snow_bands, keys['soil'])
+        keys['veglib'] = cache.key([vegl_file], veglib_fcan, veglib_photo)
+        keys['veg'] = cache.key([veg_file], veg_classes, max_roots, cells,
+                                blowing_snow, vegparam_lai, vegparam_fcan,
+                                vegparam_albedo, lai_src, fcan_src, alb_src,
+                                keys['soil'], keys['veglib'])
+        keys['lake'] = cache.key([lake_file], max_numnod, cells,
+                                 lake_profile, keys['soil'])
+        if grid_file:
+            keys['grid'] = cache.key([grid_file])
+        else:
+            keys['grid'] = cache.key([], grid_decimal, keys['soil'])
+        grid_keys = {}
+        for name, key in [('soil_dict', keys['soil']),
+                          ('snow_dict', keys['snow']),
+                          ('veg_dict', keys['veg']),
+                          ('lake_dict', keys['lake'])]:
+            grid_keys[name] = cache.key([], key, keys['grid'], compress,
+                                        version_in)
+    else:
+        cache = None
+        keys = dict.fromkeys(['soil', 'snow', 'veglib', 'veg', 'lake',
+                              'grid'])
+        grid_keys = dict.fromkeys(names)
+
+    # gridded dictionaries from the cache
+    grid_dict = {}
+    if cache:
+        for name in names:
+            cached = cache.load('gridded', grid_keys[name])
+            if cached is not None:
+                grid_dict[name] = cached
+    todo = [name for name in names if name not in grid_dict]
+
+    soil_dict = _cached(cache, 'soil', keys['soil'], soil, soil_file,
+                        c=Cols(nlayers=nlayers,
+                               organic_fract=organic_fract,
+                               spatial_frost=spatial_frost,
+                               spatial_snow=spatial_snow,
+                               july_tavg_supplied=july_tavg_supplied))
 
     if cells is None:
         cells = len(soil_dict['gridcell'])
 
-    if snow_file:
-        snow_dict = snow(snow_file, soil_dict, c=Cols(snow_bands=snow_bands))
+    if snow_file and 'snow_dict' in todo:
+        snow_dict = _cached(cache, 'snow', keys['snow'], snow, snow_file,
+                            soil_dict, c=Cols(snow_bands=snow_bands))
     else:
         snow_dict = False
 
-    if vegl_file:
-        veglib_dict, lib_bare_idx = veg_class(vegl_file,
-                                              veglib_photo=veglib_photo,
-                                              c=Cols(veglib_fcan=veglib_fcan,
-                                                     veglib_photo=veglib_photo))
+    if vegl_file and 'veg_dict' in todo:
+        veglib_dict, lib_bare_idx = _cached(
+            cache, 'veglib', keys['veglib'], veg_class, vegl_file,
+            veglib_photo=veglib_photo,
+            c=Cols(veglib_fcan=veglib_fcan, veglib_photo=veglib_photo))
         veg_classes = len(veglib_dict['Veg_class'])
     else:
         veglib_dict = False
         lib_bare_idx = None
 
-    if veg_file:
-        veg_dict = veg(veg_file, soil_dict, veg_classes,
-                       max_roots, cells, blowing_snow,
-                       vegparam_lai, vegparam_fcan,
-                       vegparam_albedo, lai_src,
-                       fcan_src, alb_src)
+    if veg_file and 'veg_dict' in todo:
+        veg_dict = _cached(cache, 'veg', keys['veg'], veg, veg_file,
+                           soil_dict, veg_classes,
+                           max_roots, cells, blowing_snow,
+                           vegparam_lai, vegparam_fcan,
+                           vegparam_albedo, lai_src,
+                           fcan_src, alb_src)
     else:
         veg_dict = False
 
-    if lake_file:
-        lake_dict = lake(lake_file, soil_dict, max_numnod,
-                         cells, lake_profile)
+    if lake_file and 'lake_dict' in todo:
+        lake_dict = _cached(cache, 'lake', keys['lake'], lake, lake_file,
+                            soil_dict, max_numnod, cells, lake_profile)
     else:
         lake_dict = False
 
     if grid_file:
-        target_grid, target_attrs = read_netcdf(grid_file)
+        target_grid, target_attrs = _cached(cache, 'grid', keys['grid'],
+                                            read_netcdf, grid_file)
+    else:
+        target_grid, target_attrs = _cached(cache, 'grid', keys['grid'],
+                                            calc_grid, soil_dict['lats'],
+                                            soil_dict['lons'],
+                                            grid_decimal)
+
+    if todo:
+        gridded = grid_params(soil_dict, target_grid, snow_dict,
+                              veglib_dict, veg_dict, lake_dict,
+                              version_in, veglib_fcan,
+                              veglib_photo, lib_bare_idx,
+                              blowing_snow, vegparam_lai,
+                              vegparam_fcan, vegparam_albedo,
+                              lai_src, fcan_src, alb_src,
+                              compress=compress,
+                              grid_soil='soil_dict' in todo)
+        for name in todo:
+            grid_dict[name] = gridded[name]
+            if cache:
+                cache.save('gridded', grid_keys[name], gridded[name])
     else:
-        target_grid, target_attrs = calc_grid(soil_dict['lats'],
-                                              soil_dict['lons'],
-                                              grid_decimal)
-
-    grid_dict = grid_params(soil_dict, target_grid, snow_dict,
-                            veglib_dict, veg_dict, lake_dict,
-                            version_in, veglib_fcan,
-                            veglib_photo, lib_bare_idx,
-                            blowing_snow, vegparam_lai,
-                            vegparam_fcan, vegparam_albedo,
-                            lai_src, fcan_src, alb_src)
+        print('all gridded params found in {0}'.format(cache_dir))
+    grid_dict = OrderedDict((name, grid_dict[name]) for name in names)
 
     if nc_file:
-        write_netcdf(nc_file, target_attrs, target_grid,
-                     grid_dict['soil_dict'], grid_dict['snow_dict'],
-                     grid_dict['veg_dict'], grid_dict['lake_dict'],
-                     version_in, organic_fract, spatial_frost,
-                     spatial_snow, july_tavg_supplied,
-                     veglib_fcan, veglib_photo, blowing_snow,
-                     vegparam_lai, vegparam_fcan, vegparam_albedo,
-                     lai_src, fcan_src, alb_src)
+        if cache:
+            out_key = cache.key([], keys['grid'], compress, zlib, complevel,
+                                sorted((chunks or {}).items()))
+            manifest = cache.load_manifest(nc_file)
+        else:
+            manifest = None
+
+        if manifest and manifest['output'] == out_key:
+            changed = [name for name in names
+                       if manifest['gridded'].get(name) != grid_keys[name]]
+            if not changed:
+                print('{0} is up to date'.format(nc_file))
+                updated = True
+            else:
+                print('updating {0} in {1}'.format(', '.join(changed),
+                                                     nc_file))
+                updated = update_netcdf(nc_file,
+                                        OrderedDict((name, grid_dict[name])
+                                                    for name in changed),
+                                        num_workers=num_workers)
+        else:
+            updated = False
+
+        if not updated:
+            write_netcdf(nc_file, target_attrs, target_grid,
+                         grid_dict['soil_dict'], grid_dict['snow_dict'],
+                         grid_dict['veg_dict'], grid_dict['lake_dict'],
+                         version_in, organic_fract, spatial_frost,
+                         spatial_snow, july_tavg_supplied,
+                         veglib_fcan, veglib_photo, blowing_snow,
+                         vegparam_lai, vegparam_fcan, vegparam_albedo,
+                         lai_src, fcan_src, alb_src, compress=compress,
+                         zlib=zlib, complevel=complevel, chunks=chunks,
+                         num_workers=num_workers)
+        if cache:
+            cache.save_manifest(nc_file, {'output': out_key,
+                                          'gridded': grid_keys})
         return nc_file
     else:
         return grid_dict
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+class GridCache(object):
+    """
+    Cache of parsed and gridded parameter dictionaries in cache_dir.
+    Entries are pickled and named by the content hash of their inputs.  A
+    manifest of the gridded dictionaries written to each output file is
+    kept so that make_grid can update the file in place.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, files, *options):
+        """Hash the contents of files and the repr of options"""
+        h = hashlib.sha1()
+        for path in files:
+            if path:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+            h.update(b'\0')
+        for option in options:
+            h.update(repr(option).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, '{0}_{1}.pkl'.format(kind, key))
+
+    def load(self, kind, key):
+        """Return the cached object or None if it is not in the cache"""
+        path = self._path(kind, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, kind, key, obj):
+        """Store obj in the cache"""
+        path = self._path(kind, key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    def _manifest_path(self, nc_file):
+        name = hashlib.sha1(os.path.abspath(nc_file).encode('utf-8'))
+        return os.path.join(self.cache_dir,
+                            'manifest_{0}.json'.format(name.hexdigest()))
+
+    def load_manifest(self, nc_file):
+        """
+        Return the manifest of nc_file or None if there is none or the file
+        changed since the manifest was written
+        """
+        path = self._manifest_path(nc_file)
+        if not (os.path.isfile(path) and os.path.isfile(nc_file)):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        stat = os.stat(nc_file)
+        if manifest.get('stat') != [stat.st_size, stat.st_mtime]:
+            return None
+        return manifest
+
+    def save_manifest(self, nc_file, manifest):
+        """Store the manifest of nc_file"""
+        stat = os.stat(nc_file)
+        manifest = dict(manifest, stat=[stat.st_size, stat.st_mtime])
+        with open(self._manifest_path(nc_file), 'w') as f:
+            json.dump(manifest, f)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _cached(cache, kind, key, func, *args, **kwargs):
+    """Load the result of func from the cache or call it and cache it"""
+    if cache is None:
+        return func(*args, **kwargs)
+    obj = cache.load(kind, key)
+    if obj is None:
+        obj = func(*args, **kwargs)
+        cache.save(kind, key, obj)
+    return obj
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def calc_grid(lats, lons, decimals=4):
     """ determine shape of regular grid from lons and lats"""
@@ -820,18 +1012,55 @@ def latlon2yx(plats, plons, glats, glons):
         plons[posinds] -= 360
         print('adjusted points lon minimum')
 
-    if glons.ndim == 1 or glats.ndim == 1:
-        print('creating 2d coordinate arrays')
-        glats, glons = np.meshgrid(glats, glons, indexing='ij')
+    return GridIndex(glats, glons).query(plats, plons)
+# -------------------------------------------------------------------- #
 
-    combined = np.dstack(([glats.ravel(), glons.ravel()]))[0]
-    points = list(np.vstack((np.array(plats), np.array(plons))).transpose())
 
-    mytree = cKDTree(combined)
-    dist, indexes = mytree.query(points, k=1)
-    y, x = np.unravel_index(indexes, glons.shape)
+# -------------------------------------------------------------------- #
+class GatheredDict(OrderedDict):
+    """
+    Dictionary of land only parameter arrays (compression by gathering).
+    The last axis of each array indexes the active grid cells listed in
+    `land` (flat indices into a grid of `shape`).  Dense (..., ysize, xsize)
+    masked arrays are only created when requested through `dense`.
+    """
+    def __init__(self, land=None, shape=None, *args, **kwargs):
+        super(GatheredDict, self).__init__(*args, **kwargs)
+        self.land = land
+        self.shape = shape
+
+    def dense(self, var):
+        """Expand var to a dense (..., ysize, xsize) masked array"""
+        data = self[var]
+        if data.dtype.kind in 'iu':
+            fill_val = FILLVALUE_I
+        else:
+            fill_val = FILLVALUE_F
+        out = np.full(data.shape[:-1] + (self.shape[0] * self.shape[1], ),
+                      fill_val, dtype=data.dtype)
+        out[..., self.land] = np.ma.filled(data, fill_val)
+        out = out.reshape(data.shape[:-1] + tuple(self.shape))
+        return np.ma.masked_values(out, fill_val)
+# -------------------------------------------------------------------- #
+
 
-    return y, x
+# -------------------------------------------------------------------- #
+def gather(grid, land, shape):
+    """
+    Gather the land cells of a dense grid dictionary into a GatheredDict.
+    Variables that are not on the (ysize, xsize) grid are passed through.
+    """
+    if isinstance(grid, GatheredDict):
+        return grid
+
+    out = GatheredDict(land, shape)
+    for var, data in grid.items():
+        if np.ndim(data) >= 2 and data.shape[-2:] == tuple(shape):
+            data = np.ma.asarray(data)
+            out[var] = data.reshape(data.shape[:-2] + (-1, ))[..., land]
+        else:
+            out[var] = data
+    return out
 # -------------------------------------------------------------------- #
 
 
@@ -841,19 +1070,27 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
                 veglib_photo=False, lib_bare_idx=None, blowing_snow=False,
                 vegparam_lai=False, vegparam_fcan=False,
                 vegparam_albedo=False, lai_src='FROM_VEGLIB',
-                fcan_src='FROM_DEFAULT', alb_src='FROM_VEGLIB'):
+                fcan_src='FROM_DEFAULT', alb_src='FROM_VEGLIB',
+                compress=False, grid_soil=True):
     """
     Reads the coordinate information from the soil_dict and target_grid and
     maps all input dictionaries to the target grid.  Returns a grid_dict with
-    the mapped input dictionary data.
+    the mapped input dictionary data.  If compress is True, only the active
+    cells of the target grid mask are stored and each sub-dictionary is a
+    GatheredDict.  If grid_soil is False, the soil_dict is only used for the
+    coordinates and grid_dict['soil_dict'] is False.
     """
     print('gridding params now...')
 
     yi, xi = latlon2yx(soil_dict['lats'], soil_dict['lons'],
                        target_grid[YVAR], target_grid[XVAR])
 
-    in_dicts = {'soil_dict': soil_dict}
+    in_dicts = {}
     out_dicts = OrderedDict()
+    if grid_soil:
+        in_dicts['soil_dict'] = soil_dict
+    else:
+        out_dicts['soil_dict'] = False
     if snow_dict:
         in_dicts['snow_dict'] = snow_dict
     else:
@@ -876,8 +1113,28 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
 
     print('{0} masked values'.format(len(ymask)))
 
+    if compress:
+        # compression by gathering, only keep the active cells of the mask
+        # points that fall outside of the mask are dropped
+        land = np.flatnonzero(mask == 1)
+        cells = np.ravel_multi_index((yi, xi), mask.shape)
+        pos = np.minimum(np.searchsorted(land, cells), len(land) - 1)
+        sel = np.nonzero(land[pos] == cells)[0]
+        inds = (pos[sel], )
+        fill_inds = (np.array([], dtype=int), )
+        grid_shape = (len(land), )
+        print('gathering {0} active cells'.format(len(land)))
+    else:
+        sel = slice(None)
+        inds = (yi, xi)
+        fill_inds = (ymask, xmask)
+        grid_shape = (ysize, xsize)
+
     for name, mydict in in_dicts.items():
-        out_dict = OrderedDict()
+        if compress:
+            out_dict = GatheredDict(land, mask.shape)
+        else:
+            out_dict = OrderedDict()
 
         for var in mydict:
             if mydict[var].dtype in [np.int, np.int64, np.int32]:
@@ -891,29 +1148,28 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
                 dtype = np.float
 
             if mydict[var].ndim == 1:
-                out_dict[var] = np.ma.zeros((ysize, xsize),
-                                            dtype=dtype)
-                out_dict[var][yi, xi] = mydict[var]
-                out_dict[var][ymask, xmask] = fill_val
+                out_dict[var] = np.ma.zeros(grid_shape, dtype=dtype)
+                out_dict[var][inds] = mydict[var][sel]
+                out_dict[var][fill_inds] = fill_val
 
             elif mydict[var].ndim == 2:
                 steps = mydict[var].shape[1]
-                out_dict[var] = np.ma.zeros((steps, ysize, xsize),
+                out_dict[var] = np.ma.zeros((steps, ) + grid_shape,
                                             dtype=dtype)
                 for i in pyrange(steps):
-                    out_dict[var][i, yi, xi] = mydict[var][:, i]
-                out_dict[var][:, ymask, xmask] = fill_val
+                    out_dict[var][(i, ) + inds] = mydict[var][sel, i]
+                out_dict[var][(Ellipsis, ) + fill_inds] = fill_val
 
             elif mydict[var].ndim == 3:
                 j = mydict[var].shape[1]
                 k = mydict[var].shape[2]
-                out_dict[var] = np.ma.zeros((j, k, ysize, xsize),
+                out_dict[var] = np.ma.zeros((j, k) + grid_shape,
                                             dtype=dtype)
                 for jj in pyrange(j):
                     for kk in pyrange(k):
-                        out_dict[var][jj, kk, yi, xi] = mydict[var][:, jj, kk]
-                for y, x in pyzip(ymask, xmask):
-                    out_dict[var][:, :, y, x] = fill_val
+                        out_dict[var][(jj, kk) + inds] = \
+                            mydict[var][sel, jj, kk]
+                out_dict[var][(Ellipsis, ) + fill_inds] = fill_val
 
             out_dict[var] = np.ma.masked_values(out_dict[var], fill_val)
 
@@ -944,13 +1200,13 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
         shape = (nveg_classes, ) + out_dicts['veg_dict'][var].shape[1:]
         new = np.zeros(shape)
         if extra_class:
-            new[:-1, :, :] = out_dicts['veg_dict'][var]
+            new[:-1] = out_dicts['veg_dict'][var]
         else:
-            new[:, :, :] = out_dicts['veg_dict'][var]
-        new[lib_bare_idx, :, :] += bare
+            new[:] = out_dicts['veg_dict'][var]
+        new[lib_bare_idx] += bare
         # Ensure that Cvs sum to 1.0
         new /= new.sum(axis=0)
-        new[:, ymask, xmask] = FILLVALUE_F
+        new[(slice(None), ) + fill_inds] = FILLVALUE_F
         out_dicts['veg_dict'][var] = new
 
         # Distribute the vegparam variables (geographically-varying)
@@ -970,10 +1226,10 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
             shape = (nveg_classes, ) + out_dicts['veg_dict'][var].shape[1:]
             new = np.full(shape, FILLVALUE_F)
             if extra_class:
-                new[:-1, :, :] = out_dicts['veg_dict'][var]
-                new[-1, :, :] = bare_vegparam[var]
+                new[:-1] = out_dicts['veg_dict'][var]
+                new[-1] = bare_vegparam[var]
             else:
-                new[:, :, :] = out_dicts['veg_dict'][var]
+                new[:] = out_dicts['veg_dict'][var]
             out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
 
         if blowing_snow:
@@ -981,10 +1237,10 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
                 shape = (nveg_classes, ) + out_dicts['veg_dict'][var].shape[1:]
                 new = np.full(shape, FILLVALUE_F)
                 if extra_class:
-                    new[:-1, :, :] = out_dicts['veg_dict'][var]
-                    new[-1, :, :] = bare_vegparam[var]
+                    new[:-1] = out_dicts['veg_dict'][var]
+                    new[-1] = bare_vegparam[var]
                 else:
-                    new[:, :, :] = out_dicts['veg_dict'][var]
+                    new[:] = out_dicts['veg_dict'][var]
                 out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
 
         # Distribute the veglib variables
@@ -1004,17 +1260,19 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
             lib_var = 'lib_{0}'.format(var)
             if var in ['Ctype', 'Nscale']:
                 fill_val = FILLVALUE_I
-                new = np.full((nveg_classes, ysize, xsize), fill_val,
+                new = np.full((nveg_classes, ) + grid_shape, fill_val,
                               dtype=np.int)
             else:
                 fill_val = FILLVALUE_F
-                new = np.full((nveg_classes, ysize, xsize), fill_val)
+                new = np.full((nveg_classes, ) + grid_shape, fill_val)
             if extra_class:
-                new[:-1, yi, xi] = veglib_dict[lib_var][:, np.newaxis]
-                new[-1, yi, xi] = bare_vegparam[var]
+                new[(slice(None, -1), ) + inds] = \
+                    veglib_dict[lib_var][:, np.newaxis]
+                new[(-1, ) + inds] = bare_vegparam[var]
             else:
-                new[:, yi, xi] = veglib_dict[lib_var][:, np.newaxis]
-            new[:, ymask, xmask] = fill_val
+                new[(slice(None), ) + inds] = \
+                    veglib_dict[lib_var][:, np.newaxis]
+            new[(slice(None), ) + fill_inds] = fill_val
             out_dicts['veg_dict'][var] = np.ma.masked_values(new, fill_val)
 
         # 2nd - the 2d vars
@@ -1027,16 +1285,16 @@ def grid_params(soil_dict, target_grid, snow_dict, veglib_dict, veg_dict,
             varnames = ['LAI'] + varnames
         for var in varnames:
             lib_var = 'lib_{0}'.format(var)
-            shape = (nveg_classes, veglib_dict[lib_var].shape[1],
-                     ysize, xsize)
+            shape = (nveg_classes, veglib_dict[lib_var].shape[1]) + grid_shape
             new = np.full(shape, FILLVALUE_F)
             if extra_class:
-                new[:-1, :, yi, xi] = veglib_dict[lib_var][:, :, np.newaxis]
-                new[-1, :, yi, xi] = bare_vegparam[var]
+                new[(slice(None, -1), slice(None)) + inds] = \
+                    veglib_dict[lib_var][:, :, np.newaxis]
+                new[(-1, slice(None)) + inds] = bare_vegparam[var]
             else:
-                new[:, :, yi, xi] = veglib_dict[lib_var][:, :, np.newaxis]
-            for y, x in pyzip(ymask, xmask):
-                new[:, :, y, x] = fill_val
+                new[(slice(None), slice(None)) + inds] = \
+                    veglib_dict[lib_var][:, :, np.newaxis]
+            new[(Ellipsis, ) + fill_inds] = FILLVALUE_F
             out_dicts['veg_dict'][var] = np.ma.masked_values(new, FILLVALUE_F)
 
         # Finally, transfer veglib class descriptions (don't distribute)
@@ -1065,15 +1323,28 @@ def write_netcdf(myfile, target_attrs, target_grid,
                  veglib_fcan=False, veglib_photo=False, blowing_snow=False,
                  vegparam_lai=False, vegparam_fcan=False,
                  vegparam_albedo=False, lai_src='FROM_VEGLIB',
-                 fcan_src='FROM_DEFAULT', alb_src='FROM_VEGLIB'):
+                 fcan_src='FROM_DEFAULT', alb_src='FROM_VEGLIB',
+                 compress=False, zlib=False, complevel=4, chunks=None,
+                 num_workers=1):
     """
     Write the gridded parameters to a netcdf4 file
     Will only write paramters that it is given
     Reads attributes from params.py and from targetAtters dictionary read from
     grid_file
+    If compress is True (or the grids are GatheredDicts), parameters are
+    written on a land only dimension using CF compression by gathering.
+    zlib and complevel set the netCDF compression of the parameter variables
+    and chunks is a dictionary of chunk lengths by dimension name (missing
+    dimensions are not chunked).  The parameter data are encoded by a pool of
+    num_workers threads (default 1) while a single thread writes them to
+    the file.
     """
     f = Dataset(myfile, 'w', format='NETCDF4')
 
+    # parameter variables are created first and written at the end
+    encoding = {'zlib': zlib, 'complevel': complevel, 'chunks': chunks}
+    jobs = []
+
     # write attributes for netcdf
     f.description = 'VIC parameter file'
     f.history = 'Created: {0}\n'.format(tm.ctime(tm.time()))
@@ -1160,9 +1431,35 @@ def write_netcdf(myfile, target_attrs, target_grid,
             except:
                 print('dont have units or description for {0}'.format(var))
 
+    # compression by gathering (land only) dimension
+    if compress or isinstance(soil_grid, GatheredDict):
+        shape = target_grid['mask'].shape
+        land = getattr(soil_grid, 'land', None)
+        if land is None:
+            land = np.flatnonzero(target_grid['mask'] == 1)
+        soil_grid = gather(soil_grid, land, shape)
+        if snow_grid:
+            snow_grid = gather(snow_grid, land, shape)
+        if veg_grid:
+            veg_grid = gather(veg_grid, land, shape)
+        if lake_grid:
+            lake_grid = gather(lake_grid, land, shape)
+
+        f.createDimension('land', len(land))
+        v = f.createVariable('land', NC_INT, ('land', ))
+        v[:] = land
+        v.compress = ' '.join(dims2)
+        v.long_name = 'active grid cell'
+        cell_dims = ('land', )
+    else:
+        cell_dims = dims2
+    # dimensions to add to the number of data dimensions to get the number
+    # of dimensions of the dense grid
+    extra_dims = len(dims2) - len(cell_dims)
+
     # Layers
     f.createDimension('nlayer', soil_grid['soil_density'].shape[0])
-    layer_dims = ('nlayer', ) + dims2
+    layer_dims = ('nlayer', ) + cell_dims
 
     v = f.createVariable('layer', NC_INT, ('nlayer', ))
     v[:] = np.arange(1, soil_grid['soil_density'].shape[0] + 1)
@@ -1170,26 +1467,29 @@ def write_netcdf(myfile, target_attrs, target_grid,
 
     # soil grid
     for var, data in soil_grid.items():
-        print('writing var: {0}'.format(var))
+        ndim = data.ndim + extra_dims
 
-        if data.ndim == 1:
+        if ndim == 1:
             v = f.createVariable(var, NC_DOUBLE, ('nlayer', ),
                                  fill_value=FILLVALUE_F)
-            v[:] = data
+            jobs.append((v, data))
 
-        elif data.ndim == 2:
+        elif ndim == 2:
             if var in ['gridcell', 'run_cell', 'fs_active']:
-                v = f.createVariable(var, NC_INT, dims2,
-                                     fill_value=FILLVALUE_I)
+                v = _create_variable(f, var, NC_INT, cell_dims,
+                                     fill_value=FILLVALUE_I,
+                                     **encoding)
             else:
-                v = f.createVariable(var, NC_DOUBLE, dims2,
-                                     fill_value=FILLVALUE_F)
-            v[:, :] = data
-
-        elif data.ndim == 3:
-            v = f.createVariable(var, NC_DOUBLE, layer_dims,
-                                 fill_value=FILLVALUE_F)
-            v[:, :, :] = data
+                v = _create_variable(f, var, NC_DOUBLE, cell_dims,
+                                     fill_value=FILLVALUE_F,
+                                     **encoding)
+            jobs.append((v, data))
+
+        elif ndim == 3:
+            v = _create_variable(f, var, NC_DOUBLE, layer_dims,
+                                 fill_value=FILLVALUE_F,
+                                 **encoding)
+            jobs.append((v, data))
         else:
             raise IOError('all soil vars should be 2 or 3 dimensions')
 
@@ -1207,23 +1507,25 @@ def write_netcdf(myfile, target_attrs, target_grid,
             pass
 
         f.createDimension('snow_band', snow_grid['AreaFract'].shape[0])
-        snow_dims = ('snow_band', ) + dims2
+        snow_dims = ('snow_band', ) + cell_dims
 
         v = f.createVariable('snow_band', NC_INT, ('snow_band', ))
         v[:] = np.arange(1, snow_grid['AreaFract'].shape[0] + 1)
         v.long_name = 'snow band'
 
         for var, data in snow_grid.items():
-            print('writing var: {0}'.format(var))
-
-            if data.ndim == 2:
-                v = f.createVariable(var, NC_DOUBLE, dims2,
-                                     fill_value=FILLVALUE_F)
-                v[:, :] = data
-            elif data.ndim == 3:
-                v = f.createVariable(var, NC_DOUBLE, snow_dims,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :] = data
+            ndim = data.ndim + extra_dims
+
+            if ndim == 2:
+                v = _create_variable(f, var, NC_DOUBLE, cell_dims,
+                                     fill_value=FILLVALUE_F,
+                                     **encoding)
+                jobs.append((v, data))
+            elif ndim == 3:
+                v = _create_variable(f, var, NC_DOUBLE, snow_dims,
+                                     fill_value=FILLVALUE_F,
+                                     **encoding)
+                jobs.append((v, data))
             else:
                 raise IOError('all snow vars should be 2 or 3 dimensions')
 
@@ -1260,39 +1562,45 @@ def write_netcdf(myfile, target_attrs, target_grid,
 
         for var, data in veg_grid.items():
             if var != 'comment':
-                print('writing var: {0} {1}'.format(var, data.shape))
+                ndim = data.ndim + extra_dims
 
-                if veg_grid[var].ndim == 2:
+                if ndim == 2:
                     if var  == 'Nveg':
-                        v = f.createVariable(var, NC_INT, dims2,
-                                             fill_value=FILLVALUE_I)
+                        v = _create_variable(f, var, NC_INT, cell_dims,
+                                             fill_value=FILLVALUE_I,
+                                             **encoding)
                     else:
-                        v = f.createVariable(var, NC_DOUBLE, dims2,
-                                             fill_value=FILLVALUE_F)
-                    v[:, :] = data
+                        v = _create_variable(f, var, NC_DOUBLE, cell_dims,
+                                             fill_value=FILLVALUE_F,
+                                             **encoding)
+                    jobs.append((v, data))
 
-                elif veg_grid[var].ndim == 3:
-                    mycoords = ('veg_class', ) + dims2
+                elif ndim == 3:
+                    mycoords = ('veg_class', ) + cell_dims
                     if var in ['overstory', 'Ctype', 'Nscale']:
-                        v = f.createVariable(var, NC_INT, mycoords,
-                                             fill_value=FILLVALUE_I)
+                        v = _create_variable(f, var, NC_INT, mycoords,
+                                             fill_value=FILLVALUE_I,
+                                             **encoding)
                     else:
-                        v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                             fill_value=FILLVALUE_F)
-                    v[:, :, :] = data
+                        v = _create_variable(f, var, NC_DOUBLE, mycoords,
+                                             fill_value=FILLVALUE_F,
+                                             **encoding)
+                    jobs.append((v, data))
 
                 elif var in ['LAI', 'fcanopy', 'albedo', 'veg_rough',
                              'displacement']:
-                    mycoords = ('veg_class', 'month') + dims2
-                    v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                         fill_value=FILLVALUE_F)
-                    v[:, :, :, :] = data
-
-                elif veg_grid[var].ndim == 4:
-                    mycoords = ('veg_class', 'root_zone', ) + dims2
-                    v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                         fill_value=FILLVALUE_F)
-                    v[:, :, :, :] = data
+                    mycoords = ('veg_class', 'month') + cell_dims
+                    v = _create_variable(f, var, NC_DOUBLE, mycoords,
+                                         fill_value=FILLVALUE_F,
+                                         **encoding)
+                    jobs.append((v, data))
+
+                elif ndim == 4:
+                    mycoords = ('veg_class', 'root_zone', ) + cell_dims
+                    v = _create_variable(f, var, NC_DOUBLE, mycoords,
+                                         fill_value=FILLVALUE_F,
+                                         **encoding)
+                    jobs.append((v, data))
 
                 else:
                     raise ValueError('only able to handle dimensions <=4')
@@ -1320,22 +1628,25 @@ def write_netcdf(myfile, target_attrs, target_grid,
         v.long_name = 'lake basin node'
 
         for var, data in lake_grid.items():
-            print('writing var: {0} {1}'.format(var, data.shape))
+            ndim = data.ndim + extra_dims
 
-            if lake_grid[var].ndim == 2:
+            if ndim == 2:
                 if var in ['lake_idx', 'numnod']:
-                    v = f.createVariable(var, NC_INT, dims2,
-                                         fill_value=FILLVALUE_I)
+                    v = _create_variable(f, var, NC_INT, cell_dims,
+                                         fill_value=FILLVALUE_I,
+                                         **encoding)
                 else:
-                    v = f.createVariable(var, NC_DOUBLE, dims2,
-                                         fill_value=FILLVALUE_F)
-                v[:, :] = data
-
-            elif lake_grid[var].ndim == 3:
-                mycoords = ('lake_node', ) + dims2
-                v = f.createVariable(var, NC_DOUBLE, mycoords,
-                                     fill_value=FILLVALUE_F)
-                v[:, :, :] = data
+                    v = _create_variable(f, var, NC_DOUBLE, cell_dims,
+                                         fill_value=FILLVALUE_F,
+                                         **encoding)
+                jobs.append((v, data))
+
+            elif ndim == 3:
+                mycoords = ('lake_node', ) + cell_dims
+                v = _create_variable(f, var, NC_DOUBLE, mycoords,
+                                     fill_value=FILLVALUE_F,
+                                     **encoding)
+                jobs.append((v, data))
 
             else:
                 raise ValueError('only able to handle dimensions <=3')
@@ -1347,12 +1658,109 @@ def write_netcdf(myfile, target_attrs, target_grid,
             if coordinates:
                 v.coordinates = coordinates
 
+    print('writing {0} variables to {1}'.format(len(jobs), myfile))
+    write_variables(jobs, num_workers=num_workers)
+
     f.close()
 
     return
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def update_netcdf(myfile, grids, num_workers=1):
+    """
+    Update the parameter variables of a netcdf file written by write_netcdf
+    in place.  grids is a dictionary of gridded sub-dictionaries, e.g.
+    {'veg_dict': veg_grid}.  Returns False, without changing the file, if
+    the variables or their shapes do not match the ones in the file.
+    """
+    f = Dataset(myfile, 'a')
+    try:
+        if 'land' in f.variables:
+            land = f.variables['land'][:]
+            shape = f.variables['mask'].shape
+        jobs = []
+        strings = []
+        for name, grid in grids.items():
+            if not grid:
+                return False
+            if 'land' in f.variables:
+                grid = gather(grid, land, shape)
+            for var, data in grid.items():
+                if var == 'gridcell' and name != 'soil_dict':
+                    continue
+                if var == 'comment':
+                    var = 'veg_descr'
+                if var not in f.variables:
+                    return False
+                if np.shape(data) != f.variables[var].shape:
+                    return False
+                if var == 'veg_descr':
+                    strings.append((f.variables[var], data))
+                else:
+                    jobs.append((f.variables[var], data))
+
+        for v, data in strings:
+            v[:] = np.asarray(data)
+        print('writing {0} variables to {1}'.format(len(jobs), myfile))
+        write_variables(jobs, num_workers=num_workers)
+
+        f.history += 'Updated: {0} {1}\n'.format(tm.ctime(tm.time()),
+                                                  ' '.join(grids))
+    finally:
+        f.close()
+
+    return True
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _create_variable(f, var, datatype, dimensions, fill_value=None,
+                     zlib=False, complevel=4, chunks=None):
+    """Create a netCDF variable with compression and chunk settings"""
+    if chunks:
+        chunksizes = [min(chunks.get(dim, len(f.dimensions[dim])),
+                          len(f.dimensions[dim])) for dim in dimensions]
+    else:
+        chunksizes = None
+    return f.createVariable(var, datatype, dimensions, fill_value=fill_value,
+                            zlib=zlib, complevel=complevel,
+                            chunksizes=chunksizes)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _encode(data, dtype, fill_value):
+    """Fill the masked values of data and cast it to dtype"""
+    return np.ma.filled(np.ma.asarray(data), fill_value).astype(dtype)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def write_variables(jobs, num_workers=1):
+    """
+    Write a list of (netCDF variable, data) pairs.  The data are encoded
+    (fill values and dtype cast) in a pool of threads while the calling
+    thread is the only one writing to the file.  At most 2 * num_workers
+    encoded variables are held in memory at a time.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for v, data in jobs:
+            fill_value = getattr(v, '_FillValue', None)
+            pending.append((v, pool.submit(_encode, data, v.dtype,
+                                           fill_value)))
+            if len(pending) >= 2 * num_workers:
+                v, future = pending.popleft()
+                v[:] = future.result()
+        while pending:
+            v, future = pending.popleft()
+            v[:] = future.result()
+    return
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def soil(in_file, c=Cols(nlayers=3, organic_fract=False,
                          spatial_frost=False, spatial_snow=False,
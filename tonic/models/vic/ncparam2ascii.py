@@ -6,13 +6,22 @@ description = 'Convert netCDF format VIC parameters to classic ASCII format'
 help = description
 
 
+import re
+from itertools import islice
 import numpy as np
 from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from . import grid_params
-from tonic.io import read_netcdf
-from tonic.pycompat import pyzip, iteritems
+from tonic.io import ParamSet
+from tonic.pycompat import OrderedDict, iteritems
 
 FILL_VALUE = -9999
+MONTHS_PER_YEAR = 12
+BUFFER_SIZE = 1 << 22
+
+VEG_VARS = ['gridcell', 'Nveg', 'Cv', 'root_depth', 'root_fract', 'LAI']
+LAKE_VARS = ['gridcell', 'lake_idx', 'numnod', 'mindepth', 'wfrac',
+             'depth_in', 'rpercent', 'basin_depth', 'basin_area']
 
 
 # -------------------------------------------------------------------- #
@@ -21,7 +30,8 @@ def _run(args):
     subset(args.nc_params, upleft=args.upleft, lowright=args.lowright,
            outfiles=args.outfiles, soil_file=args.soil_file,
            snow_file=args.snow_file, veg_file=args.veg_file,
-           project=args.project, nijssen2arno=args.nijssen2arno)
+           lake_file=args.lake_file, project=args.project,
+           nijssen2arno=args.nijssen2arno, num_workers=args.num_workers)
     return
 # -------------------------------------------------------------------- #
 
@@ -30,55 +40,125 @@ def _run(args):
 def subset(param_file, upleft=False, lowright=False, outfiles=1,
            soil_file=False, snow_file=False,
            veg_file=False, project=None,
-           nijssen2arno=False):
+           nijssen2arno=False, num_workers=1, lake_file=False):
+    """
+    Write VIC ascii parameter files for the cells of param_file between
+    upleft and lowright.  The variables needed for all requested files are
+    gathered, one variable at a time, into a single CellTable of the
+    selected cells from which every file is written.  If outfiles > 1, the
+    cells are split over that many soil files which are written
+    concurrently by num_workers processes.
+    """
 
-    data, attributes = read_netcdf(param_file)
+    # subset grid cells (bounds are exclusive)
+    if (upleft and lowright):
+        bbox = (lowright[0] + 1, upleft[0] - 1, upleft[1] + 1, lowright[1] - 1)
+    else:
+        bbox = None
 
-    if nijssen2arno:
-        import NIJSSEN2001_to_ARNO
-        data = NIJSSEN2001_to_ARNO.convert(data)
+    params = ParamSet(param_file, bbox=bbox)
+
+    # only read the variables needed for the requested files
+    variables = []
+    if project == 'RASM':
+        variables.extend(grid_params.Cols(nlayers=3).soil_param)
+        variables.extend(['Nveg', 'mask', 'xc', 'yc'])
+    else:
+        if soil_file:
+            variables.extend(grid_params.Cols(nlayers=3).soil_param)
+        if snow_file:
+            # as in snow, the bands of AreaFract, 5 by default
+            if 'snow_band' in params.f.dimensions:
+                snow_bands = len(params.f.dimensions['snow_band'])
+            elif 'AreaFract' in params.f.variables:
+                snow_bands = params.f.variables['AreaFract'].shape[0]
+            else:
+                snow_bands = 5
+            c = grid_params.Cols(snow_bands=snow_bands)
+            variables.extend(c.snow_param)
+        if veg_file:
+            variables.extend(VEG_VARS)
+        if lake_file:
+            variables.extend(LAKE_VARS)
+    variables = [var for var in OrderedDict.fromkeys(variables)
+                 if var in params]
 
     if project:
         print('Project Configuration {0}'.format(project))
-        if project == 'RASM':
-            outfiles = 1
-            cells, yinds, xinds = find_gridcells(data['mask'])
-            rasm_soil(data, soil_file)
-        else:
+        if project != 'RASM':
             raise ValueError('Unknown project configuration')
+        data, attributes = params.read(variables, window=False)
+        params.close()
+
+        if nijssen2arno:
+            import NIJSSEN2001_to_ARNO
+            data = NIJSSEN2001_to_ARNO.convert(data)
+
+        rasm_soil(data, soil_file)
         return
 
-    else:
-        cells, yinds, xinds = find_gridcells(data['mask'])
+    table = CellTable.from_paramset(params, variables)
+    params.close()
+
+    if nijssen2arno:
+        import NIJSSEN2001_to_ARNO
+        table = NIJSSEN2001_to_ARNO.convert(table)
 
-    # write snow and veg files
+    # write veg, snow and lake files
     if veg_file:
-        rootzones = data['root_depth'].shape[1]
-        veg(data, xinds, yinds, veg_file, rootzones=rootzones, global_lai=True)
+        write_veg(table, veg_file, rootzones=table.shapes['root_depth'][1],
+                  global_lai='LAI' in table)
     if snow_file:
-        snow(data, xinds, yinds, snow_file)
+        write_snow(table, snow_file)
+    if lake_file:
+        write_lake(table, lake_file)
 
-    if (upleft and lowright):
-        inds = ((yinds < upleft[0]) and
-                (yinds > lowright[0]) and
-                (xinds < lowright[1]) and
-                (xinds > upleft[1]))
-        yinds = yinds[inds]
-        xinds = xinds[inds]
+    if not soil_file:
+        return
 
-    filesize = np.ceil(cells / outfiles)
+    cells = table.ncells
+    filesize = int(np.ceil(cells / float(outfiles)))
 
+    jobs = []
     for i in range(outfiles):
         start = i * filesize
-        end = i * filesize + filesize
-        if end > cells:
-            end = cells
+        end = min(start + filesize, cells)
         if outfiles > 1:
             out_file = '{0}_{1}.txt'.format(soil_file,
                                             str(i).zfill(len(str(outfiles))))
         else:
             out_file = '{0}.txt'.format(soil_file)
-        soil(data, xinds[start:end], yinds[start:end], out_file)
+        jobs.append((out_file, slice(start, end)))
+
+    c = grid_params.Cols(nlayers=3)
+    f = grid_params.Format(nlayers=3)
+    if num_workers > 1 and len(jobs) > 1:
+        # the rows of a file are only built when a worker is free for it, so
+        # at most num_workers files are held in memory
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            pending = iter(jobs)
+            futures = {}
+            while True:
+                for out_file, cells in islice(pending,
+                                              num_workers - len(futures)):
+                    rows, row_fmt = _param_rows(table, c.soil_param,
+                                                f.soil_param, cells)
+                    futures[pool.submit(_write_rows, out_file, row_fmt,
+                                        rows)] = out_file
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    print('finished writing soil parameter file: '
+                          '{0}'.format(futures.pop(future)))
+    else:
+        for out_file, cells in jobs:
+            rows, row_fmt = _param_rows(table, c.soil_param, f.soil_param,
+                                        cells)
+            _write_rows(out_file, row_fmt, rows)
+            print('finished writing soil parameter file: '
+                  '{0}'.format(out_file))
 
     return
 # -------------------------------------------------------------------- #
@@ -96,16 +176,20 @@ Notes about RASM soil parameter file generations:
  - Inactive grid cells will have a dummy line printed for all variables except
    the lons/lats.
  - Any grid cells with nans will be copied from the previous line without nans
-   or FILL_VALUEs.
+   or FILL_VALUEs (or the nearest such line if there is no previous one).
 *** --------------------------------------------------------------------- ***\n
     """
 
     print(message)
 
     # ---------------------------------------------------------------- #
-    c = grid_params.cols(nlayers=3)
-    f = grid_params.format(nlayers=3)
+    # For rasm, all cols are shifted one to right to make room for nveg in
+    # col 0
+    c = grid_params.Cols(nlayers=3)
+    f = grid_params.Format(nlayers=3)
 
+    for var in c.soil_param:
+        c.soil_param[var] = c.soil_param[var] + 1
     c.soil_param['Nveg'] = np.array([0])
     f.soil_param['Nveg'] = '%1i'
 
@@ -136,11 +220,7 @@ Notes about RASM soil parameter file generations:
     fy, fx = np.nonzero(my_mask == 0)
 
     # Find nearest real grid cell
-    combined = np.dstack(([data['yc'][ry, rx], data['xc'][ry, rx]]))[0]
-    points = list(np.vstack((data['yc'][fy, fx],
-                             data['xc'][fy, fx])).transpose())
-    mytree = cKDTree(combined)
-    dist, inds = mytree.query(points, k=1)
+    inds = _nearest(data, ry, rx, fy, fx)
 
     # loop over all variables and fill in values
     for var in c.soil_param:
@@ -155,12 +235,6 @@ Notes about RASM soil parameter file generations:
                 data[var][:, fy, fx] = data[var][:, ry[inds], rx[inds]]
     # ---------------------------------------------------------------- #
 
-    # ---------------------------------------------------------------- #
-    # This is the domain mask
-    yinds, xinds = np.nonzero(data['mask'] == 1)
-    ymask, xmask = np.nonzero(data['mask'] == 0)
-    # ---------------------------------------------------------------- #
-
     # ---------------------------------------------------------------- #
     # Fix problematic avg_T values
     print('Finding/filling nearest neighbors for avg_T\n')
@@ -177,39 +251,31 @@ Notes about RASM soil parameter file generations:
 
     # Find nearest real grid cell
     if len(fy) > 0:
-        combined = np.dstack(([data['yc'][ry, rx], data['xc'][ry, rx]]))[0]
-        points = list(np.vstack((data['yc'][fy, fx],
-                                 data['xc'][fy, fx])).transpose())
-        mytree = cKDTree(combined)
-        dist, inds = mytree.query(points, k=1)
+        inds = _nearest(data, ry, rx, fy, fx)
 
         data['avg_T'] = np.array(data['avg_T'])
         data['avg_T'][fy, fx] = data['avg_T'][ry[inds], rx[inds]]
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
-    # For rasm, all cols are shifted one to right to make room for nveg in
-    # col 0
-    i = -1
+    # put real data, one row per grid cell of the raveled mask
+    # (missing integer values are set to 0, missing floats are back-filled)
     for var, cols in iteritems(c.soil_param):
+        if f.soil_param[var] == '%1i':
+            fill_value = 0
+        else:
+            fill_value = np.nan
+        values = np.ma.filled(np.ma.asarray(data[var], dtype=np.float64),
+                              fill_value)
+        if values.ndim == 2:
+            soil_params[:, cols[0]] = values.ravel()
+        elif values.ndim == 3:
+            soil_params[:, cols] = values.reshape(len(cols), -1).T
         for col in cols:
             dtypes[col] = f.soil_param[var]
 
-    for (y, x), maskval in np.ndenumerate(data['mask']):
-        # advance the row count
-        i += 1
-
-        # put real data
-        for var in c.soil_param:
-            cols = c.soil_param[var]
-            if data[var].ndim == 2:
-                soil_params[i, cols] = data[var][y, x]
-            elif data[var].ndim == 3:
-                for j, col in enumerate(cols):
-                    soil_params[i, col] = data[var][j, y, x]
-
-        # write the grid cell number
-        soil_params[i, 2] = i + 1
+    # write the grid cell number
+    soil_params[:, c.soil_param['gridcell'][0]] = np.arange(1, numcells + 1)
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
@@ -217,46 +283,45 @@ Notes about RASM soil parameter file generations:
     soil_params[:, c.soil_param['phi_s']] = -999
     # ---------------------------------------------------------------- #
 
-    # ---------------------------------------------------------------- #
-    # Write nveg
-    soil_params[:, 0] = data['Nveg'][:, :].flatten()
-    # ---------------------------------------------------------------- #
-
     # ---------------------------------------------------------------- #
     # Set all grid cells to run
-    soil_params[:, 1] = 1  # run
-    soil_params[:, -1] = 1  # run with frozen soils on
-    # ---------------------------------------------------------------- #
-
-    # ---------------------------------------------------------------- #
-    # rewrite the lons/lats columns
-    soil_params[:, 3] = data['lats'].flatten()
-    soil_params[:, 4] = data['lons'].flatten()
-
-    assert soil_params[-1, 3] == data['lats'][y, x]
-    assert soil_params[-1, 4] == data['lons'][y, x]
+    soil_params[:, c.soil_param['run_cell'][0]] = 1  # run
+    soil_params[:, c.soil_param['fs_active'][0]] = 1  # run with frozen soils
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
     # check for nans
     # sometimes RASM has land grid cells that the input file does not.
     # In this case, we will use the previous lnd grid cell
-    if np.isnan(soil_params.sum()):
-        bad_cells = []
-        replacements = []
-        for i, cell in enumerate(soil_params):
-            if np.isnan(np.sum(cell)):
-                bad_cells.append(i)
-                j = i
-                while True:
-                    j -= 1
-                    if (FILL_VALUE not in soil_params[j, :]) and \
-                            not np.isnan(np.sum(soil_params[j, :])):
-                        soil_params[i, 5:] = soil_params[j, 5:]
-                        replacements.append(j)
-                        break
-        print('Fixed {0} bad cells'.format(len(bad_cells)))
-        print('Example: {0}-->{1}'.format(bad_cells[0], replacements[0]))
+    bad = np.isnan(soil_params).any(axis=1)
+    if bad.any():
+        valid = ~bad & ~(soil_params == FILL_VALUE).any(axis=1)
+        # index of the last valid row at or before each row
+        last = np.where(valid, np.arange(numcells), -1)
+        np.maximum.accumulate(last, out=last)
+
+        bad_cells = np.nonzero(bad)[0]
+        replacements = last[bad_cells]
+        # leading bad cells have no previous valid grid cell, use the
+        # nearest valid grid cell instead
+        missing = replacements < 0
+        if missing.any() and valid.any():
+            ry, rx = np.unravel_index(np.nonzero(valid)[0],
+                                      data['mask'].shape)
+            fy, fx = np.unravel_index(bad_cells[missing], data['mask'].shape)
+            inds = _nearest(data, ry, rx, fy, fx)
+            replacements[missing] = np.nonzero(valid)[0][inds]
+        found = replacements >= 0
+        first_col = c.soil_param['infilt'][0]
+        soil_params[bad_cells[found], first_col:] = \
+            soil_params[replacements[found], first_col:]
+        print('Fixed {0} bad cells'.format(np.count_nonzero(found)))
+        if found.any():
+            print('Example: {0}-->{1}'.format(bad_cells[found][0],
+                                              replacements[found][0]))
+        if not found.all():
+            print('{0} bad cells have no valid grid '
+                  'cell'.format(np.count_nonzero(~found)))
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
@@ -271,15 +336,15 @@ Notes about RASM soil parameter file generations:
 
     # ---------------------------------------------------------------- #
     # Finish up
-    assert soil_params[-1, 3] == data['lats'][y, x]
-    assert soil_params[-1, 4] == data['lons'][y, x]
+    assert soil_params[-1, 3] == data['lats'].flat[-1]
+    assert soil_params[-1, 4] == data['lons'].flat[-1]
     # ---------------------------------------------------------------- #
 
     # ---------------------------------------------------------------- #
     # Write the file
     print('writing soil parameter file: {0}'.format(soil_file))
 
-    np.savetxt(soil_file, soil_params, fmt=dtypes)
+    _write_rows(soil_file, ' '.join(dtypes) + '\n', soil_params)
 
     print('done RASM with soil')
     # ---------------------------------------------------------------- #
@@ -288,28 +353,97 @@ Notes about RASM soil parameter file generations:
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def _nearest(data, ry, rx, fy, fx):
+    """Index of the nearest (ry, rx) grid cell to each (fy, fx) grid cell"""
+    combined = np.column_stack((data['yc'][ry, rx], data['xc'][ry, rx]))
+    points = np.column_stack((data['yc'][fy, fx], data['xc'][fy, fx]))
+    mytree = cKDTree(combined)
+    dist, inds = mytree.query(points, k=1)
+    return inds
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class CellTable(object):
+    """
+    Parameters of a set of grid cells gathered into one compact
+    (ncells, ncols) table.  Each variable occupies a block of columns, one
+    per element of its non grid cell dimensions, and is read only once
+    through read(var), which returns a (..., ncells) array.  Masked values
+    are stored as FILL_VALUE.
+    """
+    def __init__(self, ncells, shapes, read):
+        self.ncells = ncells
+        self.shapes = OrderedDict()
+        self.columns = OrderedDict()
+        ncols = 0
+        for var, shape in shapes.items():
+            size = int(np.prod(shape))
+            self.shapes[var] = tuple(shape)
+            self.columns[var] = slice(ncols, ncols + size)
+            ncols += size
+
+        self.table = np.empty((ncells, ncols))
+        for var in self.shapes:
+            values = np.ma.asarray(read(var), dtype=np.float64)
+            values = np.ma.filled(values, FILL_VALUE)
+            self.table[:, self.columns[var]] = \
+                values.reshape(-1, ncells).transpose()
+
+    @classmethod
+    def from_paramset(cls, params, variables):
+        """Read variables lazily from the selected cells of a ParamSet"""
+        shapes = OrderedDict((var, params.cell_shape(var))
+                             for var in variables)
+        return cls(params.ncells, shapes, params.__getitem__)
+
+    @classmethod
+    def from_grids(cls, data, yinds, xinds, variables):
+        """Gather variables from (..., y, x) grids at yinds, xinds"""
+        shapes = OrderedDict((var, np.shape(data[var])[:-2])
+                             for var in variables)
+        return cls(len(yinds), shapes,
+                   lambda var: data[var][..., yinds, xinds])
+
+    def __contains__(self, var):
+        return var in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def values(self, var, cells=slice(None)):
+        """Return the (ncells, ...) values of var for a slice of cells"""
+        data = self.table[cells, self.columns[var]]
+        return data.reshape((len(data), ) + self.shapes[var])
+
+    def __getitem__(self, var):
+        return self.values(var)
+
+    def __setitem__(self, var, data):
+        self.table[:, self.columns[var]] = \
+            np.reshape(data, (self.ncells, -1))
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def soil(data, xinds, yinds, soil_file):
     """Write VIC formatted soil parameter file"""
-    c = grid_params.cols(nlayers=3)
-    f = grid_params.format(nlayers=3)
+    c = grid_params.Cols(nlayers=3)
+    table = CellTable.from_grids(data, yinds, xinds, c.soil_param)
+    write_soil(table, soil_file)
+    return
+# -------------------------------------------------------------------- #
 
-    arrayshape = (len(xinds), 1 + np.max([np.max(c.soil_param[var])
-                                          for var in c.soil_param]))
-    soil_params = np.zeros(arrayshape)
-    dtypes = [0] * arrayshape[1]
 
-    for var in c.soil_param:
-        if data[var].ndim == 2:
-            soil_params[:, c.soil_param[var]] = np.atleast_2d(
-                data[var][yinds, xinds]).transpose()
-        elif data[var].ndim == 3:
-            soil_params[:, c.soil_param[var]] = np.atleast_2d(
-                data[var][:, yinds, xinds]).transpose()
-        for col in c.soil_param[var]:
-            dtypes[col] = f.soil_param[var]
+# -------------------------------------------------------------------- #
+def write_soil(table, soil_file):
+    """Write VIC formatted soil parameter file from a CellTable"""
+    c = grid_params.Cols(nlayers=3)
+    f = grid_params.Format(nlayers=3)
 
-    np.savetxt(soil_file, soil_params, fmt=dtypes)
+    rows, row_fmt = _param_rows(table, c.soil_param, f.soil_param)
+    _write_rows(soil_file, row_fmt, rows)
 
     print('finished writing soil parameter file: {0}'.format(soil_file))
 
@@ -325,25 +459,23 @@ def snow(data, xinds, yinds, snow_file):
     except:
         snow_bands = 5
 
-    c = grid_params.cols(snow_bands=snow_bands)
-    f = grid_params.format(snow_bands=snow_bands)
+    c = grid_params.Cols(snow_bands=snow_bands)
+    table = CellTable.from_grids(data, yinds, xinds, c.snow_param)
+    write_snow(table, snow_file)
+    return
+# -------------------------------------------------------------------- #
+
 
-    arrayshape = (len(xinds), 1 + np.max([np.max(c.snow_param[var])
-                                          for var in c.snow_param]))
-    snow_params = np.zeros(arrayshape)
-    dtypes = [0] * arrayshape[1]
+# -------------------------------------------------------------------- #
+def write_snow(table, snow_file):
+    """Write VIC formatted snowband parameter file from a CellTable"""
+    snow_bands = table.shapes['AreaFract'][0]
 
-    for var in c.snow_param:
-        if data[var].ndim == 2:
-            snow_params[:, c.snow_param[var]] = np.atleast_2d(
-                data[var][yinds, xinds]).transpose()
-        elif data[var].ndim == 3:
-            snow_params[:, c.snow_param[var]] = np.atleast_2d(
-                data[var][:, yinds, xinds]).transpose()
-        for col in c.snow_param[var]:
-            dtypes[col] = f.snow_param[var]
+    c = grid_params.Cols(snow_bands=snow_bands)
+    f = grid_params.Format(snow_bands=snow_bands)
 
-    np.savetxt(snow_file, snow_params, fmt=dtypes)
+    rows, row_fmt = _param_rows(table, c.snow_param, f.snow_param)
+    _write_rows(snow_file, row_fmt, rows)
 
     print('finished writing snow parameter file: {0}'.format(snow_file))
 
@@ -352,43 +484,107 @@ def snow(data, xinds, yinds, snow_file):
 
 
 # -------------------------------------------------------------------- #
-def veg(data, xinds, yinds, veg_file, rootzones=3, global_lai=True):
+def _param_rows(table, cols, fmts, cells=slice(None)):
+    """
+    Rows of a VIC parameter file with the columns (cols) and formats (fmts)
+    of grid_params.Cols and grid_params.Format for a slice of cells.
+    Returns the rows and the printf style row format.
+    """
+    ncells = len(range(*cells.indices(table.ncells)))
+    ncols = 1 + max(np.max(columns) for columns in cols.values())
+    rows = np.zeros((ncells, ncols))
+    dtypes = [0] * ncols
+
+    for var, columns in cols.items():
+        rows[:, columns] = table.values(var, cells).reshape(ncells, -1)
+        for col in columns:
+            dtypes[col] = fmts[var]
+
+    return rows, ' '.join(dtypes) + '\n'
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def veg(data, xinds, yinds, veg_file, rootzones=3, global_lai=True,
+        chunk_cells=10000):
     """Write VIC formatted veg parameter file"""
+    variables = [var for var in VEG_VARS if global_lai or var != 'LAI']
+    table = CellTable.from_grids(data, yinds, xinds, variables)
+    write_veg(table, veg_file, rootzones=rootzones, global_lai=global_lai,
+              chunk_cells=chunk_cells)
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def write_veg(table, veg_file, rootzones=3, global_lai=True,
+              chunk_cells=10000):
+    """
+    Write VIC formatted veg parameter file from a CellTable
+    All active (cell, veg class) pairs are found with a single np.nonzero
+    over Cv and their rows are formatted in bulk, chunk_cells grid cells at a
+    time, and streamed to the file through a large buffer.
+    """
 
     print('writing veg parameter file: {0}'.format(veg_file))
 
+    fmt = grid_params.Format(vegparam_lai=global_lai)
+    header_fmt = _unpadded('{0} {1}\n'.format(fmt.veg_param['gridcell'],
+                                               fmt.veg_param['Nveg']))
+    class_fmt = [fmt.veg_param['veg_class'], fmt.veg_param['Cv']]
+    class_fmt += [fmt.veg_param['root_depth'],
+                  fmt.veg_param['root_fract']] * rootzones
+    class_fmt = _unpadded(' '.join(class_fmt) + '\n')
+    if global_lai:
+        lai_fmt = _unpadded(' '.join([fmt.veg_param['LAI']] *
+                                     MONTHS_PER_YEAR) + '\n')
+    lines_per_class = 2 if global_lai else 1
+
     # counter for bad grid cells
     count = 0
 
-    f = open(veg_file, 'w')
-
-    for y, x in pyzip(yinds, xinds):
-        gridcell = int(data['gridcell'][y, x])
-        n_veg = int(data['Nveg'][y, x])
-        cv = data['Cv'][:, y, x]
-        veg_class = np.nonzero(cv)[0]
-
-        if not len(veg_class) == n_veg:
-            count += 1
-
-        line1 = str(gridcell) + ' ' + str(n_veg) + '\n'
-        f.write(line1)
-        if n_veg > 0:
-            for j in veg_class:
-                line2 = [str(j + 1)]
-                line2.append(str(cv[j]))
-                for k in range(rootzones):
-                    line2.append(str(data['root_depth'][j, k, y, x]))
-                    line2.append(str(data['root_fract'][j, k, y, x]))
-                line2.append('\n')
-                f.write(' '.join(line2))
-                if global_lai:
-                    line3 = []
-                    for m in range(12):
-                        line3.append(str(data['LAI'][j, m, y, x]))
-                    line3.append('\n')
-                    f.write(' '.join(line3))
-    f.close()
+    with open(veg_file, 'w', BUFFER_SIZE) as f:
+        for start in range(0, table.ncells, chunk_cells):
+            cells = slice(start, start + chunk_cells)
+
+            gridcell = table.values('gridcell', cells).astype(int)
+            n_veg = table.values('Nveg', cells).astype(int)
+            cv = table.values('Cv', cells)
+            cv[cv == FILL_VALUE] = 0
+            ncells = len(cv)
+
+            # active (cell, veg class) pairs, ordered by cell and class
+            cell, veg_class = np.nonzero(cv)
+            count += np.count_nonzero(
+                np.bincount(cell, minlength=ncells) != n_veg)
+            active = n_veg[cell] > 0
+            cell = cell[active]
+            veg_class = veg_class[active]
+            npairs = len(cell)
+
+            rows = np.empty((npairs, 2 + 2 * rootzones))
+            rows[:, 0] = veg_class + 1
+            rows[:, 1] = cv[cell, veg_class]
+            rows[:, 2::2] = table.values('root_depth', cells)[
+                cell, veg_class, :rootzones]
+            rows[:, 3::2] = table.values('root_fract', cells)[
+                cell, veg_class, :rootzones]
+
+            # position of each line in the output
+            first = np.zeros(ncells, dtype=int)
+            np.cumsum(np.bincount(cell, minlength=ncells)[:-1],
+                      out=first[1:])
+            lines = np.empty(ncells + npairs * lines_per_class, dtype=object)
+            class_pos = cell + 1 + lines_per_class * np.arange(npairs)
+            lines[np.arange(ncells) + lines_per_class * first] = \
+                _format_rows(header_fmt,
+                             np.column_stack((gridcell, n_veg)))
+            lines[class_pos] = _format_rows(class_fmt, rows)
+            if global_lai:
+                lai = table.values('LAI', cells)[cell, veg_class]
+                lines[class_pos + 1] = _format_rows(lai_fmt, lai)
+
+            f.writelines(lines.tolist())
 
     print('{0} grid cells have unequal veg_classes'.format(count))
     print('finished writing veg parameter file: {0}'.format(veg_file))
@@ -397,6 +593,100 @@ def veg(data, xinds, yinds, veg_file, rootzones=3, global_lai=True):
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def lake(data, xinds, yinds, lake_file):
+    """Write VIC formatted lake parameter file"""
+    table = CellTable.from_grids(data, yinds, xinds, LAKE_VARS)
+    write_lake(table, lake_file)
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def write_lake(table, lake_file):
+    """
+    Write VIC formatted lake parameter file from a CellTable
+    Each grid cell has a line with gridcell, lake_idx, numnod, mindepth,
+    wfrac, depth_in and rpercent.  Grid cells with a lake (lake_idx >= 0)
+    have a second line with numnod pairs of basin depth and area.
+    """
+    print('writing lake parameter file: {0}'.format(lake_file))
+
+    fmt = grid_params.Format(lakes=True).lake_param
+    header_vars = ['gridcell', 'lake_idx', 'numnod', 'mindepth', 'wfrac',
+                   'depth_in', 'rpercent']
+    header_fmt = _unpadded(' '.join(fmt[var] for var in header_vars) + '\n')
+    node_fmt = _unpadded(fmt['basin_depth'] + ' ' + fmt['basin_area'])
+
+    header = np.column_stack([table[var] for var in header_vars])
+    lake_idx = table['lake_idx'].astype(int)
+    depth = table['basin_depth'].reshape(table.ncells, -1)
+    area = table['basin_area'].reshape(table.ncells, -1)
+    nodes = np.clip(table['numnod'].astype(int), 1, depth.shape[1])
+
+    # position of each line in the output
+    has_lake = lake_idx >= 0
+    first = np.zeros(table.ncells, dtype=int)
+    np.cumsum(1 + has_lake[:-1], out=first[1:])
+    lines = np.empty(table.ncells + np.count_nonzero(has_lake),
+                     dtype=object)
+    lines[first] = _format_rows(header_fmt, header)
+
+    # depth-area lines, grouped by their number of nodes
+    for n in np.unique(nodes[has_lake]):
+        cells = np.nonzero(has_lake & (nodes == n))[0]
+        pairs = np.empty((len(cells), 2 * n))
+        pairs[:, 0::2] = depth[cells, :n]
+        pairs[:, 1::2] = area[cells, :n]
+        lines[first[cells] + 1] = _format_rows(
+            ' '.join([node_fmt] * n) + '\n', pairs)
+
+    with open(lake_file, 'w', BUFFER_SIZE) as f:
+        f.writelines(lines.tolist())
+
+    print('finished writing lake parameter file: {0}'.format(lake_file))
+
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _unpadded(fmt):
+    """Remove the field widths of a printf style format"""
+    return re.sub(r'%\d+', '%', fmt)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _format_block(row_fmt, rows):
+    """
+    Format the rows of a 2d array with a printf style row format ending in
+    a newline.  The whole array is formatted in a single operation.
+    """
+    rows = np.ma.filled(rows, FILL_VALUE)
+    if not len(rows):
+        return ''
+    return (row_fmt * len(rows)) % tuple(rows.ravel().tolist())
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _format_rows(row_fmt, rows):
+    """Like _format_block but returns a list with one string per row"""
+    return _format_block(row_fmt, rows).splitlines(True)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _write_rows(out_file, row_fmt, rows, chunk_rows=10000):
+    """Format the rows of a 2d array in blocks and write them to out_file"""
+    with open(out_file, 'w', BUFFER_SIZE) as f:
+        for start in range(0, len(rows), chunk_rows):
+            f.write(_format_block(row_fmt, rows[start:start + chunk_rows]))
+    return
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 def veg_lib():
     raise
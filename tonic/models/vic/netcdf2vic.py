@@ -2,65 +2,167 @@
 """netcdf2vic.py"""
 
 from __future__ import print_function
+import re
 import numpy as np
 import struct
 import os
-from tonic.io import read_netcdf, read_config
-from tonic.pycompat import pyzip
+import time as tm
+from netCDF4 import Dataset, date2num, num2date, default_fillvals
+from concurrent.futures import ProcessPoolExecutor
+from tonic.io import read_netcdf, read_configobj
+from tonic.tonic import GridIndex
+from tonic.pycompat import OrderedDict, basestring, pyzip
 
 description = 'Convert netCDF meteorological forcings to VIC sytle format'
 help = 'Convert netCDF meteorological forcings to VIC sytle format'
 
+# numpy types of the standard size struct format codes
+STRUCT_CODES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4',
+                'I': 'u4', 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8',
+                'e': 'f2', 'f': 'f4', 'd': 'f8', '?': 'b1'}
+BYTE_ORDERS = {'=': '=', '<': '<', '>': '>', '!': '>'}
+_binary_dtypes = {}
+
+# units of the VIC 5 image driver forcings
+IMAGE_UNITS = OrderedDict([('air_temp', 'C'), ('prec', 'mm'),
+                           ('pressure', 'kPa'), ('swdown', 'W m-2'),
+                           ('lwdown', 'W m-2'), ('vp', 'kPa'),
+                           ('wind', 'm s-1')])
+IMAGE_FILL = default_fillvals['f4']
+UNIT_ALIASES = {'k': 'K', 'degk': 'K', 'kelvin': 'K', 'c': 'C', 'degc': 'C',
+                'celsius': 'C', 'degrees_celsius': 'C', 'pa': 'Pa',
+                'hpa': 'hPa', 'mb': 'hPa', 'kpa': 'kPa', 'mm': 'mm',
+                'kg m-2': 'mm', 'kg/m2': 'mm', 'mm s-1': 'mm s-1',
+                'mm/s': 'mm s-1', 'kg m-2 s-1': 'mm s-1',
+                'kg/m2/s': 'mm s-1', 'w m-2': 'W m-2', 'w/m2': 'W m-2',
+                'm s-1': 'm s-1', 'm/s': 'm s-1'}
+# (scale, offset) between units, a scale of None is the timestep in seconds
+UNIT_CONVERSIONS = {('K', 'C'): (1., -273.15), ('C', 'K'): (1., 273.15),
+                    ('Pa', 'kPa'): (1e-3, 0.), ('hPa', 'kPa'): (0.1, 0.),
+                    ('mm s-1', 'mm'): (None, 0.)}
+
 
 # -------------------------------------------------------------------- #
 # top level run function
 def _run(args):
 
-    config = read_config(args.config)
-    files = config['options']['files']
-    var_keys = config['options']['var_keys']
-    output = config['options']['output']
-    binary_mult = config['options']['binary_mult']
-    binary_type = config['options']['binary_type'],
-    paths = config['options']['paths']
-    out_prefix = config['options']['out_prefix']
-    verbose = config['options']['verbose']
-
-    mask = read_netcdf(paths['mask_path'], nc_vars=['mask'])['mask']
+    config = read_configobj(args.config)
+    options = config['options']
+    output = options['output']
+    paths = options['paths']
+
+    if output['ASCII']:
+        ascii_path = paths['ASCIIoutPath']
+    else:
+        ascii_path = None
+    if output['Binary']:
+        binary_path = paths['BinaryoutPath']
+    else:
+        binary_path = None
+
+    if output.get('Image', False):
+        convert_image(options['files'], options['image'], paths['mask_path'],
+                      paths['ImageoutPath'],
+                      in_path=paths['in_path'],
+                      out_prefix=options['out_prefix'],
+                      time_chunk=options.get('time_chunk', 1000),
+                      verbose=options.get('verbose', False))
+    if not (ascii_path or binary_path):
+        return
+
+    convert(options['files'], options['var_keys'], paths['mask_path'],
+            in_path=paths['in_path'],
+            out_prefix=options['out_prefix'],
+            ascii_path=ascii_path,
+            binary_path=binary_path,
+            binary_mult=options.get('binary_mult', None),
+            binary_type=options.get('binary_type', None),
+            stream=options.get('stream', False),
+            time_chunk=options.get('time_chunk', 1000),
+            tile_size=options.get('tile_size', 16),
+            max_open_files=options.get('max_open_files', 512),
+            num_workers=options.get('num_workers', 1),
+            verbose=options.get('verbose', False))
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def convert(files, var_keys, mask_file, in_path='', out_prefix='data_',
+            ascii_path=None, binary_path=None, binary_mult=None,
+            binary_type=None, stream=False, time_chunk=1000, tile_size=16,
+            max_open_files=512, num_workers=1, verbose=False):
+    """
+    Convert gridded netCDF forcings (files, a continuous timeseries) to VIC
+    per grid cell ASCII (if ascii_path) and/or binary (if binary_path)
+    forcing files for the active cells of the mask in mask_file.  The
+    active cells are cached in the output directory (if any) for later runs.
+
+    If stream is True, the forcings are read in blocks of time_chunk
+    timesteps for spatial tiles of tile_size x tile_size grid cells and
+    appended to the per cell files through a pool of at most max_open_files
+    open files.  Keep tile_size**2 <= max_open_files so that the files of a
+    tile stay open while it is written.
+
+    If num_workers > 1, the forcings are streamed by a pool of processes.
+    The active cells are partitioned, by whole tiles, across the workers.
+    Each worker reads its spatial subset of every input file and owns the
+    files of its cells (with a pool of max_open_files) for the whole run.
+    """
+    if isinstance(files, basestring):
+        files = [files]
+    if isinstance(var_keys, basestring):
+        var_keys = [var_keys]
+    in_files = [os.path.join(in_path, fname) for fname in files]
+
+    mask = read_netcdf(mask_file, variables=['mask'],
+                       verbose=verbose)[0]['mask']
     yi, xi = np.nonzero(mask)
     print('found {0} points in mask file.'.format(len(yi)))
 
-    xlist = []
-    ylist = []
-    pointlist = []
-    append = False
+    # the active cells are cached alongside the output (if any)
+    out_dir = ascii_path or binary_path
+    if out_dir:
+        cache_file = os.path.join(out_dir,
+                                  '.{0}active_cells.npz'.format(out_prefix))
+    else:
+        cache_file = None
+    ylist, xlist, pointlist = find_active_cells(in_files[0], mask, var_keys,
+                                                cache_file=cache_file,
+                                                time_chunk=time_chunk,
+                                                verbose=verbose)
 
-    for i, fname in enumerate(files):
-        d = read_netcdf(os.path.join(paths['in_path'], fname),
-                        verbose=verbose)
-
-        if i == 0:
-
-            # find point locations
-            xs = d['xc']
-            ys = d['yc']
-            posinds = np.nonzero(xs > 180)
-            xs[posinds] -= 360
-            print('adjusted xs lon minimum')
-
-            for y, x in pyzip(yi, xi):
-                active_flag = False
-                for key in var_keys:
-                    if (d[key][:, y, x].all() is np.ma.masked) \
-                            or (mask[y, x] == 0):
-                        active_flag = True
-                if not active_flag:
-                    point = (ys[y, x], xs[y, x])
-                    xlist.append(x)
-                    ylist.append(y)
-                    pointlist.append(point)
+    if stream or num_workers > 1:
+        targets = []
+        if ascii_path:
+            targets.append((ascii_path, False, format_ascii, ()))
+        if binary_path:
+            targets.append((binary_path, True, pack_binary,
+                            (binary_type, binary_mult)))
+        kwargs = dict(time_chunk=time_chunk, tile_size=tile_size,
+                      max_open_files=max_open_files, verbose=verbose)
 
+        if num_workers > 1:
+            parts = partition_cells(ylist, xlist, tile_size, num_workers)
+            print('streaming {0} cells with {1} workers'.format(len(ylist),
+                                                                len(parts)))
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = [pool.submit(stream_cells, in_files, var_keys,
+                                       ylist[part], xlist[part],
+                                       [pointlist[i] for i in part],
+                                       targets, out_prefix, **kwargs)
+                           for part in parts]
+                for future in futures:
+                    future.result()
         else:
+            stream_cells(in_files, var_keys, ylist, xlist, pointlist,
+                         targets, out_prefix, **kwargs)
+        return
+
+    append = False
+    for i, fname in enumerate(in_files):
+        d = read_netcdf(fname, variables=var_keys, verbose=verbose)[0]
+        if i > 0:
             append = True
 
         for y, x, point in pyzip(ylist, xlist, pointlist):
@@ -70,24 +172,310 @@ def _run(args):
             for j, key in enumerate(var_keys):
                 data[:, j] = d[key][:, y, x]
 
-            if output['Binary']:
+            if binary_path:
                 write_binary(data * binary_mult, point, binary_type,
-                             out_prefix, paths['BinaryoutPath'], append)
-            if output['ASCII']:
-                write_ascii(data, point, out_prefix, paths['ASCIIoutPath'],
-                            append)
+                             out_prefix, binary_path, append)
+            if ascii_path:
+                write_ascii(data, point, out_prefix, ascii_path, append)
     return
 # -------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------- #
+def find_active_cells(nc_file, mask, var_keys, cache_file=None,
+                      time_chunk=1000, verbose=False):
+    """
+    Find the cells of the mask that have data for all var_keys in nc_file.
+    A cell is inactive if the values of any of the var_keys are masked at
+    all timesteps.  Returns arrays of the y and x indices and a list of the
+    (lat, lon) points.  If cache_file is given, the result is stored there
+    and reused as long as the mask, var_keys and nc_file do not change.
+    """
+    mask = np.ma.filled(mask, 0)
+    stat = os.stat(nc_file)
+    meta = np.array([os.path.abspath(nc_file), str(stat.st_size),
+                     repr(stat.st_mtime)] + list(var_keys))
+
+    if cache_file and os.path.isfile(cache_file):
+        with np.load(cache_file) as cache:
+            if (np.array_equal(cache['meta'], meta) and
+                    np.array_equal(cache['mask'], mask)):
+                if verbose:
+                    print('read active cells from {0}'.format(cache_file))
+                ylist = cache['ylist']
+                xlist = cache['xlist']
+                pointlist = list(pyzip(cache['lats'], cache['lons']))
+                return ylist, xlist, pointlist
+
+    f = Dataset(nc_file, 'r')
+
+    # find point locations
+    xs = f.variables['xc'][:]
+    ys = f.variables['yc'][:]
+    if xs.ndim == 1:
+        xs, ys = np.meshgrid(xs, ys)
+    posinds = np.nonzero(xs > 180)
+    xs[posinds] -= 360
+    print('adjusted xs lon minimum')
+
+    inactive = mask == 0
+    for key in var_keys:
+        v = f.variables[key]
+        all_masked = np.ones(mask.shape, dtype=bool)
+        for t0 in range(0, v.shape[0], time_chunk):
+            data = v[t0:t0 + time_chunk]
+            all_masked &= np.ma.getmaskarray(data).all(axis=0)
+        inactive |= all_masked
+    f.close()
+
+    ylist, xlist = np.nonzero(~inactive)
+    lats = np.ma.getdata(ys)[ylist, xlist]
+    lons = np.ma.getdata(xs)[ylist, xlist]
+    print('found {0} active cells'.format(len(ylist)))
+
+    if cache_file:
+        np.savez(cache_file, meta=meta, mask=mask, ylist=ylist, xlist=xlist,
+                 lats=lats, lons=lons)
+
+    return ylist, xlist, list(pyzip(lats, lons))
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class HandlePool(object):
+    """
+    Bounded pool of open output files.  Files are opened for writing the
+    first time they are requested and reopened for appending after they
+    have been closed to make room for other files (least recently used
+    first).
+    """
+    def __init__(self, max_open=512):
+        self.max_open = max(int(max_open), 1)
+        self.handles = OrderedDict()
+        self.opened = set()
+
+    def get(self, path, binary=False):
+        """Return an open file handle for path"""
+        try:
+            f = self.handles.pop(path)
+        except KeyError:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            if path in self.opened:
+                mode = 'a'
+            else:
+                mode = 'w'
+                self.opened.add(path)
+            if binary:
+                mode += 'b'
+            f = open(path, mode)
+        self.handles[path] = f
+        return f
+
+    def close(self):
+        """Close all open files"""
+        while self.handles:
+            self.handles.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def stream_cells(in_files, var_keys, ylist, xlist, pointlist, targets,
+                 out_prefix, time_chunk=1000, tile_size=16,
+                 max_open_files=512, verbose=False):
+    """
+    Append the forcings of the cells at ylist, xlist to their per cell
+    files.  Each input file is read in blocks of time_chunk timesteps for
+    one spatial tile of tile_size x tile_size cells at a time; each block is
+    transposed to cell major order once and appended to the cell files.
+    targets is a list of (path, binary, encode, encode_args) tuples, where
+    encode(array, *encode_args) returns the text or bytes of a
+    (time, variable) array.
+    """
+    ylist = np.asarray(ylist, dtype=int)
+    xlist = np.asarray(xlist, dtype=int)
+    nvars = len(var_keys)
+
+    out_files = [[_out_file(path, out_prefix, point)
+                  for point in pointlist] for path, _, _, _ in targets]
+
+    tiles = _tiles(ylist, xlist, tile_size)
+
+    with HandlePool(max_open_files) as handles:
+        for fname in in_files:
+            if verbose:
+                print('streaming {0} tiles from {1}'.format(len(tiles),
+                                                            fname))
+            f = Dataset(fname, 'r')
+            ntime = f.variables[var_keys[0]].shape[0]
+
+            for cells in tiles:
+                ys = ylist[cells]
+                xs = xlist[cells]
+                window = (slice(ys.min(), ys.max() + 1),
+                          slice(xs.min(), xs.max() + 1))
+                iy = ys - ys.min()
+                ix = xs - xs.min()
+
+                for t0 in range(0, ntime, time_chunk):
+                    t1 = min(t0 + time_chunk, ntime)
+                    block = np.empty((nvars, t1 - t0, len(cells)))
+                    for j, key in enumerate(var_keys):
+                        data = f.variables[key][(slice(t0, t1), ) + window]
+                        block[j] = np.ma.getdata(data)[:, iy, ix]
+
+                    # cell major (cell, time, variable) order
+                    block = np.ascontiguousarray(block.transpose(2, 1, 0))
+
+                    for i, (path, binary, encode, args) in \
+                            enumerate(targets):
+                        for k, cell in enumerate(cells):
+                            handles.get(out_files[i][cell], binary).write(
+                                encode(block[k], *args))
+            f.close()
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _tiles(ylist, xlist, tile_size):
+    """Group cell indices by spatial tile of tile_size x tile_size cells"""
+    if not len(ylist):
+        return []
+    tile = (ylist // tile_size) * (xlist.max() // tile_size + 1) + \
+        xlist // tile_size
+    order = np.argsort(tile, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(tile[order])) + 1
+    return np.split(order, bounds)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def partition_cells(ylist, xlist, tile_size, num_workers):
+    """
+    Partition the cells into at most num_workers groups of whole spatial
+    tiles with similar numbers of cells.  Returns a list of cell index
+    arrays.
+    """
+    tiles = _tiles(ylist, xlist, tile_size)
+    if not tiles:
+        return []
+    counts = np.cumsum([len(tile) for tile in tiles])
+    edges = np.searchsorted(counts, counts[-1] * np.arange(1, num_workers) /
+                            float(num_workers))
+    parts = [np.concatenate(tiles[start:end]) for start, end in
+             pyzip(np.r_[0, edges], np.r_[edges, len(tiles)]) if end > start]
+    return parts
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _out_file(path, out_prefix, point):
+    """Name of the forcing file of a (lat, lon) point"""
+    fname = out_prefix + ('%.3f' % point[0]) + '_' + ('%.3f' % point[1])
+    return os.path.join(path, fname)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def format_ascii(array):
+    """Format a (time, variable) array as VIC ASCII forcing text"""
+    row_fmt = ' '.join(['%12.7g'] * array.shape[1]) + '\n'
+    return (row_fmt * len(array)) % tuple(array.ravel().tolist())
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def pack_binary(array, binary_type, binary_mult=1):
+    """
+    Pack a (time, variable) array in the VIC binary forcing format.
+    The scaled array is cast (truncating, like struct) to a structured
+    dtype with the layout of the struct format binary_type.
+    """
+    dtype = binary_dtype(binary_type)
+    array = np.asarray(array, dtype=np.float64) * binary_mult
+    if array.ndim != 2 or array.shape[1] != len(dtype.names):
+        raise ValueError('binary_type {0} does not match the {1} forcing '
+                         'variables'.format(binary_type, array.shape[-1]))
+
+    # zeros, like struct, in any padding bytes
+    out = np.zeros(len(array), dtype=dtype)
+    for i, name in enumerate(dtype.names):
+        field = dtype.fields[name][0]
+        if field.kind in 'iub':
+            if not np.isfinite(array[:, i]).all():
+                raise ValueError('forcing values of column {0} are not '
+                                 'finite, can not cast to binary type '
+                                 '{1}'.format(i, field))
+        if field.kind in 'iu' and array.shape[0]:
+            info = np.iinfo(field)
+            if (array[:, i].min() < info.min or
+                    array[:, i].max() > info.max):
+                raise ValueError('forcing values of column {0} do not fit '
+                                 'in binary type {1}'.format(i, field))
+        out[name] = array[:, i]
+    return out.tobytes()
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def binary_dtype(binary_type):
+    """Structured numpy dtype with the layout of a struct format"""
+    try:
+        return _binary_dtypes[binary_type]
+    except KeyError:
+        pass
+
+    fmt = binary_type.strip()
+    if fmt[:1] in '@=<>!':
+        order, fmt = fmt[0], fmt[1:]
+    else:
+        order = '@'
+
+    codes = []
+    for count, code in re.findall(r'\s*(\d*)\s*(\S)', fmt):
+        if code not in STRUCT_CODES:
+            raise ValueError('unsupported binary_type code: {0}'.format(code))
+        codes.extend([code] * int(count or 1))
+
+    # the offsets (and native alignment) are those of struct, which adds no
+    # trailing padding
+    names, formats, offsets = [], [], []
+    for i, code in enumerate(codes):
+        names.append('f{0}'.format(i))
+        if order == '@':
+            # native size
+            formats.append(np.dtype(code))
+        else:
+            formats.append(np.dtype(BYTE_ORDERS[order] + STRUCT_CODES[code]))
+        size = struct.calcsize(order + code)
+        if formats[-1].itemsize != size:
+            raise ValueError('binary_type {0} can not be represented as a '
+                             'numpy dtype'.format(binary_type))
+        offsets.append(struct.calcsize(order + ''.join(codes[:i + 1])) -
+                       size)
+    dtype = np.dtype({'names': names, 'formats': formats,
+                      'offsets': offsets,
+                      'itemsize': struct.calcsize(binary_type)})
+
+    _binary_dtypes[binary_type] = dtype
+    return dtype
+# -------------------------------------------------------------------- #
+
+
 # -------------------------------------------------------------------- #
 # Write ASCII
 def write_ascii(array, point, out_prefix, path, append, verbose=False):
     """
     Write an array to standard VIC ASCII output.
     """
-    fname = out_prefix + ('%1.3f' % point[0]) + '_' + ('%1.3f' % point[1])
-    out_file = os.path.join(path, fname)
+    out_file = _out_file(path, out_prefix, point)
     if append:
         f = open(out_file, 'a')
     else:
@@ -108,18 +496,213 @@ def write_binary(array, point, binary_type, out_prefix, path, append,
     """
     Write a given array to standard binary short int format.
     """
-    fname = out_prefix + ('%.3f' % point[0]) + '_' + ('%.3f' % point[1])
-    out_file = os.path.join(path, fname)
+    out_file = _out_file(path, out_prefix, point)
     if verbose:
         print('Writing Binary Data to'.format(out_file))
     if append:
-        f = open(out_file, 'a')
+        f = open(out_file, 'ab')
     else:
-        f = open(out_file, 'w')
+        f = open(out_file, 'wb')
 
-    for row in array:
-        data = struct.pack(binary_type, *row)
-        f.write(data)
+    f.write(pack_binary(array, binary_type))
     f.close()
     return
 # -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def convert_image(files, variables, domain_file, out_path, in_path='',
+                  out_prefix='forcings_', units=None, time_chunk=1000,
+                  verbose=False):
+    """
+    Remap gridded netCDF forcings (files, a continuous timeseries) to the
+    grid of a VIC 5 domain file and write them as yearly image driver
+    forcing files ({out_prefix}{year}.nc in out_path).
+
+    variables maps the VIC forcing names to the variable names in files.
+    The data are converted to IMAGE_UNITS from the units attribute of the
+    input variables (or units[name] if given).  Each input file is read
+    once, in blocks of time_chunk timesteps, and each active cell of the
+    domain mask is mapped to its nearest source cell.
+    """
+    if isinstance(files, basestring):
+        files = [files]
+    in_files = [os.path.join(in_path, fname) for fname in files]
+    units = units or {}
+
+    # target grid
+    with Dataset(domain_file, 'r') as f:
+        mask = np.ma.filled(f.variables['mask'][:], 0)
+        dims = f.variables['mask'].dimensions
+        coords = OrderedDict((name, (f.variables[name].dimensions,
+                                     f.variables[name][:],
+                                     f.variables[name].__dict__))
+                             for name in _lat_lon_names(f))
+    dlats, dlons = [np.asarray(c[1], dtype=np.float64)
+                    for c in coords.values()]
+    if dlats.ndim == 1:
+        dlons, dlats = np.meshgrid(dlons, dlats)
+    yi, xi = np.nonzero(mask)
+    print('found {0} points in domain file.'.format(len(yi)))
+
+    # source grid, times and units
+    dates = []
+    for i, fname in enumerate(in_files):
+        with Dataset(fname, 'r') as f:
+            time = f.variables['time']
+            if i == 0:
+                time_units = time.units
+                calendar = getattr(time, 'calendar', 'standard')
+                slats, slons = [np.asarray(f.variables[name][:],
+                                           dtype=np.float64)
+                                for name in _lat_lon_names(f)]
+                in_units = dict((name, units.get(name, getattr(
+                    f.variables[in_name], 'units', None)))
+                    for name, in_name in variables.items())
+            dates.append(num2date(time[:], time.units, calendar=calendar))
+    all_dates = np.concatenate(dates)
+    years = np.array([d.year for d in all_dates])
+    if len(all_dates) > 1:
+        timestep = (all_dates[1] - all_dates[0]).total_seconds()
+    else:
+        timestep = None
+
+    if (slons.max() > 180) and (dlons.min() < 0):
+        slons = np.where(slons > 180, slons - 360, slons)
+        print('adjusted forcing lon minimum')
+
+    conversions = OrderedDict()
+    for name in variables:
+        if in_units[name] is None:
+            print('no units for {0}, writing it unchanged'.format(name))
+            conversions[name] = (1., 0.)
+        else:
+            conversions[name] = unit_conversion(
+                in_units[name], IMAGE_UNITS.get(name, in_units[name]),
+                timestep=timestep)
+
+    sy, sx = GridIndex(slats, slons).query(dlats[yi, xi], dlons[yi, xi])
+    # only read the window of the source grid that covers the domain
+    window = (slice(sy.min(), sy.max() + 1), slice(sx.min(), sx.max() + 1))
+    sy -= sy.min()
+    sx -= sx.min()
+
+    year_files = {}
+    step = 0
+    try:
+        for fname, fdates in pyzip(in_files, dates):
+            if verbose:
+                print('streaming {0}'.format(fname))
+            with Dataset(fname, 'r') as f:
+                for t0 in range(0, len(fdates), time_chunk):
+                    t1 = min(t0 + time_chunk, len(fdates))
+                    block = OrderedDict()
+                    for name, in_name in variables.items():
+                        data = f.variables[in_name][(slice(t0, t1), ) + window]
+                        scale, offset = conversions[name]
+                        data = (data[:, sy, sx].astype(np.float32) * scale +
+                                offset)
+                        block[name] = np.full((t1 - t0, ) + mask.shape,
+                                              IMAGE_FILL, dtype=np.float32)
+                        block[name][:, yi, xi] = np.ma.filled(data, IMAGE_FILL)
+
+                    # split the block at the year boundaries
+                    block_years = years[step:step + t1 - t0]
+                    for year in np.unique(block_years):
+                        inds = np.nonzero(block_years == year)[0]
+                        if year not in year_files:
+                            out_file = os.path.join(
+                                out_path, '{0}{1}.nc'.format(out_prefix, year))
+                            year_files[year] = [_image_file(
+                                out_file, (years == year).sum(), dims, coords,
+                                variables, time_units, calendar), 0]
+                        out, start = year_files[year]
+                        end = start + len(inds)
+                        out.variables['time'][start:end] = date2num(
+                            [fdates[t0 + i] for i in inds], time_units,
+                            calendar=calendar)
+                        for name, data in block.items():
+                            out.variables[name][start:end] = data[inds]
+                        year_files[year][1] = end
+                        if end == len(out.dimensions['time']):
+                            if verbose:
+                                print('finished {0}'.format(out.filepath()))
+                            out.close()
+                    step += t1 - t0
+    finally:
+        # close the files of years that were not completed
+        for out, _ in year_files.values():
+            if out.isopen():
+                out.close()
+    return
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _lat_lon_names(f):
+    """Names of the latitude and longitude variables of an open netCDF"""
+    for names in [('lat', 'lon'), ('yc', 'xc')]:
+        if all(name in f.variables for name in names):
+            return names
+    raise ValueError('no lat/lon or yc/xc variables in {0}'.format(
+        f.filepath()))
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _image_file(out_file, ntime, dims, coords, variables, time_units,
+                calendar):
+    """Create one (yearly) image driver forcing file"""
+    f = Dataset(out_file, 'w', format='NETCDF4')
+    f.history = 'Created: {0} by netcdf2vic'.format(tm.ctime(tm.time()))
+
+    f.createDimension('time', ntime)
+    for name, (cdims, data, attrs) in coords.items():
+        for dim, size in pyzip(cdims, data.shape):
+            if dim not in f.dimensions:
+                f.createDimension(dim, size)
+    shape = tuple(len(f.dimensions[dim]) for dim in dims)
+
+    time = f.createVariable('time', 'f8', ('time', ))
+    time.units = time_units
+    time.calendar = calendar
+    for name, (cdims, data, attrs) in coords.items():
+        var = f.createVariable(name, data.dtype, cdims)
+        var.setncatts(dict((k, v) for k, v in attrs.items()
+                           if k != '_FillValue'))
+        var[:] = data
+
+    # one chunk per timestep, which is how the image driver reads them
+    for name in variables:
+        var = f.createVariable(name, 'f4', ('time', ) + tuple(dims),
+                               fill_value=IMAGE_FILL, zlib=True,
+                               chunksizes=(1, ) + shape)
+        if name in IMAGE_UNITS:
+            var.units = IMAGE_UNITS[name]
+    return f
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def unit_conversion(in_units, out_units, timestep=None):
+    """
+    Return the (scale, offset) that converts data from in_units to
+    out_units.  Rates per second are converted to totals per timestep
+    (in seconds).
+    """
+    in_units = UNIT_ALIASES.get(in_units.strip().lower(), in_units)
+    out_units = UNIT_ALIASES.get(out_units.strip().lower(), out_units)
+    if in_units == out_units:
+        return 1., 0.
+    try:
+        scale, offset = UNIT_CONVERSIONS[(in_units, out_units)]
+    except KeyError:
+        raise ValueError('no conversion from {0} to {1}'.format(in_units,
+                                                              out_units))
+    if scale is None:
+        if timestep is None:
+            raise ValueError('converting {0} to {1} requires the '
+                             'timestep'.format(in_units, out_units))
+        scale = timestep
+    return scale, offset
+# -------------------------------------------------------------------- #
@@ -5,14 +5,37 @@ vic.py
 
 from __future__ import print_function
 import os
+import re
+import json
+import time
+import signal
 import tempfile
+import threading
 import subprocess
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import numpy as np
 import pandas as pd
+from tonic.pycompat import OrderedDict, PY3
 
 default_vic_valgrind_error_code = 125
 default_vic_valgrind_suppressions_path = 'vic_valgrind_suppressions.supp'
 
+# seconds between progress polls of a running VIC
+POLL_INTERVAL = 1.
+# simulated dates in VIC's output (e.g. 1949-01-01)
+DATE_PATTERN = r'(\d{4})-(\d{2})-(\d{2})'
+# time columns of VIC ASCII output
+TIME_COLS = ['YEAR', 'MONTH', 'DAY', 'HOUR']
+# version and options of VIC executables by path, see VIC._probe
+_probe_cache = {}
+if PY3:
+    NEW_SESSION = {'start_new_session': True}
+else:  # pragma: no cover
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
 
 # -------------------------------------------------------------------- #
 class VICRuntimeError(RuntimeError):
@@ -22,17 +45,57 @@ class VICRuntimeError(RuntimeError):
 
 # -------------------------------------------------------------------- #
 class VIC(object):
+    """
+    A VIC executable.
 
-    def __init__(self, executable):
+    The version and compile time options of the executable are probed once
+    per executable (and again when it changes) and cached in memory, and
+    in the JSON file cache_file (default: the VIC_PROBE_CACHE environment
+    variable) if given.
+    """
+
+    def __init__(self, executable, cache_file=None):
         if os.path.isfile(executable) and os.access(executable, os.X_OK):
             self.executable = executable
-            self.version = self._get_version()
-            self.options = self._get_options()
             self.args = []
             self.argstring = ''
+            if cache_file is None:
+                cache_file = os.getenv('VIC_PROBE_CACHE')
+            self.version, self.options = self._probe(cache_file)
         else:
             raise VICRuntimeError('%s is not a valid executable' % executable)
 
+    def _probe(self, cache_file=None):
+        """
+        Return the version and options of the executable, from the cache if
+        the executable (by path, mtime, inode and size) has not changed.
+        """
+        path = os.path.realpath(self.executable)
+        st = os.stat(path)
+        key = [st.st_mtime, st.st_ino, st.st_size]
+
+        entry = _probe_cache.get(path)
+        if (entry is None or entry['key'] != key) and cache_file:
+            entry = _read_probe_cache(cache_file).get(path)
+            if entry is not None:
+                entry = {'key': entry['key'],
+                         'version': entry['version'].encode('latin-1'),
+                         'options': entry['options'].encode('latin-1')}
+        if entry is not None and entry['key'] == key:
+            _probe_cache[path] = entry
+            return entry['version'], entry['options']
+
+        entry = {'key': key, 'version': self._get_version(),
+                 'options': self._get_options()}
+        _probe_cache[path] = entry
+        if cache_file:
+            entries = _read_probe_cache(cache_file)
+            entries[path] = {'key': key,
+                             'version': entry['version'].decode('latin-1'),
+                             'options': entry['options'].decode('latin-1')}
+            _write_probe_cache(cache_file, entries)
+        return entry['version'], entry['options']
+
     def _get_version(self):
         """Get the version of VIC from the executable"""
         self._call_vic('-v')
@@ -43,7 +106,8 @@ class VIC(object):
         self._call_vic('-o')
         return self.stdout
 
-    def run(self, global_param, logdir=None, **kwargs):
+    def run(self, global_param, logdir=None, progress=None, tail_lines=1000,
+            **kwargs):
         """
         Run VIC with specified global parameter file.
 
@@ -53,7 +117,16 @@ class VIC(object):
             Either a path to a VIC global parameter file or a multiline string
             including VIC global parameter options.
         logdir : str, optional
-            Path to write log files to.
+            Path to write log files to.  The output of VIC is written to the
+            log files as it arrives.
+        progress : callable, optional
+            Called with each line (bytes) of VIC's stdout and stderr, e.g. a
+            `VICProgress`.  If it has a poll method, that is called about
+            once a second while VIC runs and VIC is terminated if it returns
+            True.
+        tail_lines : int, optional
+            Number of the last lines of stdout and stderr kept in the stdout
+            and stderr attributes.  Default is 1000, None keeps all lines.
         **kwargs : key=value, optional
             Keyword arguments to pass to the VIC executable. Valid options are:
                 mpi_proc : int
@@ -74,35 +147,33 @@ class VIC(object):
 
         """
 
-        if os.path.isfile(global_param):
-            global_param_file = global_param
-        else:
-            # global_param is a string
-            f, global_param_file = tempfile.mkstemp(prefix='vic.global.param.',
-                                                    suffix='.txt',
-                                                    text=True)
-            with open(global_param_file, mode='w') as f:
-                f.write(global_param)
-
-        self._call_vic('-g', global_param_file, **kwargs)
+        global_param_file, temporary = _global_param_file(global_param)
 
+        log_files = (None, None)
         if logdir:
             now = datetime.now()
             seconds = (now - now.replace(hour=0, minute=0, second=0,
                                          microsecond=0)).total_seconds()
             timestr = "%s_%05.f" % (now.strftime("%Y%m%d"), seconds)
-            with open(os.path.join(logdir, 'stdout_{0}.txt'.format(timestr)),
-                      mode='wb') as f:
-                f.write(self.stdout)
-            with open(os.path.join(logdir, 'stderr_{0}.txt'.format(timestr)),
-                      mode='wb') as f:
-                f.write(self.stderr)
+            log_files = (
+                os.path.join(logdir, 'stdout_{0}.txt'.format(timestr)),
+                os.path.join(logdir, 'stderr_{0}.txt'.format(timestr)))
 
-        return self.returncode
+        try:
+            self._call_vic('-g', global_param_file, log_files=log_files,
+                           progress=progress, tail_lines=tail_lines, **kwargs)
+        finally:
+            if temporary:
+                os.remove(global_param_file)
 
-    def _call_vic(self, *args, **kwargs):
+        return self.returncode
 
-        self.args = []
+    def _build_args(self, *args, **kwargs):
+        """
+        Return the command line (a list) to run the executable with args,
+        prefixed by mpiexec and/or valgrind according to kwargs.
+        """
+        cmd = []
 
         # Get mpi info
         mpi_proc = kwargs.pop('mpi_proc', None)
@@ -110,7 +181,7 @@ class VIC(object):
             if not isinstance(mpi_proc, int):
                 raise TypeError("number of processors must be specified as an"
                                 "integer")
-            self.args.extend(['mpiexec', '-np', '%.0d' % mpi_proc])
+            cmd.extend(['mpiexec', '-np', '%.0d' % mpi_proc])
 
         # Get valgrind info
         valgrind = kwargs.pop('valgrind', None)
@@ -119,76 +190,424 @@ class VIC(object):
                 valgrind = 'valgrind'
             errorcode = os.getenv('VIC_VALGRIND_ERROR',
                                   default_vic_valgrind_error_code)
-            self.args.extend([valgrind, '-v', '--leak-check=full',
-                             '--error-exitcode={0}'.format(errorcode)])
+            cmd.extend([valgrind, '-v', '--leak-check=full',
+                        '--error-exitcode={0}'.format(errorcode)])
 
             suppressions = os.getenv('VIC_VALGRIND_SUPPRESSIONS',
                                      default_vic_valgrind_suppressions_path)
             if os.path.isfile(suppressions):
-                self.args.extend(['--suppressions={0}'.format(suppressions)])
+                cmd.extend(['--suppressions={0}'.format(suppressions)])
 
         # if there are kwargs left, we don't know what to do with them so
         # raise an error
         if kwargs:
             raise ValueError('Unknown argument(s): %s' % ', '.join(kwargs.keys()))
 
-        self.args += [self.executable] + [a for a in args]
+        return cmd + [self.executable] + [a for a in args]
 
-        # set the args attribute
+    def _call_vic(self, *args, **kwargs):
+        log_files = kwargs.pop('log_files', (None, None))
+        progress = kwargs.pop('progress', None)
+        tail_lines = kwargs.pop('tail_lines', None)
 
+        # set the args attribute
+        self.args = self._build_args(*args, **kwargs)
         self.argstring = ' '.join(self.args)
 
-        proc = subprocess.Popen(self.argstring,
-                                shell=True,
-                                stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        retvals = proc.communicate()
+        self.returncode, self.stdout, self.stderr = _run_command(
+            self.argstring, log_files=log_files, progress=progress,
+            tail_lines=tail_lines)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class VICRunManager(object):
+    """
+    Run many VIC simulations concurrently, at most max_workers at a time.
+
+    Each run writes its stdout and stderr to its own log files in logdir
+    (stdout_{name}.txt and stderr_{name}.txt).  Runs are started in a new
+    session and stopped, with all of their processes, like `VIC.run`.  As
+    the runs do not receive the signals of the terminal, leaving the with
+    block with an exception (e.g. KeyboardInterrupt) cancels the queued runs
+    and terminates the running ones, see `cancel`.
+
+    Examples
+    --------
+    with VICRunManager(vic, max_workers=8, logdir='logs') as runs:
+        for path in global_param_files:
+            runs.submit(path)
+    failed = [name for name, code in runs.returncodes.items() if code]
+    """
+
+    def __init__(self, vic, max_workers=None, logdir=None):
+        self.vic = vic
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self.max_workers = max_workers
+        self.logdir = logdir or os.getcwd()
+        self.futures = OrderedDict()
+        self.returncodes = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        # running processes by run name
+        self._procs = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def submit(self, global_param, name=None, progress=None, **kwargs):
+        """
+        Queue a VIC run of global_param (a path to a global parameter file
+        or a multiline string of global parameter options, see `VIC.run`).
+        progress is the progress callback of this run (see `VIC.run`).
+        kwargs (mpi_proc, valgrind) are passed on to the executable.
+        Returns a future of the return code of the run.
+        """
+        if name is None:
+            name = 'run_{0:04d}'.format(len(self.futures))
+        if name in self.futures:
+            raise ValueError('a run named {0} already exists'.format(name))
+        global_param_file, temporary = _global_param_file(global_param)
+        try:
+            args = self.vic._build_args('-g', global_param_file, **kwargs)
+        except Exception:
+            if temporary:
+                os.remove(global_param_file)
+            raise
+
+        self.returncodes[name] = None
+        future = self._pool.submit(self._run, name, args, progress,
+                                   global_param_file if temporary else None)
+        self.futures[name] = future
+        return future
+
+    def map(self, global_params, **kwargs):
+        """Queue a run of each of global_params, returns the futures"""
+        return [self.submit(global_param, **kwargs)
+                for global_param in global_params]
+
+    def wait(self):
+        """Wait for all runs, returns the return codes by run name"""
+        for future in self.futures.values():
+            future.result()
+        return self.returncodes
+
+    def cancel(self):
+        """Cancel the queued runs and terminate the running ones"""
+        with self._lock:
+            self._cancelled = True
+            for future in self.futures.values():
+                future.cancel()
+            for proc in self._procs.values():
+                _terminate(proc)
+
+    def shutdown(self, wait=True):
+        """Stop accepting runs (and wait for the queued ones)"""
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+        self.shutdown()
+
+    def log_files(self, name):
+        """Paths of the stdout and stderr log files of a run"""
+        return (os.path.join(self.logdir, 'stdout_{0}.txt'.format(name)),
+                os.path.join(self.logdir, 'stderr_{0}.txt'.format(name)))
+
+    def _run(self, name, args, progress=None, temporary_file=None):
+        def started(proc):
+            with self._lock:
+                self._procs[name] = proc
+                if self._cancelled:
+                    _terminate(proc)
+
+        try:
+            returncode = _run_command(' '.join(args),
+                                      log_files=self.log_files(name),
+                                      progress=progress, tail_lines=0,
+                                      started=started)[0]
+        finally:
+            with self._lock:
+                self._procs.pop(name, None)
+            if temporary_file is not None:
+                os.remove(temporary_file)
+        self.returncodes[name] = returncode
+        return returncode
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+class VICProgress(object):
+    """
+    Progress callback for `VIC.run`.
+
+    Parses the simulated date from VIC's output lines (the first match of
+    pattern, with year, month and day groups) to report the throughput in
+    simulated days per second.  If no new date arrives within stall_timeout
+    seconds, the run is considered stalled and is terminated.  The stall
+    clock only applies once the first date has arrived; the startup of VIC
+    (e.g. reading large parameter or forcing files) has its own limit,
+    startup_timeout seconds (default None, no limit).  The state is reset at
+    the start of each run, so one VICProgress can follow several runs in
+    turn.
+    """
+
+    def __init__(self, stall_timeout=None, pattern=DATE_PATTERN,
+                 verbose=False, report_every=60, startup_timeout=None):
+        self.stall_timeout = stall_timeout
+        self.startup_timeout = startup_timeout
+        self.pattern = re.compile(pattern)
+        self.verbose = verbose
+        self.report_every = report_every
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Restart the stall clock and forget the dates of a previous run"""
+        with self._lock:
+            self.start = self.last_update = self.last_report = time.time()
+            self.first_date = None
+            self.date = None
+            self.stalled = False
+
+    def __call__(self, line):
+        match = self.pattern.search(line.decode('utf-8', 'replace'))
+        if match is None:
+            return
+        date = datetime(*[int(g) for g in match.groups()[:3]])
+        with self._lock:
+            if self.first_date is None:
+                self.first_date = date
+                self.start = time.time()
+            if self.date is None or date > self.date:
+                self.date = date
+                self.last_update = time.time()
+
+    @property
+    def throughput(self):
+        """Simulated days per second of wall time"""
+        if self.date is None or self.last_update <= self.start:
+            return 0.
+        days = (self.date - self.first_date).total_seconds() / 86400.
+        return days / (self.last_update - self.start)
+
+    def poll(self):
+        """Report the progress, returns True if the run has stalled"""
+        now = time.time()
+        if self.verbose and now - self.last_report >= self.report_every:
+            print(self)
+            self.last_report = now
+        if self.first_date is None:
+            timeout = self.startup_timeout
+        else:
+            timeout = self.stall_timeout
+        if timeout is not None and now - self.last_update > timeout:
+            self.stalled = True
+        return self.stalled
+
+    def __str__(self):
+        return 'VIC at {0}, {1:.1f} simulated days/s'.format(
+            self.date, self.throughput)
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _run_command(argstring, log_files=(None, None), progress=None,
+                 tail_lines=None, started=None):
+    """
+    Run argstring in a new session, so that all of its processes can be
+    stopped, streaming its stdout and stderr to log_files and progress
+    (see `VIC.run`).  The process group is terminated if progress.poll
+    returns True or if waiting for it is interrupted.  started, if given,
+    is called with the Popen object once the process has started.
+    Returns the return code and the last tail_lines of stdout and stderr.
+    """
+    # a progress object may be reused, its state is that of this run
+    reset = getattr(progress, 'reset', None)
+    if reset is not None:
+        reset()
+
+    proc = subprocess.Popen(argstring,
+                            shell=True,
+                            stderr=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            **NEW_SESSION)
+    if started is not None:
+        started(proc)
+
+    # stream the output through bounded buffers
+    tails = (deque(maxlen=tail_lines), deque(maxlen=tail_lines))
+    readers = [threading.Thread(target=_stream_lines,
+                                args=(pipe, log_file, tail, progress))
+               for pipe, log_file, tail in zip((proc.stdout, proc.stderr),
+                                               log_files, tails)]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    poll = getattr(progress, 'poll', None)
+    try:
+        while readers[0].is_alive():
+            readers[0].join(POLL_INTERVAL)
+            if poll is not None and proc.poll() is None and poll():
+                _terminate(proc)
+        for reader in readers:
+            reader.join()
+    except BaseException:
+        _terminate(proc)
+        raise
+
+    return proc.wait(), b''.join(tails[0]), b''.join(tails[1])
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _terminate(proc):
+    """Terminate the process group of proc (if it is still running)"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+# -------------------------------------------------------------------- #
+
 
-        self.stdout = retvals[0]
-        self.stderr = retvals[1]
-        self.returncode = proc.returncode
+# -------------------------------------------------------------------- #
+def _stream_lines(pipe, log_file, tail, callback):
+    """
+    Read the lines of pipe until it closes, writing them to log_file,
+    keeping them in tail and calling callback with each line.
+    """
+    log = open(log_file, mode='wb') if log_file else None
+    try:
+        for line in iter(pipe.readline, b''):
+            if log is not None:
+                log.write(line)
+            tail.append(line)
+            if callback is not None:
+                callback(line)
+    finally:
+        pipe.close()
+        if log is not None:
+            log.close()
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _read_probe_cache(cache_file):
+    """Entries of a probe cache file, empty if it is missing or invalid"""
+    try:
+        with open(cache_file) as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _write_probe_cache(cache_file, entries):
+    """
+    Atomically replace cache_file with entries, through a temporary file
+    unique to this call (threads and processes may write concurrently)
+    """
+    fd, tmp_file = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(cache_file)), suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(cache_file)), text=True)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        if PY3:
+            os.replace(tmp_file, cache_file)
+        else:  # pragma: no cover
+            os.rename(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _global_param_file(global_param):
+    """
+    Return the path of global_param, a global parameter file or a string of
+    global parameter options (which is written to a temporary file), and
+    whether it is a temporary file to be removed after the run
+    """
+    if os.path.isfile(global_param):
+        return global_param, False
+    # global_param is a string
+    fd, global_param_file = tempfile.mkstemp(prefix='vic.global.param.',
+                                             suffix='.txt', text=True)
+    with os.fdopen(fd, 'w') as f:
+        f.write(global_param)
+    return global_param_file, True
 # -------------------------------------------------------------------- #
 
 
 # -------------------------------------------------------------------- #
 def read_vic_ascii(filepath, header=True, parse_dates=True,
-                   datetime_index=None, names=None, **kwargs):
+                   datetime_index=None, names=None, usecols=None, **kwargs):
     """Generic reader function for VIC ASCII output with a standard header
     filepath: path to VIC output file
     header (True or False):  Standard VIC header is present
     parse_dates (True or False): Parse dates from file
     datetime_index (Pandas.tseries.index.DatetimeIndex):  Index to use as
-    datetime index names (list like): variable names
-    **kwargs: passed to Pandas.read_table
+    datetime index names (list like): variable names, required to parse the
+    dates if there is no header
+    usecols (list like): variable names to read, default is all
+    **kwargs: passed to Pandas.read_csv
 
     returns Pandas.DataFrame
     """
     kwargs['header'] = None
+    kwargs.setdefault('sep', '\t')
+    kwargs.setdefault('engine', 'c')
 
-    if header:
-        kwargs['skiprows'] = 6
+    with open(filepath) as f:
+        if header:
+            # skip lines 0 through 4, line 5 holds the names
+            lines = [next(f) for _ in range(6)]
+            if names is None:
+                names = lines[5].strip('#').replace('OUT_', '').split()
 
-        # get names
         if names is None:
-            with open(filepath) as f:
-                # skip lines 0 through 5
-                for _ in range(5):
-                    next(f)
-
-                # process header
-                names = next(f)
-                names = names.strip('#').replace('OUT_', '').split()
-
-    kwargs['names'] = names
-
-    if parse_dates:
-        time_cols = ['YEAR', 'MONTH', 'DAY']
-        if 'HOUR' in names:
-            time_cols.append('HOUR')
-        kwargs['parse_dates'] = {'datetime': time_cols}
-        kwargs['index_col'] = 0
-
-    df = pd.read_table(filepath, **kwargs)
+            # without a header or names, read_csv infers the columns
+            if parse_dates and datetime_index is None:
+                raise ValueError('names are required to parse the dates of '
+                                 'a file without header')
+            df = pd.read_csv(f, usecols=usecols, **kwargs)
+            read_time = []
+        else:
+            time_cols = []
+            if parse_dates:
+                time_cols = [col for col in TIME_COLS if col in names]
+            # the time columns are only read to build the datetime index
+            read_time = time_cols if datetime_index is None else []
+            if usecols is None:
+                usecols = [name for name in names if name not in time_cols]
+            usecols = read_time + [name for name in usecols
+                                   if name not in time_cols]
+
+            dtype = dict((name, np.int64 if name in TIME_COLS
+                          else np.float64) for name in usecols)
+            df = pd.read_csv(f, names=names, usecols=usecols, dtype=dtype,
+                             **kwargs)
+
+    if read_time:
+        # datetime64 arithmetic on the integer columns
+        times = (df['YEAR'].values - 1970).astype('datetime64[Y]')
+        times = (times.astype('datetime64[M]') +
+                 (df['MONTH'].values - 1).astype('timedelta64[M]'))
+        times = (times.astype('datetime64[D]') +
+                 (df['DAY'].values - 1).astype('timedelta64[D]'))
+        if 'HOUR' in read_time:
+            times = times + df['HOUR'].values.astype('timedelta64[h]')
+        df = df.drop(read_time, axis=1)
+        df.index = pd.DatetimeIndex(times.astype('datetime64[ns]'),
+                                    name='datetime')
 
     if datetime_index is not None:
         df.index = datetime_index
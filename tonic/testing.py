@@ -2,6 +2,7 @@
 """functions to support testing of VIC output"""
 
 from __future__ import print_function
+import numpy as np
 # import pandas as pd
 
 
@@ -32,3 +33,29 @@ def check_completed(df, start, end):
     return
 
 # -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def snow17_forcings(nsteps, ncells=1, dt=24, start='2000-10-01'):
+    """
+    Deterministic synthetic Snow-17 forcings (time, prec, tair) of nsteps
+    timesteps of dt hours, starting at start.  prec and tair have shape
+    (nsteps, ncells), from colder and drier to warmer and wetter cells.
+    """
+    time = (np.datetime64(start, 'h') +
+            np.arange(nsteps) * np.timedelta64(dt, 'h')).astype(object)
+    hours = np.arange(nsteps) * float(dt)
+    days = hours / 24.
+
+    # seasonal cycle (coldest in January), weather and daily cycle
+    tair = (-10 * np.cos(2 * np.pi * (days - 100) / 365.25) +
+            4 * np.sin(2 * np.pi * days / 6.3))
+    if dt < 24:
+        tair += 5 * np.sin(2 * np.pi * (hours % 24 - 9) / 24)
+    storms = np.maximum(np.sin(2 * np.pi * days / 4.7), 0) ** 4
+    prec = 20 * (dt / 24.) * storms
+
+    tair = tair[:, np.newaxis] + np.linspace(-6, 6, ncells + 2)[1:-1]
+    prec = prec[:, np.newaxis] * np.linspace(0.5, 1.5, ncells + 2)[1:-1]
+    return time, prec, tair
+# -------------------------------------------------------------------- #
@@ -46,19 +46,100 @@ class FakeNcVar(np.ndarray):
 
 
 # -------------------------------------------------------------------- #
-def latlon2yx(plats, plons, glats, glons):
-    """find y x coordinates """
+class GridIndex(object):
+    """
+    Nearest neighbor lookup of lat/lon points on a target grid.
+    Grids with 1d (or 2d rectilinear) coordinates are indexed along each
+    axis, by arithmetic from the origin and step for evenly spaced axes and
+    by a binary search otherwise.  Only curvilinear grids use a cKDTree.
+    """
+    def __init__(self, glats, glons, rtol=1e-3):
+        glats = np.asarray(glats, dtype=np.float64)
+        glons = np.asarray(glons, dtype=np.float64)
+
+        if glats.ndim == 1 and glons.ndim == 1:
+            lat, lon = glats, glons
+        elif (glats.ndim == 2 and glats.shape == glons.shape and
+              np.allclose(glats, glats[:, :1]) and
+              np.allclose(glons, glons[:1, :])):
+            lat, lon = glats[:, 0], glons[0, :]
+        else:
+            lat = lon = None
+
+        if lat is not None:
+            self.shape = (len(lat), len(lon))
+            self.axes = (_grid_axis(lat, rtol), _grid_axis(lon, rtol))
+            self.tree = None
+        else:
+            self.shape = glats.shape
+            self.axes = None
+            combined = np.column_stack((glats.ravel(), glons.ravel()))
+            self.tree = cKDTree(combined)
+
+    @property
+    def regular(self):
+        """True if both grid axes are evenly spaced"""
+        return (self.axes is not None and
+                all(axis['step'] is not None for axis in self.axes))
+
+    def query(self, plats, plons):
+        """Return the y and x indices of the grid cells nearest to points"""
+        plats = np.asarray(plats, dtype=np.float64).ravel()
+        plons = np.asarray(plons, dtype=np.float64).ravel()
+
+        if self.tree is None:
+            y = _axis_inds(self.axes[0], plats)
+            x = _axis_inds(self.axes[1], plons)
+        else:
+            dist, indexes = self.tree.query(np.column_stack((plats, plons)),
+                                            k=1)
+            y, x = np.unravel_index(indexes, self.shape)
+        return y, x
+# -------------------------------------------------------------------- #
+
+
+# -------------------------------------------------------------------- #
+def _grid_axis(values, rtol=1e-3):
+    """Describe a 1d grid axis for _axis_inds"""
+    axis = {'size': len(values), 'step': None}
+    if len(values) == 1:
+        axis['origin'] = values[0]
+        axis['step'] = 1.
+    else:
+        step = (values[-1] - values[0]) / (len(values) - 1)
+        # the cumulative deviation from a regular axis, small deviations of
+        # the steps may add up to more than a grid cell
+        regular = values[0] + step * np.arange(len(values))
+        if step != 0 and np.abs(values - regular).max() < rtol * abs(step):
+            axis['origin'] = values[0]
+            axis['step'] = step
+        else:
+            axis['order'] = np.argsort(values, kind='mergesort')
+            axis['values'] = values[axis['order']]
+    return axis
+# -------------------------------------------------------------------- #
 
-    if glons.ndim == 1 or glats.ndim == 1:
-        glons, glats = np.meshgrid(glons, glats)
 
-    combined = np.dstack(([glats.ravel(), glons.ravel()]))[0]
-    points = list(np.vstack((np.array(plats), np.array(plons))).transpose())
+# -------------------------------------------------------------------- #
+def _axis_inds(axis, points):
+    """Indices of the nearest axis values to points"""
+    if axis['step'] is not None:
+        inds = np.rint((points - axis['origin']) / axis['step'])
+        return np.clip(inds, 0, axis['size'] - 1).astype(int)
+
+    values = axis['values']
+    right = np.clip(np.searchsorted(values, points), 1, len(values) - 1)
+    left = right - 1
+    inds = np.where(points - values[left] <= values[right] - points,
+                    left, right)
+    return axis['order'][inds]
+# -------------------------------------------------------------------- #
+
 
-    mytree = cKDTree(combined)
-    dist, indexes = mytree.query(points, k=1)
-    y, x = np.unravel_index(np.array(indexes), glons.shape)
-    return y, x
+# -------------------------------------------------------------------- #
+def latlon2yx(plats, plons, glats, glons):
+    """find y x coordinates """
+    return GridIndex(glats, glons).query(plats, plons)
 # -------------------------------------------------------------------- #
 
 
@@ -107,7 +188,7 @@ def calc_grid(lats, lons, decimals=4):
 def get_grid_inds(domain, points):
     """
     Find location of lat/lon points in 2d target grid.
-    Uses cKdtree nearest neighbor mapping.
+    Uses nearest neighbor mapping (see GridIndex).
     """
     lons = points.get_lons()
     lats = points.get_lats()
@@ -117,17 +198,7 @@ def get_grid_inds(domain, points):
         lons[posinds] += 360
         print('adjusted VIC lon minimum (+360 for negative lons)')
 
-    # Make sure the longitude / latitude vars are 2d
-    if domain['lat'].ndim == 1 or domain['lon'].ndim == 1:
-        dlons, dlats = np.meshgrid(domain['lon'], domain['lat'])
-
-    combined = np.dstack(([dlats.ravel(), dlons.ravel()]))[0]
-    point_list = list(np.vstack((lats, lons)).transpose())
-
-    mytree = cKDTree(combined)
-    dist, indexes = mytree.query(point_list, k=1)
-
-    yinds, xinds = np.unravel_index(indexes, dlons.shape)
+    yinds, xinds = GridIndex(domain['lat'], domain['lon']).query(lats, lons)
 
     points.add_xs(xinds)
     points.add_ys(yinds)